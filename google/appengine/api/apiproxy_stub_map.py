@@ -19,15 +19,24 @@
 
 Classes/variables/functions defined here:
   APIProxyStubMap: container of APIProxy stubs.
+  RPC: asynchronous call to a stub, run on a worker thread.
+  CallStatsCollector: post-call hook that keeps per-call latency histograms.
   apiproxy: global instance of an APIProxyStubMap.
   MakeSyncCall: APIProxy entry point.
+  CreateRPC: APIProxy entry point for asynchronous calls.
 """
 
 
 
 
 
+import Queue
+import bisect
 import sys
+import threading
+import time
+
+from google.appengine.runtime import apiproxy_errors
 
 def MakeSyncCall(service, call, request, response):
   """The APIProxy entry point.
@@ -41,10 +50,440 @@ def MakeSyncCall(service, call, request, response):
   Raises:
     apiproxy_errors.Error or a subclass.
   """
-  stub = apiproxy.GetStub(service)
-  assert stub, ("No api proxy found for service %s!"
-                " Was a default api proxy provided?" % service)
-  stub.MakeSyncCall(service, call, request, response)
+  apiproxy.MakeSyncCall(service, call, request, response)
+
+
+def CreateRPC(service):
+  """Creates an RPC object for an asynchronous API call.
+
+  Args:
+    service: string representing which service to call
+
+  Returns:
+    an RPC object, with the same interface as
+    google.appengine.runtime.apiproxy.RPC
+  """
+  return apiproxy.CreateRPC(service)
+
+
+class _ThreadPool(object):
+  """A bounded number of daemon threads that run functions from a queue.
+
+  Threads are started as functions are submitted, when none are idle, up to
+  the pool's size. Functions submitted while all of the threads are busy wait
+  in the queue.
+  """
+
+  def __init__(self, size):
+    """Constructor.
+
+    Args:
+      size: int, the maximum number of threads
+    """
+    self.__size = size
+    self.__queue = Queue.Queue()
+    self.__threads = []
+    self.__idle = 0
+    self.__lock = threading.Lock()
+
+    self.__calls = 0
+    self.__queued = 0
+    self.__max_queued = 0
+    self.__queue_time = 0.0
+    self.__max_queue_time = 0.0
+    self.__deadlines_exceeded = 0
+
+  def SetSize(self, size):
+    """Changes the maximum number of threads.
+
+    Threads that are already running are kept, even if there are more of them
+    than the new size.
+
+    Args:
+      size: int
+    """
+    self.__size = size
+
+  def Submit(self, function):
+    """Runs a function on one of the pool's threads.
+
+    Args:
+      function: callable taking no arguments. Exceptions it raises are
+          discarded, so it should handle them itself.
+    """
+    self.__lock.acquire()
+    try:
+      self.__calls += 1
+      self.__queued += 1
+      self.__max_queued = max(self.__max_queued, self.__queued)
+      if self.__idle < self.__queued and len(self.__threads) < self.__size:
+        thread = threading.Thread(target=self.__Work)
+        thread.setDaemon(True)
+        thread.start()
+        self.__threads.append(thread)
+    finally:
+      self.__lock.release()
+    self.__queue.put((time.time(), function))
+
+  def __Work(self):
+    """Runs submitted functions, forever.
+    """
+    while True:
+      self.__lock.acquire()
+      self.__idle += 1
+      self.__lock.release()
+
+      submitted, function = self.__queue.get()
+
+      waited = time.time() - submitted
+      self.__lock.acquire()
+      try:
+        self.__idle -= 1
+        self.__queued -= 1
+        self.__queue_time += waited
+        self.__max_queue_time = max(self.__max_queue_time, waited)
+      finally:
+        self.__lock.release()
+
+      try:
+        function()
+      except:
+        pass
+
+  def RecordDeadlineExceeded(self):
+    """Counts a call that missed its deadline.
+    """
+    self.__lock.acquire()
+    self.__deadlines_exceeded += 1
+    self.__lock.release()
+
+  def Stats(self):
+    """Returns the pool's queueing statistics.
+
+    Returns:
+      dict with these keys:
+        threads: the number of threads started
+        calls: the number of functions submitted
+        queued: the number of functions waiting for a thread
+        max_queued: the most functions that have waited at once
+        queue_time: total seconds that functions waited for a thread
+        max_queue_time: the longest any function waited, in seconds
+        deadlines_exceeded: the number of calls that missed their deadline
+    """
+    self.__lock.acquire()
+    try:
+      return {'threads': len(self.__threads),
+              'calls': self.__calls,
+              'queued': self.__queued,
+              'max_queued': self.__max_queued,
+              'queue_time': self.__queue_time,
+              'max_queue_time': self.__max_queue_time,
+              'deadlines_exceeded': self.__deadlines_exceeded,
+              }
+    finally:
+      self.__lock.release()
+
+
+class _CallHooks(object):
+  """The pre- and post-call hooks of an APIProxyStubMap.
+
+  Hooks are added rarely and run on every call, from many threads, so adding
+  one replaces the hook lists rather than changing them in place.
+  """
+
+  def __init__(self):
+    """Constructor."""
+    self.__pre_call_hooks = ()
+    self.__post_call_hooks = ()
+
+  def AddPreCallHook(self, hook):
+    """Adds a hook that runs before each call."""
+    self.__pre_call_hooks += (hook,)
+
+  def AddPostCallHook(self, hook):
+    """Adds a hook that runs after each call."""
+    self.__post_call_hooks += (hook,)
+
+  def PreCall(self, service, call, request):
+    """Runs the pre-call hooks.
+
+    Args:
+      service: string
+      call: string
+      request: protocol buffer for the request
+
+    Returns:
+      int, the size of the request in bytes, or None if there are no hooks to
+      pass it to.
+    """
+    if not self.__pre_call_hooks and not self.__post_call_hooks:
+      return None
+    request_size = request.ByteSize()
+    for hook in self.__pre_call_hooks:
+      hook(service, call, request_size)
+    return request_size
+
+  def PostCall(self, service, call, request_size, response, elapsed,
+               exception):
+    """Runs the post-call hooks.
+
+    Args:
+      service: string
+      call: string
+      request_size: int, as returned by PreCall(). The hooks don't run if
+          this is None, since they were added while the call was running.
+      response: protocol buffer for the response
+      elapsed: float, the wall time of the call in seconds
+      exception: the exception the call raised, or None if it succeeded
+    """
+    if not self.__post_call_hooks or request_size is None:
+      return
+    if exception is None:
+      response_size = response.ByteSize()
+    else:
+      response_size = 0
+    for hook in self.__post_call_hooks:
+      hook(service, call, request_size, response_size, elapsed, exception)
+
+
+class CallStatsCollector(object):
+  """A post-call hook that counts calls and keeps latency histograms.
+
+  Calls are grouped by (service, call). Add an instance to an APIProxyStubMap
+  with AddPostCallHook(), and read what it has collected with Snapshot().
+  """
+
+  LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+                     1.0, 2.0, 5.0)
+
+  def __init__(self):
+    """Constructor."""
+    self.__lock = threading.Lock()
+    self.Reset()
+
+  def Reset(self):
+    """Discards everything collected so far."""
+    self.__lock.acquire()
+    try:
+      self.__stats = {}
+      self.__start_time = time.time()
+    finally:
+      self.__lock.release()
+
+  def __call__(self, service, call, request_size, response_size, elapsed,
+               exception):
+    """Records a call. Arguments are as for a post-call hook."""
+    bucket = bisect.bisect_left(self.LATENCY_BUCKETS, elapsed)
+    self.__lock.acquire()
+    try:
+      stats = self.__stats.get((service, call))
+      if stats is None:
+        stats = {'count': 0,
+                 'errors': 0,
+                 'total_time': 0.0,
+                 'max_time': 0.0,
+                 'request_bytes': 0,
+                 'response_bytes': 0,
+                 'histogram': [0] * (len(self.LATENCY_BUCKETS) + 1),
+                 }
+        self.__stats[(service, call)] = stats
+      stats['count'] += 1
+      if exception is not None:
+        stats['errors'] += 1
+      stats['total_time'] += elapsed
+      stats['max_time'] = max(stats['max_time'], elapsed)
+      stats['request_bytes'] += request_size
+      stats['response_bytes'] += response_size
+      stats['histogram'][bucket] += 1
+    finally:
+      self.__lock.release()
+
+  def StartTime(self):
+    """Returns the time collection started, in seconds since the epoch."""
+    return self.__start_time
+
+  def Snapshot(self):
+    """Returns a copy of the statistics collected so far.
+
+    Returns:
+      dict mapping (service, call) tuples to dicts with these keys:
+        count: the number of calls
+        errors: the number of calls that raised an exception
+        total_time: the total wall time of the calls, in seconds
+        max_time: the longest call, in seconds
+        request_bytes: the total size of the requests
+        response_bytes: the total size of the successful calls' responses
+        histogram: list of call counts. Entry i counts the calls that took at
+          most LATENCY_BUCKETS[i] seconds, and longer than the bucket before;
+          the last entry counts the calls longer than every bucket.
+    """
+    self.__lock.acquire()
+    try:
+      snapshot = {}
+      for key, stats in self.__stats.iteritems():
+        stats = stats.copy()
+        stats['histogram'] = list(stats['histogram'])
+        snapshot[key] = stats
+      return snapshot
+    finally:
+      self.__lock.release()
+
+
+class RPC(object):
+  """An asynchronous call to a stub.
+
+  The stub's MakeSyncCall() runs on a worker thread. Has the same interface as
+  google.appengine.runtime.apiproxy.RPC, so code using it also works against
+  the real APIProxy.
+
+  If the call has a deadline and doesn't finish in time, Wait() stops waiting
+  for it and CheckSuccess() raises DeadlineExceededError. The worker thread
+  can't be interrupted, so the stub still finishes the call, but into a
+  response of its own that is then discarded.
+
+  Post-call hooks run in Wait(), before the callback.
+  """
+
+  IDLE = 0
+  RUNNING = 1
+  FINISHING = 2
+
+  def __init__(self, stub, thread_pool, deadline=None, package=None,
+               call=None, request=None, response=None, callback=None,
+               hooks=None):
+    """Constructor.
+
+    Args:
+      stub: the stub that serves the call
+      thread_pool: _ThreadPool to run the call on
+      deadline: float, seconds after MakeCall() at which the call fails, or
+          None to wait as long as it takes
+      package, call, request, response, callback: as for MakeCall()
+      hooks: _CallHooks to run around the call, if any
+    """
+    self.__stub = stub
+    self.__thread_pool = thread_pool
+    self.__deadline = deadline
+    self.__hooks = hooks
+    self.__request_size = None
+    self.__start_time = None
+    self.__end_time = None
+    self.__stub_response = None
+    self.__exception = None
+    self.__traceback = None
+    self.__state = RPC.IDLE
+    self.__done = threading.Event()
+
+    self.package = package
+    self.call = call
+    self.request = request
+    self.response = response
+    self.callback = callback
+
+  def MakeCall(self, package=None, call=None, request=None, response=None,
+               callback=None):
+    """Starts the call on a worker thread, and returns immediately.
+
+    callback, if provided, is called by Wait() once the call has finished,
+    whether or not it succeeded.
+
+    Args:
+      package: string, the package for the call
+      call: string, the call within the package
+      request: ProtocolMessage instance, appropriate for the arguments
+      response: ProtocolMessage instance, appropriate for the response
+      callback: callable, called when call is complete
+    """
+    self.callback = callback or self.callback
+    self.package = package or self.package
+    self.call = call or self.call
+    self.request = request or self.request
+    self.response = response or self.response
+
+    assert self.__state is RPC.IDLE, ("RPC for %s.%s has already been started" %
+                                      (self.package, self.call))
+    assert self.callback is None or callable(self.callback)
+
+    if self.__deadline is None:
+      self.__stub_response = self.response
+    else:
+      self.__stub_response = self.response.__class__()
+
+    if self.__hooks:
+      self.__request_size = self.__hooks.PreCall(self.package, self.call,
+                                                 self.request)
+
+    self.__state = RPC.RUNNING
+    self.__start_time = time.time()
+    self.__thread_pool.Submit(self.__Run)
+
+  def __Run(self):
+    """Makes the call on the stub. Runs on a worker thread.
+    """
+    try:
+      try:
+        self.__stub.MakeSyncCall(self.package, self.call, self.request,
+                                 self.__stub_response)
+      except Exception, e:
+        self.__exception = e
+        self.__traceback = sys.exc_info()[2]
+    finally:
+      self.__end_time = time.time()
+      self.__done.set()
+
+  def Wait(self):
+    """Waits for the call to finish or its deadline to pass, then calls the
+    callback, if any. Returns immediately if the call was never started, or
+    has already been waited for.
+    """
+    if self.__state is not RPC.RUNNING:
+      return
+
+    if self.__deadline is None:
+      self.__done.wait()
+    else:
+      remaining = self.__start_time + self.__deadline - time.time()
+      if remaining > 0:
+        self.__done.wait(remaining)
+
+      if not self.__done.isSet():
+        self.__thread_pool.RecordDeadlineExceeded()
+        self.__exception = apiproxy_errors.DeadlineExceededError(
+            'The API call %s.%s() took too long to respond and was '
+            'cancelled.' % (self.package, self.call))
+        self.__traceback = None
+      elif not self.__exception:
+        self.response.CopyFrom(self.__stub_response)
+
+    self.__state = RPC.FINISHING
+    if self.__hooks:
+      if self.__done.isSet():
+        elapsed = self.__end_time - self.__start_time
+      else:
+        elapsed = self.__deadline
+      self.__hooks.PostCall(self.package, self.call, self.__request_size,
+                            self.response, elapsed, self.__exception)
+    if self.callback:
+      self.callback()
+
+  def CheckSuccess(self):
+    """If there was an exception, raise it now.
+
+    Raises:
+      Exception of the API call, if any.
+    """
+    if self.__exception and self.__traceback:
+      raise self.__exception.__class__, self.__exception, self.__traceback
+    if self.__exception:
+      raise self.__exception
+
+  @property
+  def exception(self):
+    return self.__exception
+
+  @property
+  def state(self):
+    return self.__state
 
 
 class APIProxyStubMap:
@@ -58,8 +497,22 @@ class APIProxyStubMap:
   implementations. To achieve this, we allow the client to attach stubs to
   service names, as well as define a default stub to be used if no specific
   matching stub is identified.
+
+  Asynchronous calls to stubs run on a pool of threads per service, of at most
+  DEFAULT_MAX_THREADS threads unless ConfigureService() says otherwise. Once a
+  service has been configured, its synchronous calls run on its pool too, so
+  that its thread limit and deadline apply to them as well. A slow service then
+  only ties up its own threads, and a flood of calls waits in its queue instead
+  of starting more threads.
+
+  Pre- and post-call hooks added with AddPreCallHook() and AddPostCallHook()
+  run around every synchronous call, and every asynchronous call that runs on
+  a thread pool. Asynchronous calls through a stub's own CreateRPC() aren't
+  hooked.
   """
 
+  DEFAULT_MAX_THREADS = 10
+
 
   def __init__(self, default_stub=None):
     """Constructor.
@@ -71,6 +524,10 @@ class APIProxyStubMap:
     """
     self.__stub_map = {}
     self.__default_stub = default_stub
+    self.__service_config = {}
+    self.__thread_pools = {}
+    self.__thread_pools_lock = threading.Lock()
+    self.__hooks = _CallHooks()
 
   def RegisterStub(self, service, stub):
     """Register the provided stub for the specified service.
@@ -99,6 +556,143 @@ class APIProxyStubMap:
     """
     return self.__stub_map.get(service, self.__default_stub)
 
+  def CreateRPC(self, service):
+    """Creates an RPC object for an asynchronous call to a service.
+
+    If the service's stub has its own CreateRPC(), as the real APIProxy does,
+    its RPC object is used. Otherwise the call is run on a worker thread.
+
+    Args:
+      service: string
+
+    Returns:
+      an RPC object, with the same interface as
+      google.appengine.runtime.apiproxy.RPC
+    """
+    stub = self.GetStub(service)
+    assert stub, ("No api proxy found for service %s!"
+                  " Was a default api proxy provided?" % service)
+    if hasattr(stub, 'CreateRPC'):
+      return stub.CreateRPC()
+    deadline = self.__service_config.get(service, (None, None))[1]
+    return RPC(stub, self.__GetThreadPool(service), deadline,
+               hooks=self.__hooks)
+
+  def MakeSyncCall(self, service, call, request, response):
+    """Makes a synchronous call to a service.
+
+    Calls to services that haven't been configured with ConfigureService() run
+    directly on the calling thread.
+
+    Args:
+      service: string
+      call: string
+      request: protocol buffer for the request
+      response: protocol buffer for the response
+
+    Raises:
+      apiproxy_errors.Error or a subclass.
+    """
+    stub = self.GetStub(service)
+    assert stub, ("No api proxy found for service %s!"
+                  " Was a default api proxy provided?" % service)
+    if service not in self.__service_config or hasattr(stub, 'CreateRPC'):
+      request_size = self.__hooks.PreCall(service, call, request)
+      start_time = time.time()
+      try:
+        stub.MakeSyncCall(service, call, request, response)
+      except Exception, e:
+        self.__hooks.PostCall(service, call, request_size, response,
+                              time.time() - start_time, e)
+        raise
+      self.__hooks.PostCall(service, call, request_size, response,
+                            time.time() - start_time, None)
+      return
+
+    rpc = self.CreateRPC(service)
+    rpc.MakeCall(service, call, request, response)
+    rpc.Wait()
+    rpc.CheckSuccess()
+
+  def ConfigureService(self, service, max_threads=None, deadline=None):
+    """Sets how calls to a service are run.
+
+    Args:
+      service: string
+      max_threads: int, the most calls to the service that may run at once.
+          Defaults to DEFAULT_MAX_THREADS.
+      deadline: float, the number of seconds after which calls to the service
+          fail with DeadlineExceededError, or None for no deadline
+    """
+    if max_threads is None:
+      max_threads = self.DEFAULT_MAX_THREADS
+    assert max_threads > 0
+
+    self.__thread_pools_lock.acquire()
+    try:
+      self.__service_config[service] = (max_threads, deadline)
+      if service in self.__thread_pools:
+        self.__thread_pools[service].SetSize(max_threads)
+    finally:
+      self.__thread_pools_lock.release()
+
+  def AddPreCallHook(self, hook):
+    """Adds a function to run before each API call.
+
+    Args:
+      hook: callable taking (service, call, request_size), where request_size
+          is the request's ByteSize()
+    """
+    self.__hooks.AddPreCallHook(hook)
+
+  def AddPostCallHook(self, hook):
+    """Adds a function to run after each API call.
+
+    Args:
+      hook: callable taking (service, call, request_size, response_size,
+          elapsed, exception). The sizes are ByteSize() of the request and
+          response, response_size is 0 if the call failed, elapsed is the
+          call's wall time in seconds, and exception is what the call raised,
+          or None.
+    """
+    self.__hooks.AddPostCallHook(hook)
+
+  def GetServiceStats(self, service):
+    """Returns the queueing statistics of a service's thread pool.
+
+    Args:
+      service: string
+
+    Returns:
+      dict, as returned by _ThreadPool.Stats(), or None if no calls to the
+      service have run on a thread pool yet.
+    """
+    pool = self.__thread_pools.get(service)
+    if pool is None:
+      return None
+    return pool.Stats()
+
+  def __GetThreadPool(self, service):
+    """Returns the thread pool for a service, creating it if necessary.
+
+    Args:
+      service: string
+
+    Returns:
+      _ThreadPool
+    """
+    self.__thread_pools_lock.acquire()
+    try:
+      pool = self.__thread_pools.get(service)
+      if pool is None:
+        max_threads = self.__service_config.get(
+            service, (self.DEFAULT_MAX_THREADS, None))[0]
+        pool = _ThreadPool(max_threads)
+        self.__thread_pools[service] = pool
+      return pool
+    finally:
+      self.__thread_pools_lock.release()
+
 def GetDefaultAPIProxy():
   try:
     runtime = __import__('google.appengine.runtime', globals(), locals(),
@@ -21,6 +21,9 @@ Defines Entity, Query, and Iterator classes, as well as methods for all of the
 datastore's calls. Also defines conversions between the Python classes and
 their PB counterparts.
 
+GetAsync(), PutAsync(), DeleteAsync() and Query.RunAsync() start a call and
+return a Future right away, so that several calls can be in flight at once.
+
 The datastore errors are defined in the datastore_errors module. That module is
 only required to avoid circular imports. datastore imports datastore_types,
 which needs BadValueError, so it can't be defined in datastore.
@@ -119,12 +122,103 @@ def NormalizeAndTypeCheckKeys(keys):
   return (keys, multiple)
 
 
+class Future(object):
+  """The pending result of an asynchronous datastore call.
+
+  Returned by GetAsync(), PutAsync(), DeleteAsync() and Query.RunAsync().
+  GetResult() waits for the call to finish, then returns what the
+  corresponding synchronous call would have returned, or raises what it would
+  have raised.
+  """
+
+  def __init__(self, rpc, result_hook):
+    """Constructor.
+
+    Args:
+      rpc: an RPC object for a call that has been started
+      result_hook: callable that takes the call's response PB and returns the
+          call's result
+    """
+    self.__rpc = rpc
+    self.__result_hook = result_hook
+    self.__done = False
+    self.__result = None
+    self.__exc_info = None
+
+  def Wait(self):
+    """Waits for the call to finish, without checking whether it succeeded.
+    """
+    self.__rpc.Wait()
+
+  def GetResult(self):
+    """Waits for the call to finish and returns its result.
+
+    Returns:
+      the call's result, as returned by the synchronous call
+
+    Raises:
+      the exception raised by the call, if any
+    """
+    if not self.__done:
+      self.__done = True
+      try:
+        self.__rpc.Wait()
+        try:
+          self.__rpc.CheckSuccess()
+        except apiproxy_errors.ApplicationError, err:
+          raise _ToDatastoreError(err)
+        self.__result = self.__result_hook(self.__rpc.response)
+      except:
+        self.__exc_info = sys.exc_info()
+
+    if self.__exc_info:
+      raise self.__exc_info[0], self.__exc_info[1], self.__exc_info[2]
+    return self.__result
+
+
+def _MakeSyncCall(call, request, response, result_hook):
+  """Makes a datastore call and returns its result.
+
+  Args:
+    call: string, the name of the call
+    request: the request PB
+    response: the response PB
+    result_hook: callable that takes the response PB and returns the result
+
+  Returns:
+    whatever result_hook returns
+  """
+  try:
+    apiproxy_stub_map.MakeSyncCall('datastore_v3', call, request, response)
+  except apiproxy_errors.ApplicationError, err:
+    raise _ToDatastoreError(err)
+  return result_hook(response)
+
+
+def _MakeAsyncCall(call, request, response, result_hook):
+  """Starts a datastore call and returns a Future for its result.
+
+  Args:
+    See _MakeSyncCall().
+
+  Returns:
+    Future
+  """
+  rpc = apiproxy_stub_map.CreateRPC('datastore_v3')
+  rpc.MakeCall('datastore_v3', call, request, response)
+  return Future(rpc, result_hook)
+
+
 def Put(entities):
   """Store one or more entities in the datastore.
 
   The entities may be new or previously existing. For new entities, Put() will
   fill in the app id and key assigned by the datastore.
 
+  Outside a transaction, the entities may belong to any number of entity
+  groups; they are all stored with a single call. Inside a transaction, they
+  must all belong to the transaction's entity group.
+
   If the argument is a single Entity, a single Key will be returned. If the
   argument is a list of Entity, a list of Keys will be returned.
 
@@ -137,42 +231,68 @@ def Put(entities):
   Raises:
     TransactionFailedError, if the Put could not be committed.
   """
+  return _Put(entities, _MakeSyncCall)
+
+
+def PutAsync(entities):
+  """Starts storing one or more entities in the datastore.
+
+  Like Put(), but returns without waiting for the entities to be stored. Inside
+  a transaction, get the result before the transaction function returns.
+
+  Args:
+    entities: Entity or list of Entities
+
+  Returns:
+    Future, whose GetResult() returns what Put() returns
+  """
+  return _Put(entities, _MakeAsyncCall)
+
+
+def _Put(entities, make_call, entity_pbs=None):
+  """Implements Put() and PutAsync().
+
+  Args:
+    entities: Entity or list of Entities
+    make_call: _MakeSyncCall or _MakeAsyncCall
+    entity_pbs: list of the entities' protocol buffers, if the caller has
+      already made them. Used by the db module.
+
+  Returns:
+    whatever make_call returns
+  """
   entities, multiple = NormalizeAndTypeCheck(entities, Entity)
 
-  entity_group = entities[0]._entity_group()
   for entity in entities:
     if not entity.kind() or not entity.app():
       raise datastore_errors.BadRequestError(
           'App and kind must not be empty, in entity: %s' % entity)
-    elif entity._entity_group() != entity_group:
-      raise datastore_errors.BadRequestError(
-          'All entities must be in the same entity group.')
-
-  req = datastore_pb.PutRequest()
-  req.entity_list().extend([e._ToPb() for e in entities])
-  _MaybeSetupTransaction(req, entities[0])
 
-  resp = datastore_pb.PutResponse()
-  try:
-    apiproxy_stub_map.MakeSyncCall('datastore_v3', 'Put', req, resp)
-  except apiproxy_errors.ApplicationError, err:
-    raise _ToDatastoreError(err)
+  if entity_pbs is None:
+    entity_pbs = [e._ToPb() for e in entities]
 
-  keys = resp.key_list()
-  num_keys = len(keys)
-  num_entities = len(entities)
-  if num_keys != num_entities:
-    raise datastore_errors.InternalError(
-        'Put accepted %d entities but returned %d keys.' %
-        (num_entities, num_keys))
-
-  for entity, key in zip(entities, keys):
-    entity._Entity__key._Key__reference.CopyFrom(key)
+  req = datastore_pb.PutRequest()
+  req.entity_list().extend(entity_pbs)
+  _MaybeSetupTransaction(req, entities)
+
+  def result_hook(resp):
+    keys = resp.key_list()
+    num_keys = len(keys)
+    num_entities = len(entities)
+    if num_keys != num_entities:
+      raise datastore_errors.InternalError(
+          'Put accepted %d entities but returned %d keys.' %
+          (num_entities, num_keys))
+
+    for entity, key in zip(entities, keys):
+      entity._Entity__key._CopyFromPb(key)
+
+    if multiple:
+      return [Key._FromPb(k) for k in keys]
+    else:
+      return Key._FromPb(resp.key(0))
 
-  if multiple:
-    return [Key._FromPb(k) for k in keys]
-  else:
-    return Key._FromPb(resp.key(0))
+  return make_call('Put', req, datastore_pb.PutResponse(), result_hook)
 
 
 def Get(keys):
@@ -196,31 +316,56 @@ def Get(keys):
   Returns:
     Entity or list of Entity objects
   """
+  return _Get(keys, _MakeSyncCall)
+
+
+def GetAsync(keys):
+  """Starts retrieving one or more entities from the datastore.
+
+  Like Get(), but returns without waiting for the entities to arrive.
+
+  Args:
+    keys: Key or string or list of Keys or strings
+
+  Returns:
+    Future, whose GetResult() returns what Get() returns
+  """
+  return _Get(keys, _MakeAsyncCall)
+
+
+def _Get(keys, make_call):
+  """Implements Get() and GetAsync().
+
+  Args:
+    keys: Key or string or list of Keys or strings
+    make_call: _MakeSyncCall or _MakeAsyncCall
+
+  Returns:
+    whatever make_call returns
+  """
   keys, multiple = NormalizeAndTypeCheckKeys(keys)
 
   req = datastore_pb.GetRequest()
-  req.key_list().extend([key._Key__reference for key in keys])
-  _MaybeSetupTransaction(req, keys[0])
-
-  resp = datastore_pb.GetResponse()
-  try:
-    apiproxy_stub_map.MakeSyncCall('datastore_v3', 'Get', req, resp)
-  except apiproxy_errors.ApplicationError, err:
-    raise _ToDatastoreError(err)
+  for key in keys:
+    req.add_key().CopyFrom(key._Key__reference)
+  _MaybeSetupTransaction(req, keys)
+
+  def result_hook(resp):
+    entities = []
+    for group in resp.entity_list():
+      if group.has_entity():
+        entities.append(Entity._FromPb(group.entity()))
+      else:
+        entities.append(None)
 
-  entities = []
-  for group in resp.entity_list():
-    if group.has_entity():
-      entities.append(Entity._FromPb(group.entity()))
+    if multiple:
+      return entities
     else:
-      entities.append(None)
+      if entities[0] is None:
+        raise datastore_errors.EntityNotFoundError()
+      return entities[0]
 
-  if multiple:
-    return entities
-  else:
-    if entities[0] is None:
-      raise datastore_errors.EntityNotFoundError()
-    return entities[0]
+  return make_call('Get', req, datastore_pb.GetResponse(), result_hook)
 
 
 def Delete(keys):
@@ -230,6 +375,10 @@ def Delete(keys):
   entities from your app. If there is an error, raises a subclass of
   datastore_errors.Error.
 
+  Outside a transaction, the keys may belong to any number of entity groups;
+  they are all deleted with a single call. Inside a transaction, they must all
+  belong to the transaction's entity group.
+
   Args:
     # the primary key(s) of the entity(ies) to delete
     keys: Key or string or list of Keys or strings
@@ -237,23 +386,43 @@ def Delete(keys):
   Raises:
     TransactionFailedError, if the Put could not be committed.
   """
-  keys, _ = NormalizeAndTypeCheckKeys(keys)
+  return _Delete(keys, _MakeSyncCall)
 
-  entity_group = keys[0]._entity_group()
-  for key in keys:
-    if key._entity_group() != entity_group:
-      raise datastore_errors.BadRequestError(
-          'All keys must be in the same entity group.')
+
+def DeleteAsync(keys):
+  """Starts deleting one or more entities from the datastore.
+
+  Like Delete(), but returns without waiting for the entities to be deleted.
+  Inside a transaction, get the result before the transaction function
+  returns.
+
+  Args:
+    keys: Key or string or list of Keys or strings
+
+  Returns:
+    Future, whose GetResult() returns None
+  """
+  return _Delete(keys, _MakeAsyncCall)
+
+
+def _Delete(keys, make_call):
+  """Implements Delete() and DeleteAsync().
+
+  Args:
+    keys: Key or string or list of Keys or strings
+    make_call: _MakeSyncCall or _MakeAsyncCall
+
+  Returns:
+    whatever make_call returns
+  """
+  keys, _ = NormalizeAndTypeCheckKeys(keys)
 
   req = datastore_pb.DeleteRequest()
-  req.key_list().extend([key._Key__reference for key in keys])
-  _MaybeSetupTransaction(req, keys[0])
+  for key in keys:
+    req.add_key().CopyFrom(key._Key__reference)
+  _MaybeSetupTransaction(req, keys)
 
-  resp = api_base_pb.VoidProto()
-  try:
-    apiproxy_stub_map.MakeSyncCall('datastore_v3', 'Delete', req, resp)
-  except apiproxy_errors.ApplicationError, err:
-    raise _ToDatastoreError(err)
+  return make_call('Delete', req, api_base_pb.VoidProto(), lambda resp: None)
 
 
 class Entity(dict):
@@ -460,14 +629,7 @@ class Entity(dict):
     Returns:
       entity_pb.Entity
     """
-
-    pb = entity_pb.EntityProto()
-    pb.mutable_key().CopyFrom(self.key()._ToPb())
-
-    group = pb.mutable_entity_group()
-    if self.__key.has_id_or_name():
-      root = pb.key().path().element(0)
-      group.add_element().CopyFrom(root)
+    pb = self._ToPbWithoutProperties()
 
     properties = self.items()
     properties.sort()
@@ -487,6 +649,23 @@ class Entity(dict):
 
     return pb
 
+  def _ToPbWithoutProperties(self):
+    """Returns a protocol buffer with this Entity's key and entity group, but
+    none of its properties. Not intended to be used by application developers.
+
+    Returns:
+      entity_pb.Entity
+    """
+    pb = entity_pb.EntityProto()
+    pb.mutable_key().CopyFrom(self.key()._ToPb())
+
+    group = pb.mutable_entity_group()
+    if self.__key.has_id_or_name():
+      root = pb.key().path().element(0)
+      group.add_element().CopyFrom(root)
+
+    return pb
+
   @staticmethod
   def _FromPb(pb):
     """Static factory method. Returns the Entity representation of the
@@ -830,7 +1009,18 @@ class Query(dict):
     """
     return self._Run()
 
-  def _Run(self, limit=None):
+  def RunAsync(self):
+    """Starts running this query.
+
+    Like Run(), but returns without waiting for the datastore to start the
+    query.
+
+    Returns:
+      Future, whose GetResult() returns what Run() returns
+    """
+    return self._Run(make_call=_MakeAsyncCall)
+
+  def _Run(self, limit=None, make_call=_MakeSyncCall):
     """Runs this query, with an optional result limit.
 
     Identical to Run, with the extra optional limit parameter. limit must be
@@ -844,12 +1034,8 @@ class Query(dict):
         "Can't query inside a transaction.")
 
     pb = self._ToPb(limit)
-    result = datastore_pb.QueryResult()
-    try:
-      apiproxy_stub_map.MakeSyncCall('datastore_v3', 'RunQuery', pb, result)
-    except apiproxy_errors.ApplicationError, err:
-      raise _ToDatastoreError(err)
-    return Iterator._FromPb(result.cursor())
+    return make_call('RunQuery', pb, datastore_pb.QueryResult(),
+                     lambda result: Iterator._FromPb(result.cursor()))
 
   def Get(self, count):
     """Fetches and returns a certain number of results from the query.
@@ -1346,37 +1532,48 @@ def RunInTransaction(function, *args, **kwargs):
     del frame
 
 
-def _MaybeSetupTransaction(request, key_or_entity):
+def IsInTransaction():
+  """Returns whether the caller is running inside RunInTransaction().
+
+  Returns:
+    bool
+  """
+  frame = _FindTransactionInStack()
+  try:
+    return frame is not None
+  finally:
+    del frame
+
+
+def _MaybeSetupTransaction(request, keys_or_entities):
   """Begins a transaction, and populates it in the request, if necessary.
 
   If we're currently inside a transaction, this records the entity group,
   creates the transaction PB, and sends the BeginTransaction. It then
   populates the transaction handle in the request.
 
-  Raises BadRequestError if the entity has a different entity group than the
-  current transaction.
+  Raises BadRequestError if any of the entities has a different entity group
+  than the current transaction.
 
   Args:
     request: GetRequest, PutRequest, or DeleteRequest
-    key_or_entity: Key or Entity
+    keys_or_entities: list of Keys or Entities
   """
   assert isinstance(request, (datastore_pb.GetRequest, datastore_pb.PutRequest,
                               datastore_pb.DeleteRequest))
-  assert isinstance(key_or_entity, (Key, Entity))
   frame = None
 
   try:
     frame = _FindTransactionInStack()
     if frame:
-      this_group = key_or_entity._entity_group()
-      if frame not in _txes:
-        _txes[frame] = datastore_pb.Transaction()
-        _tx_entity_groups[frame] = this_group
-        req = api_base_pb.VoidProto()
-        apiproxy_stub_map.MakeSyncCall('datastore_v3', 'BeginTransaction', req,
-                                       _txes[frame])
-      else:
+      if frame in _tx_entity_groups:
         orig_group = _tx_entity_groups[frame]
+      else:
+        orig_group = keys_or_entities[0]._entity_group()
+
+      for key_or_entity in keys_or_entities:
+        assert isinstance(key_or_entity, (Key, Entity))
+        this_group = key_or_entity._entity_group()
         if orig_group != this_group:
           def id_or_name(key):
             if (key.name()):
@@ -1389,6 +1586,13 @@ def _MaybeSetupTransaction(request, key_or_entity):
             (orig_group.kind(), id_or_name(orig_group),
              this_group.kind(), id_or_name(this_group)))
 
+      if frame not in _txes:
+        _txes[frame] = datastore_pb.Transaction()
+        _tx_entity_groups[frame] = orig_group
+        req = api_base_pb.VoidProto()
+        apiproxy_stub_map.MakeSyncCall('datastore_v3', 'BeginTransaction', req,
+                                       _txes[frame])
+
       request.mutable_transaction().CopyFrom(_txes[frame])
 
   finally:
@@ -16,18 +16,55 @@
 #
 
 """
-In-memory persistent stub for the Python datastore API. Gets, queries,
-and searches are implemented as in-memory scans over all entities.
+In-memory persistent stub for the Python datastore API. Gets are dict
+lookups. Query filters and sort orders are compiled by datastore_stub_util
+into predicates that run directly over the stored entity protocol buffers.
+
+Queries with filters are served from sorted single-property indexes. An index
+is built the first time a query filters on its property, and from then on
+Put() and Delete() keep it up to date. The planner picks the filter whose
+index range is smallest, then applies the remaining filters to that range.
+
+Composite indexes in the READ_WRITE state, e.g. those created from index.yaml
+by the dev_appserver, are materialized the same way the first time a query
+needs them. Queries that need a composite index are served straight from its
+rows, which are already in the query's sort order.
 
 Stores entities across sessions as pickled proto bufs in a single file. On
-startup, all entities are read from the file and loaded into memory. On
-every Put(), the file is wiped and all entities are written from scratch.
-Clients can also manually Read() and Write() the file themselves.
-
-Transactions are serialized through __tx_lock. Each transaction acquires it
-when it begins and releases it when it commits or rolls back. This is
-important, since there are other member variables like __tx_snapshot that are
-per-transaction, so they should only be used by one tx at a time.
+startup, all entities are read from the file and loaded into memory. Their
+properties are left encoded until a query or Get() needs them. On every Put(),
+the file is wiped and all entities are written from scratch. Clients can also
+manually Read() and Write() the file themselves.
+
+With use_write_log, Put() and Delete() instead append one checksummed record
+per entity or deleted key to a write log next to the datastore file. Once the
+log grows past LOG_COMPACTION_THRESHOLD bytes, a background thread compacts
+it: the current log is set aside, a fresh one is started, and the full
+datastore file is rewritten from memory. On startup the datastore file is
+read first, then any set-aside log, then the current log. Whenever the
+datastore file is rewritten, with or without use_write_log, the logs it
+supersedes are removed, so they are never replayed on top of newer data.
+
+With compact_storage, entities are kept in memory as their encoded strings,
+which take a fraction of the memory of decoded EntityProtos. Only their keys
+are decoded on startup. Get(), queries and the index tables decode entities as
+they need them, and drop them again afterwards; the index tables hold the
+encoded strings too.
+
+Query results are produced lazily. RunQuery() only sets up an iterator over
+the matching entities, and each Next() pulls one batch from it. Queries with
+sort orders that aren't served by a composite index still have to look at all
+of their results up front; if they have a limit, only the first limit results
+are kept, using a heap. Cursors that are never drained are discarded after
+CURSOR_TTL seconds of disuse, or when there are more than MAX_CURSORS.
+
+Transactions are optimistic. Each transaction buffers its writes, and records
+the version of each entity group it reads or writes the first time it uses
+it. Every write that is applied bumps the versions of the entity groups it
+touches. Commit() checks that none of the transaction's entity groups have
+changed since, then applies its writes; otherwise it fails with
+CONCURRENT_TRANSACTION, and datastore.RunInTransaction() retries. Versions are
+only tracked while there are transactions in progress.
 """
 
 
@@ -36,6 +73,7 @@ per-transaction, so they should only be used by one tx at a time.
 
 
 import datetime
+import itertools
 import logging
 import os
 import pickle
@@ -43,8 +81,10 @@ import struct
 import sys
 import tempfile
 import threading
+import time
 import types
 import warnings
+import zlib
 
 from google.appengine.api import api_base_pb
 from google.appengine.api import datastore
@@ -54,6 +94,7 @@ from google.appengine.api import datastore_types
 from google.appengine.api import users
 from google.appengine.datastore import datastore_pb
 from google.appengine.datastore import datastore_index
+from google.appengine.datastore import datastore_stub_util
 from google.appengine.runtime import apiproxy_errors
 from google.net.proto import ProtocolBuffer
 from google.appengine.datastore import entity_pb
@@ -64,6 +105,26 @@ warnings.filterwarnings('ignore', 'tempnam is a potential security risk')
 entity_pb.Reference.__hash__ = lambda self: hash(self.Encode())
 datastore_pb.Query.__hash__ = lambda self: hash(self.Encode())
 
+_LOG_RECORD_HEADER = '>BII'
+_LOG_RECORD_HEADER_SIZE = struct.calcsize(_LOG_RECORD_HEADER)
+_LOG_PUT = 1
+_LOG_DELETE = 2
+
+
+class _Transaction(object):
+  """The state of a transaction in progress.
+
+  Attributes:
+    versions: dict mapping the encoded root entity key of each entity group
+        the transaction has used to the group's version when it was first used
+    writes: dict mapping encoded keys to the entity_pb.EntityProto put there,
+        or to None if the entity was deleted
+  """
+
+  def __init__(self):
+    self.versions = {}
+    self.writes = {}
+
 
 class DatastoreFileStub(object):
   """ Persistent stub for the Python datastore API.
@@ -71,10 +132,21 @@ class DatastoreFileStub(object):
   Stores all entities in memory, and persists them to a file as pickled
   protocol buffers. A DatastoreFileStub instance handles a single app's data
   and is backed by files on disk.
+
+  In memory, the entities of each app and kind are kept in a dict keyed by
+  their encoded keys, so looking one up hashes and compares strings rather
+  than Reference protocol buffers.
   """
 
+  LOG_COMPACTION_THRESHOLD = 16 * 1024 * 1024
+
+  CURSOR_TTL = 10 * 60
+
+  MAX_CURSORS = 1000
+
   def __init__(self, app_id, datastore_file, history_file,
-               require_indexes=False):
+               require_indexes=False, use_write_log=False,
+               compact_storage=False):
     """Constructor.
 
     Initializes and loads the datastore from the backing files, if they exist.
@@ -87,21 +159,36 @@ class DatastoreFileStub(object):
           datastore_file.
       require_indexes: bool, default False.  If True, composite indexes must
           exist in index.yaml for queries that need them.
+      use_write_log: bool, default False.  If True, writes are appended to a
+          log instead of rewriting datastore_file every time.
+      compact_storage: bool, default False.  If True, entities are kept in
+          memory encoded, and decoded whenever they are used.
     """
 
     assert isinstance(app_id, types.StringTypes) and app_id != ''
     self.__app_id = app_id
     self.__datastore_file = datastore_file
     self.__history_file = history_file
+    self.__compact_storage = compact_storage
+
+    self.__use_write_log = use_write_log
+    self.__log_file = None
+    self.__log_size = 0
+    self.__compacting = False
+    self.__compaction_lock = threading.Lock()
 
     self.__entities = {}
 
-    self.__tx_snapshot = {}
+    self.__property_indexes = {}
+
+    self.__composite_tables = {}
 
     self.__queries = {}
 
     self.__transactions = {}
 
+    self.__entity_group_versions = {}
+
     self.__indexes = {}
     self.__require_indexes = require_indexes
 
@@ -115,7 +202,6 @@ class DatastoreFileStub(object):
     self.__cursor_lock = threading.Lock()
     self.__tx_handle_lock = threading.Lock()
     self.__index_id_lock = threading.Lock()
-    self.__tx_lock = threading.Lock()
     self.__entities_lock = threading.Lock()
     self.__file_lock = threading.Lock()
     self.__indexes_lock = threading.Lock()
@@ -126,8 +212,11 @@ class DatastoreFileStub(object):
     """ Clears the datastore by deleting all currently stored entities and
     queries. """
     self.__entities = {}
+    self.__property_indexes = {}
+    self.__composite_tables = {}
     self.__queries = {}
     self.__transactions = {}
+    self.__entity_group_versions = {}
     self.__query_history = {}
 
   def Read(self):
@@ -150,20 +239,30 @@ class DatastoreFileStub(object):
                  'Try running with the --clear_datastore flag.\n%r')
 
     if self.__datastore_file and self.__datastore_file != '/dev/null':
+      self.__property_indexes = {}
+      self.__composite_tables = {}
       for encoded_entity in self.__ReadPickled(self.__datastore_file):
         try:
-          entity = entity_pb.EntityProto(encoded_entity)
+          self.__LoadEntity(encoded_entity)
         except pb_exceptions, e:
           raise datastore_errors.InternalError(error_msg %
                                                (self.__datastore_file, e))
 
-        last_path = entity.key().path().element_list()[-1]
-        app_kind = (entity.key().app(), last_path.type())
-        kind_dict = self.__entities.setdefault(app_kind, {})
-        kind_dict[entity.key()] = entity
-
-        if last_path.has_id() and last_path.id() >= self.__next_id:
-          self.__next_id = last_path.id() + 1
+      log_filenames = self.LogFilenames(self.__datastore_file)
+      for filename in reversed(log_filenames):
+        for record_type, payload in self.__ReadLog(filename):
+          try:
+            if record_type == _LOG_PUT:
+              self.__LoadEntity(payload)
+            else:
+              key = entity_pb.Reference(payload)
+              kind = key.path().element_list()[-1].type()
+              kind_dict = self.__entities.get((key.app(), kind), {})
+              kind_dict.pop(key.Encode(), None)
+              if not kind_dict:
+                self.__entities.pop((key.app(), kind), None)
+          except pb_exceptions, e:
+            raise datastore_errors.InternalError(error_msg % (filename, e))
 
       self.__query_history = {}
       for encoded_query, count in self.__ReadPickled(self.__history_file):
@@ -178,13 +277,230 @@ class DatastoreFileStub(object):
         else:
           self.__query_history[query_pb] = count
 
+  def __LoadEntity(self, encoded_entity):
+    """Adds an entity read from disk to the in-memory datastore.
+
+    Also bumps __next_id past the entity's id, if it has one.
+
+    Args:
+      encoded_entity: string, an encoded entity_pb.EntityProto
+    """
+    if self.__compact_storage:
+      key = datastore_stub_util.DecodeEntityKey(encoded_entity)
+      stored = encoded_entity
+    else:
+      stored = datastore_stub_util.LazyEntityProto(encoded_entity)
+      key = stored.key()
+
+    last_path = key.path().element_list()[-1]
+    app_kind = (key.app(), last_path.type())
+    kind_dict = self.__entities.setdefault(app_kind, {})
+    kind_dict[key.Encode()] = stored
+
+    if last_path.has_id() and last_path.id() >= self.__next_id:
+      self.__next_id = last_path.id() + 1
+
   def Write(self):
     """ Writes out the datastore and history files. Be careful! If the files
     already exist, this method overwrites them!
     """
-    self.__WriteDatastore()
+    if self.__use_write_log:
+      self.Compact()
+    else:
+      self.__WriteDatastore()
     self.__WriteHistory()
 
+  @staticmethod
+  def LogFilenames(datastore_file):
+    """Returns the names of the write log files for a datastore file.
+
+    Args:
+      datastore_file: string
+
+    Returns:
+      list of strings: the current log, then the log set aside by an
+      unfinished compaction
+    """
+    log_file = datastore_file + '.log'
+    return [log_file, log_file + '.compacting']
+
+  def Compact(self):
+    """Rewrites the datastore file from memory and discards the write log.
+
+    Writes that happen while the datastore file is being written go to a new
+    log, so they are kept.
+    """
+    if not self.__datastore_file or self.__datastore_file == '/dev/null':
+      return
+
+    log_file, compacting_file = self.LogFilenames(self.__datastore_file)
+
+    self.__compaction_lock.acquire()
+    try:
+      self.__entities_lock.acquire()
+      try:
+        entities = []
+        for kind_dict in self.__entities.values():
+          entities.extend(kind_dict.values())
+
+        self.__file_lock.acquire()
+        try:
+          if self.__log_file:
+            self.__log_file.close()
+            self.__log_file = None
+          self.__log_size = 0
+
+          if os.path.exists(log_file):
+            if os.path.exists(compacting_file):
+              self.__AppendFile(log_file, compacting_file)
+              os.remove(log_file)
+            else:
+              os.rename(log_file, compacting_file)
+        finally:
+          self.__file_lock.release()
+      finally:
+        self.__entities_lock.release()
+
+      self.__WriteSnapshot(map(self.__Encode, entities), [compacting_file])
+    finally:
+      self.__compacting = False
+      self.__compaction_lock.release()
+
+  def __AppendFile(self, source, dest):
+    """Appends the contents of one file to another.
+    """
+    input = open(source, 'rb')
+    try:
+      output = open(dest, 'ab')
+      try:
+        data = input.read(65536)
+        while data:
+          output.write(data)
+          data = input.read(65536)
+      finally:
+        output.close()
+    finally:
+      input.close()
+
+  def __Persist(self, entities=(), keys=()):
+    """Makes a write durable.
+
+    Without the write log, rewrites the datastore file. With the write log,
+    appends records for the written entities and deleted keys to the log.
+
+    Must be called with __entities_lock held, so that log records are written
+    in the same order as the changes they record.
+
+    Args:
+      entities: list of entity_pb.EntityProto that were put
+      keys: list of entity_pb.Reference that were deleted
+    """
+    if not self.__use_write_log:
+      self.__WriteDatastore()
+      return
+
+    self.__AppendLog([(_LOG_PUT, entity.Encode()) for entity in entities] +
+                     [(_LOG_DELETE, key.Encode()) for key in keys])
+
+  def __AppendLog(self, records):
+    """Appends records to the write log, and starts a compaction in the
+    background if the log has grown too big.
+
+    Each record is a header, holding the record type, the payload length and
+    the payload's CRC-32, followed by the payload.
+
+    Args:
+      records: list of (record type, payload string) tuples
+    """
+    if (not records or not self.__datastore_file or
+        self.__datastore_file == '/dev/null'):
+      return
+
+    self.__file_lock.acquire()
+    try:
+      if not self.__log_file:
+        log_file = self.LogFilenames(self.__datastore_file)[0]
+        self.__log_file = open(log_file, 'ab')
+        self.__log_file.seek(0, 2)
+        self.__log_size = self.__log_file.tell()
+
+      for record_type, payload in records:
+        header = struct.pack(_LOG_RECORD_HEADER, record_type, len(payload),
+                             zlib.crc32(payload) & 0xffffffff)
+        self.__log_file.write(header)
+        self.__log_file.write(payload)
+        self.__log_size += len(header) + len(payload)
+      self.__log_file.flush()
+
+      start_compaction = (self.__log_size > self.LOG_COMPACTION_THRESHOLD and
+                          not self.__compacting)
+      if start_compaction:
+        self.__compacting = True
+    finally:
+      self.__file_lock.release()
+
+    if start_compaction:
+      thread = threading.Thread(target=self.Compact)
+      thread.setDaemon(True)
+      thread.start()
+
+  def __ReadLog(self, filename):
+    """Reads the records in a write log.
+
+    Stops at the first truncated or corrupt record, since that is where a
+    crash interrupted the last write.
+
+    Args:
+      filename: string
+
+    Returns:
+      list of (record type, payload string) tuples
+    """
+    if not os.path.isfile(filename):
+      return []
+
+    self.__file_lock.acquire()
+    try:
+      input = open(filename, 'rb')
+      try:
+        data = input.read()
+      finally:
+        input.close()
+    finally:
+      self.__file_lock.release()
+
+    records = []
+    offset = 0
+    while offset < len(data):
+      header = data[offset:offset + _LOG_RECORD_HEADER_SIZE]
+      if len(header) < _LOG_RECORD_HEADER_SIZE:
+        break
+      record_type, length, checksum = struct.unpack(_LOG_RECORD_HEADER,
+                                                    header)
+      payload = data[offset + _LOG_RECORD_HEADER_SIZE:
+                     offset + _LOG_RECORD_HEADER_SIZE + length]
+      if (record_type not in (_LOG_PUT, _LOG_DELETE) or
+          len(payload) < length or
+          zlib.crc32(payload) & 0xffffffff != checksum):
+        break
+      offset += _LOG_RECORD_HEADER_SIZE + length
+      records.append((record_type, payload))
+
+    if offset < len(data):
+      logging.warning('Discarding truncated or corrupt record at offset %d '
+                      'of %s', offset, filename)
+      self.__file_lock.acquire()
+      try:
+        output = open(filename, 'r+b')
+        try:
+          output.truncate(offset)
+        finally:
+          output.close()
+      finally:
+        self.__file_lock.release()
+
+    return records
+
   def __WriteDatastore(self):
     """ Writes out the datastore file. Be careful! If the file already exist,
     this method overwrites it!
@@ -192,11 +508,34 @@ class DatastoreFileStub(object):
     if self.__datastore_file and self.__datastore_file != '/dev/null':
       encoded = []
       for kind_dict in self.__entities.values():
-        for entity in kind_dict.values():
-          encoded.append(entity.Encode())
+        encoded.extend(map(self.__Encode, kind_dict.values()))
 
+      self.__WriteSnapshot(encoded, self.LogFilenames(self.__datastore_file))
+
+  def __WriteSnapshot(self, encoded, log_filenames):
+    """Replaces the datastore file with the given entities, and removes the
+    write logs whose records they already include.
+
+    The logs are removed as soon as the new datastore file is in place, so
+    that they are never replayed on top of it by a later Read().
+
+    Args:
+      encoded: list of encoded entity_pb.EntityProto strings
+      log_filenames: list of strings, the write logs to remove
+    """
+    if encoded:
       self.__WritePickled(encoded, self.__datastore_file)
 
+    self.__file_lock.acquire()
+    try:
+      if not encoded and os.path.exists(self.__datastore_file):
+        os.remove(self.__datastore_file)
+      for filename in log_filenames:
+        if os.path.exists(filename):
+          os.remove(filename)
+    finally:
+      self.__file_lock.release()
+
   def __WriteHistory(self):
     """ Writes out the history file. Be careful! If the file already exist,
     this method overwrites it!
@@ -310,230 +649,425 @@ class DatastoreFileStub(object):
         assert (clone.has_entity_group() and
                 clone.entity_group().element_size() > 0)
 
-    self.__entities_lock.acquire()
-
-    try:
-      for clone in clones:
-        last_path = clone.key().path().element_list()[-1]
-        kind_dict = self.__entities.setdefault((app, last_path.type()), {})
-        kind_dict[clone.key()] = clone
-    finally:
-      self.__entities_lock.release()
-
-    if not put_request.has_transaction():
-      self.__WriteDatastore()
+    if put_request.has_transaction():
+      tx = self.__GetTransaction(put_request.transaction())
+      self.__entities_lock.acquire()
+      try:
+        for clone in clones:
+          self.__UseEntityGroup(tx, clone.key())
+          tx.writes[clone.key().Encode()] = clone
+      finally:
+        self.__entities_lock.release()
+    else:
+      self.__entities_lock.acquire()
+      try:
+        self.__ApplyWrites(clones, [])
+      finally:
+        self.__entities_lock.release()
 
     put_response.key_list().extend([c.key() for c in clones])
 
 
   def _Dynamic_Get(self, get_request, get_response):
     for key in get_request.key_list():
-        app = self.ResolveAppId(key.app())
-        key.set_app(app)
-        last_path = key.path().element_list()[-1]
+      key.set_app(self.ResolveAppId(key.app()))
+
+    tx = None
+    if get_request.has_transaction():
+      tx = self.__GetTransaction(get_request.transaction())
+      self.__entities_lock.acquire()
+      try:
+        for key in get_request.key_list():
+          self.__UseEntityGroup(tx, key)
+      finally:
+        self.__entities_lock.release()
 
-        group = get_response.add_entity()
+    for key in get_request.key_list():
+      last_path = key.path().element_list()[-1]
+
+      encoded = key.Encode()
+      group = get_response.add_entity()
+      if tx and encoded in tx.writes:
+        entity = tx.writes[encoded]
+      else:
         try:
-          entity = self.__entities[app, last_path.type()][key]
+          entity = self.__entities[key.app(), last_path.type()][encoded]
         except KeyError:
           entity = None
 
-        if entity:
-          group.mutable_entity().CopyFrom(entity)
+      if isinstance(entity, str):
+        group.mutable_entity().MergeFromString(entity)
+      elif entity:
+        group.mutable_entity().CopyFrom(entity)
 
 
   def _Dynamic_Delete(self, delete_request, delete_response):
-    self.__entities_lock.acquire()
-    try:
-      for key in delete_request.key_list():
-        try:
-          app = self.ResolveAppId(key.app())
-          key.set_app(app)
-          kind = key.path().element_list()[-1].type()
-          del self.__entities[app, kind][key]
-          if not self.__entities[app, kind]:
-            del self.__entities[app, kind]
-        except KeyError:
-          pass
+    for key in delete_request.key_list():
+      key.set_app(self.ResolveAppId(key.app()))
 
-        if not delete_request.has_transaction():
-          self.__WriteDatastore()
-    finally:
-      self.__entities_lock.release()
+    if delete_request.has_transaction():
+      tx = self.__GetTransaction(delete_request.transaction())
+      self.__entities_lock.acquire()
+      try:
+        for key in delete_request.key_list():
+          self.__UseEntityGroup(tx, key)
+          tx.writes[key.Encode()] = None
+      finally:
+        self.__entities_lock.release()
+    else:
+      self.__entities_lock.acquire()
+      try:
+        self.__ApplyWrites([], delete_request.key_list())
+      finally:
+        self.__entities_lock.release()
 
+  def __ApplyWrites(self, entities, keys):
+    """Stores and deletes entities, updates the index tables, bumps the
+    versions of the entity groups involved, and persists the changes.
 
-  def _Dynamic_RunQuery(self, query, query_result):
-    if not self.__tx_lock.acquire(False):
-      raise apiproxy_errors.ApplicationError(
-        datastore_pb.Error.BAD_REQUEST, "Can't query inside a transaction.")
-    else:
-      self.__tx_lock.release()
+    Must be called with __entities_lock held.
+
+    Args:
+      entities: list of entity_pb.EntityProto to store
+      keys: list of entity_pb.Reference to delete
+    """
+    for entity in entities:
+      key = entity.key()
+      app_kind = (key.app(), key.path().element_list()[-1].type())
+      encoded = key.Encode()
+      if self.__compact_storage:
+        stored = entity.Encode()
+      else:
+        stored = entity
+      kind_dict = self.__entities.setdefault(app_kind, {})
+      old_entity = kind_dict.get(encoded)
+      kind_dict[encoded] = stored
+
+      for table in self.__IndexTables(app_kind):
+        if old_entity:
+          table.Remove(old_entity)
+        table.Add(stored)
+      self.__BumpEntityGroupVersion(key)
+
+    for key in keys:
+      app_kind = (key.app(), key.path().element_list()[-1].type())
+      self.__BumpEntityGroupVersion(key)
+      encoded = key.Encode()
+      kind_dict = self.__entities.get(app_kind)
+      if kind_dict is None or encoded not in kind_dict:
+        continue
+
+      entity = kind_dict.pop(encoded)
+      for table in self.__IndexTables(app_kind):
+        table.Remove(entity)
+      if not kind_dict:
+        del self.__entities[app_kind]
+        self.__property_indexes.pop(app_kind, None)
+        self.__composite_tables.pop(app_kind, None)
+
+    self.__Persist(entities, keys)
+
+  def __EntityGroup(self, key):
+    """Returns the encoded key of the root entity of a key's entity group.
+
+    Args:
+      key: entity_pb.Reference
+
+    Returns:
+      string
+    """
+    root = entity_pb.Reference()
+    root.set_app(key.app())
+    root.mutable_path().add_element().CopyFrom(key.path().element(0))
+    return root.Encode()
+
+  def __UseEntityGroup(self, tx, key):
+    """Records the version of a key's entity group in a transaction, unless
+    the transaction has already used the group.
+
+    Must be called with __entities_lock held.
+
+    Args:
+      tx: _Transaction
+      key: entity_pb.Reference
+    """
+    group = self.__EntityGroup(key)
+    if group not in tx.versions:
+      tx.versions[group] = self.__entity_group_versions.get(group, 0)
+
+  def __BumpEntityGroupVersion(self, key):
+    """Bumps the version of a key's entity group, if there are transactions
+    in progress that might be using it.
 
+    Must be called with __entities_lock held.
+
+    Args:
+      key: entity_pb.Reference
+    """
+    if self.__transactions:
+      group = self.__EntityGroup(key)
+      self.__entity_group_versions[group] = (
+          self.__entity_group_versions.get(group, 0) + 1)
+
+
+  def _Dynamic_RunQuery(self, query, query_result):
     app = self.ResolveAppId(query.app())
 
-    if self.__require_indexes:
+    composite_index = None
+    if self.__require_indexes or self.__indexes.get(app):
       required_index = datastore_index.CompositeIndexForQuery(query)
       if required_index is not None:
-        kind, ancestor, props, num_eq_filters = required_index
-        required_key = kind, ancestor, props
-        indexes = self.__indexes.get(app)
-        if not indexes:
-          raise apiproxy_errors.ApplicationError(
-              datastore_pb.Error.BAD_REQUEST,
-              "This query requires a composite index, but none are defined. "
-              "You must create an index.yaml file in your application root.")
-        eq_filters_set = set(props[:num_eq_filters])
-        remaining_filters = props[num_eq_filters:]
-        for index in indexes:
-          definition = datastore_admin.ProtoToIndexDefinition(index)
-          index_key = datastore_index.IndexToKey(definition)
-          if required_key == index_key:
-            break
-          if num_eq_filters > 1 and (kind, ancestor) == index_key[:2]:
-            this_props = index_key[2]
-            this_eq_filters_set = set(this_props[:num_eq_filters])
-            this_remaining_filters = this_props[num_eq_filters:]
-            if (eq_filters_set == this_eq_filters_set and
-                remaining_filters == this_remaining_filters):
-              break
-        else:
-          raise apiproxy_errors.ApplicationError(
-              datastore_pb.Error.BAD_REQUEST,
-              "This query requires a composite index that is not defined. "
-              "You must update the index.yaml file in your application root.")
+        composite_index = self.__FindCompositeIndex(app, required_index)
+        if self.__require_indexes and composite_index is None:
+          if not self.__indexes.get(app):
+            raise apiproxy_errors.ApplicationError(
+                datastore_pb.Error.BAD_REQUEST,
+                "This query requires a composite index, but none are defined. "
+                "You must create an index.yaml file in your application root.")
+          else:
+            raise apiproxy_errors.ApplicationError(
+                datastore_pb.Error.BAD_REQUEST,
+                "This query requires a composite index that is not defined. "
+                "You must update the index.yaml file in your application root.")
+
+    query.set_app(app)
+    predicates = datastore_stub_util.CompileQuery(query)
+
+    results = None
+    if (composite_index is not None and
+        composite_index.state() == entity_pb.CompositeIndex.READ_WRITE):
+      results = self.__CompositeIndexScan(app, query, composite_index)
+
+    limit = None
+    if query.has_limit():
+      limit = query.limit()
+
+    if results is not None:
+      results = datastore_stub_util.FilterEntities(results, predicates)
+      if self.__HasDescendingOrder(query):
+        results = datastore_stub_util.SortEntities(results,
+                                                   query.order_list(), limit)
+      elif limit is not None:
+        results = itertools.islice(results, limit)
+    else:
+      results = self.__IndexScan(app, query)
+      results = datastore_stub_util.FilterEntities(results, predicates)
+      results = datastore_stub_util.SortEntities(results, query.order_list(),
+                                                 limit)
 
-    try:
-      query.set_app(app)
-      results = self.__entities[app, query.kind()].values()
-      results = [datastore.Entity._FromPb(pb) for pb in results]
-    except KeyError:
-      results = []
+    clone = datastore_pb.Query()
+    clone.CopyFrom(query)
+    clone.clear_hint()
+    if clone in self.__query_history:
+      self.__query_history[clone] += 1
+    else:
+      self.__query_history[clone] = 1
+    self.__WriteHistory()
 
-    if query.has_ancestor():
-      ancestor_path = query.ancestor().path().element_list()
-      def is_descendant(entity):
-        path = entity.key()._Key__reference.path().element_list()
-        return path[:len(ancestor_path)] == ancestor_path
-      results = filter(is_descendant, results)
+    query_cursor = datastore_stub_util.QueryCursor(results)
 
-    operators = {datastore_pb.Query_Filter.LESS_THAN:             '<',
-                 datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL:    '<=',
-                 datastore_pb.Query_Filter.GREATER_THAN:          '>',
-                 datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL: '>=',
-                 datastore_pb.Query_Filter.EQUAL:                 '==',
-                 }
+    self.__cursor_lock.acquire()
+    try:
+      cursor = self.__next_cursor
+      self.__next_cursor += 1
+      self.__EvictCursors()
+      self.__queries[cursor] = query_cursor
+    finally:
+      self.__cursor_lock.release()
 
-    for filt in query.filter_list():
-      assert filt.op() != datastore_pb.Query_Filter.IN
+    query_result.mutable_cursor().set_cursor(cursor)
+    query_result.set_more_results(query_cursor.HasMore())
 
-      prop = filt.property(0).name().decode('utf-8')
-      op = operators[filt.op()]
+  def __EvictCursors(self):
+    """Discards cursors that haven't been used for CURSOR_TTL seconds, then,
+    if there are still MAX_CURSORS or more, the least recently used ones.
 
-      def passes(entity):
-        """ Returns True if the entity passes the filter, False otherwise. """
-        entity_vals = entity.get(prop, [])
-        if type(entity_vals) is not types.ListType:
-          entity_vals = [entity_vals]
+    Must be called with __cursor_lock held.
+    """
+    expired = time.time() - self.CURSOR_TTL
+    for cursor, query_cursor in self.__queries.items():
+      if query_cursor.last_access < expired:
+        del self.__queries[cursor]
 
-        entity_property_list = [datastore_types.ToPropertyPb(prop, value)
-                                for value in entity_vals]
+    excess = len(self.__queries) - self.MAX_CURSORS + 1
+    if excess > 0:
+      by_access = sorted([(query_cursor.last_access, cursor)
+                          for cursor, query_cursor in self.__queries.items()])
+      for last_access, cursor in by_access[:excess]:
+        del self.__queries[cursor]
 
-        for entity_prop in entity_property_list:
-          fixed_entity_val = datastore_types.FromPropertyPb(entity_prop)
 
-          for filter_prop in filt.property_list():
-            filter_val = datastore_types.FromPropertyPb(filter_prop)
+  def __Encode(self, stored):
+    """Returns a stored entity, encoded.
 
-            comp = u'%r %s %r' % (fixed_entity_val, op, filter_val)
+    Args:
+      stored: entity_pb.EntityProto, or string with compact_storage
 
-            logging.log(logging.DEBUG - 1,
-                        'Evaling filter expression "%s"', comp)
+    Returns:
+      string
+    """
+    if self.__compact_storage:
+      return stored
+    return stored.Encode()
 
-            if eval(comp):
-              return True
+  def __Decoded(self, stored_entities):
+    """Returns stored entities as entity_pb.EntityProto.
 
-        return False
+    With compact_storage, each entity is decoded as the returned iterator
+    reaches it, so only the entities a caller is still holding on to stay
+    decoded.
 
-      results = filter(passes, results)
+    Args:
+      stored_entities: iterable of stored entities
 
-    for order in query.order_list():
-      prop = order.property().decode('utf-8')
-      results = [entity for entity in results if prop in entity]
+    Returns:
+      iterable of entity_pb.EntityProto
+    """
+    if self.__compact_storage:
+      return itertools.imap(datastore_stub_util.LazyEntityProto,
+                            stored_entities)
+    return stored_entities
 
-    def order_compare(a, b):
-      """ Return a negative, zero or positive number depending on whether
-      entity a is considered smaller than, equal to, or larger than b,
-      according to the query's orderings. """
-      for o in query.order_list():
-        prop = o.property().decode('utf-8')
+  def __TableLoader(self):
+    """Returns the load function for index tables over stored entities.
+    """
+    if self.__compact_storage:
+      return datastore_stub_util.LazyEntityProto
+    return None
 
-        a_values = a[prop]
-        if not isinstance(a_values, types.ListType):
-          a_values = [a_values]
+  def __IndexTables(self, app_kind):
+    """Returns all of the materialized index tables for a kind.
 
-        b_values = b[prop]
-        if not isinstance(b_values, types.ListType):
-          b_values = [b_values]
+    Args:
+      app_kind: (app, kind) tuple
 
-        cmped = cmp(min(a_values), min(b_values))
+    Returns:
+      list of datastore_stub_util.PropertyIndex and CompositeIndexTable
+    """
+    return (self.__property_indexes.get(app_kind, {}).values() +
+            self.__composite_tables.get(app_kind, {}).values())
 
-        if o.direction() is datastore_pb.Query_Order.DESCENDING:
-          cmped = -cmped
+  def __CompositeIndexScan(self, app, query, index):
+    """Returns the entities that may match a query, in query order, from the
+    rows of a composite index.
 
-        if cmped != 0:
-          return cmped
+    The index is materialized first if necessary. The caller must still apply
+    the query's filters to the returned entities, but not its sort orders.
 
-      return 0
+    Args:
+      app: string, the resolved app id
+      query: datastore_pb.Query
+      index: entity_pb.CompositeIndex, in the READ_WRITE state
 
-    results.sort(order_compare)
+    Returns:
+      list of entity_pb.EntityProto, or None if the index can't serve the
+      query.
+    """
+    app_kind = (app, query.kind())
+    self.__entities_lock.acquire()
+    try:
+      kind_dict = self.__entities.get(app_kind)
+      if not kind_dict:
+        return []
+
+      kind_tables = self.__composite_tables.setdefault(app_kind, {})
+      table = kind_tables.get(index.id())
+      if table is None:
+        table = datastore_stub_util.CompositeIndexTable(index.definition(),
+                                                        kind_dict.values(),
+                                                        self.__TableLoader())
+        kind_tables[index.id()] = table
+
+      bounds = table.Bounds(query)
+      if bounds is None:
+        return None
+      start, end = bounds
+      return self.__Decoded(table.Entities(start, end))
+    finally:
+      self.__entities_lock.release()
 
-    if query.has_limit():
-      results = results[:query.limit()]
+  def __HasDescendingOrder(self, query):
+    """Returns True if any of a query's sort orders is descending.
 
-    clone = datastore_pb.Query()
-    clone.CopyFrom(query)
-    clone.clear_hint()
-    if clone in self.__query_history:
-      self.__query_history[clone] += 1
-    else:
-      self.__query_history[clone] = 1
-    self.__WriteHistory()
+    Composite index rows put an entity with several values for a descending
+    property at its highest value, but entities are sorted by
+    datastore_stub_util.SortValueKey() in both directions, so the results of
+    such a query are sorted again after the index scan.
+    """
+    for order in query.order_list():
+      if order.direction() == datastore_pb.Query_Order.DESCENDING:
+        return True
+    return False
 
-    results = [e._ToPb() for e in results]
-    self.__cursor_lock.acquire()
-    cursor = self.__next_cursor
-    self.__next_cursor += 1
-    self.__cursor_lock.release()
-    self.__queries[cursor] = (results, len(results))
+  def __IndexScan(self, app, query):
+    """Returns the entities that may match a query.
 
-    query_result.mutable_cursor().set_cursor(cursor)
-    query_result.set_more_results(len(results) > 0)
+    Looks up each of the query's filters in the corresponding property index,
+    building the index first if necessary, and returns the entities in the
+    smallest matching range. The caller must still apply all of the query's
+    filters to the returned entities. If the query has no filters, returns all
+    entities of the query's kind.
 
+    Args:
+      app: string, the resolved app id
+      query: datastore_pb.Query
+
+    Returns:
+      list of entity_pb.EntityProto
+    """
+    app_kind = (app, query.kind())
+    self.__entities_lock.acquire()
+    try:
+      kind_dict = self.__entities.get(app_kind)
+      if not kind_dict:
+        return []
+      elif not query.filter_size():
+        return self.__Decoded(kind_dict.values())
+
+      kind_indexes = self.__property_indexes.setdefault(app_kind, {})
+      best = None
+      for filt in query.filter_list():
+        name = filt.property(0).name()
+        index = kind_indexes.get(name)
+        if index is None:
+          index = datastore_stub_util.PropertyIndex(name, kind_dict.values(),
+                                                    self.__TableLoader())
+          kind_indexes[name] = index
+
+        start, end = index.Bounds(filt)
+        if best is None or end - start < best[2] - best[1]:
+          best = (index, start, end)
+
+      index, start, end = best
+      return self.__Decoded(index.Entities(start, end))
+    finally:
+      self.__entities_lock.release()
 
   def _Dynamic_Next(self, next_request, query_result):
     cursor = next_request.cursor().cursor()
 
     try:
-      results, orig_count = self.__queries[cursor]
+      query_cursor = self.__queries[cursor]
     except KeyError:
       raise apiproxy_errors.ApplicationError(datastore_pb.Error.BAD_REQUEST,
                                              'Cursor %d not found' % cursor)
 
-    count = next_request.count()
-    for r in results[:count]:
+    for r in query_cursor.Next(next_request.count()):
       query_result.add_result().CopyFrom(r)
-    del results[:count]
 
-    query_result.set_more_results(len(results) > 0)
+    query_result.set_more_results(query_cursor.HasMore())
 
 
   def _Dynamic_Count(self, query, integer64proto):
     query_result = datastore_pb.QueryResult()
     self._Dynamic_RunQuery(query, query_result)
     cursor = query_result.cursor().cursor()
-    results, count = self.__queries[cursor]
-    integer64proto.set_value(count)
-    del self.__queries[cursor]
+    self.__cursor_lock.acquire()
+    try:
+      query_cursor = self.__queries.pop(cursor)
+    finally:
+      self.__cursor_lock.release()
+    integer64proto.set_value(query_cursor.Count())
 
 
   def _Dynamic_BeginTransaction(self, request, transaction):
@@ -542,35 +1076,78 @@ class DatastoreFileStub(object):
     self.__next_tx_handle += 1
     self.__tx_handle_lock.release()
 
-    self.__transactions[handle] = None
+    self.__entities_lock.acquire()
+    try:
+      self.__transactions[handle] = _Transaction()
+    finally:
+      self.__entities_lock.release()
     transaction.set_handle(handle)
 
-    self.__tx_lock.acquire()
-    snapshot = [(app_kind, dict(entities))
-                for app_kind, entities in self.__entities.items()]
-    self.__tx_snapshot = dict(snapshot)
-
   def _Dynamic_Commit(self, transaction, transaction_response):
-    if not self.__transactions.has_key(transaction.handle()):
-      raise apiproxy_errors.ApplicationError(
-        datastore_pb.Error.BAD_REQUEST,
-        'Transaction handle %d not found' % transaction.handle())
-
-    self.__tx_snapshot = {}
+    self.__entities_lock.acquire()
     try:
-      self.__WriteDatastore()
+      tx = self.__GetTransaction(transaction)
+      try:
+        for group, version in tx.versions.items():
+          if self.__entity_group_versions.get(group, 0) != version:
+            raise apiproxy_errors.ApplicationError(
+              datastore_pb.Error.CONCURRENT_TRANSACTION,
+              'Concurrency exception.')
+
+        if tx.writes:
+          entities = []
+          keys = []
+          for encoded, entity in tx.writes.items():
+            if entity is None:
+              keys.append(entity_pb.Reference(encoded))
+            else:
+              entities.append(entity)
+          self.__ApplyWrites(entities, keys)
+      finally:
+        self.__EndTransaction(transaction)
     finally:
-      self.__tx_lock.release()
+      self.__entities_lock.release()
 
   def _Dynamic_Rollback(self, transaction, transaction_response):
-    if not self.__transactions.has_key(transaction.handle()):
+    self.__entities_lock.acquire()
+    try:
+      self.__EndTransaction(transaction)
+    finally:
+      self.__entities_lock.release()
+
+  def __GetTransaction(self, transaction):
+    """Returns the state of a transaction in progress.
+
+    Args:
+      transaction: datastore_pb.Transaction
+
+    Returns:
+      _Transaction
+    """
+    try:
+      return self.__transactions[transaction.handle()]
+    except KeyError:
       raise apiproxy_errors.ApplicationError(
         datastore_pb.Error.BAD_REQUEST,
         'Transaction handle %d not found' % transaction.handle())
 
-    self.__entities = self.__tx_snapshot
-    self.__tx_snapshot = {}
-    self.__tx_lock.release()
+  def __EndTransaction(self, transaction):
+    """Removes a transaction from the transactions in progress, and stops
+    tracking entity group versions if it was the last one.
+
+    Must be called with __entities_lock held.
+
+    Args:
+      transaction: datastore_pb.Transaction
+
+    Returns:
+      _Transaction
+    """
+    tx = self.__GetTransaction(transaction)
+    del self.__transactions[transaction.handle()]
+    if not self.__transactions:
+      self.__entity_group_versions = {}
+    return tx
 
   def _Dynamic_GetSchema(self, app_str, schema):
     minint = -sys.maxint - 1
@@ -589,7 +1166,7 @@ class DatastoreFileStub(object):
 
         props = {}
 
-        for entity in self.__entities[(app, kind)].values():
+        for entity in self.__Decoded(self.__entities[(app, kind)].values()):
           for prop in entity.property_list():
             if prop.name() not in props:
               props[prop.name()] = entity_pb.PropertyValue()
@@ -669,6 +1246,7 @@ class DatastoreFileStub(object):
     self.__indexes_lock.acquire()
     try:
       stored_index.set_state(index.state())
+      self.__DropCompositeTable(stored_index)
     finally:
       self.__indexes_lock.release()
 
@@ -682,9 +1260,33 @@ class DatastoreFileStub(object):
     self.__indexes_lock.acquire()
     try:
       self.__indexes[app].remove(stored_index)
+      self.__DropCompositeTable(stored_index)
     finally:
       self.__indexes_lock.release()
 
+  def __DropCompositeTable(self, index):
+    """Discards the materialized rows of a composite index, if any.
+
+    Args:
+      index: entity_pb.CompositeIndex
+    """
+    app_kind = (index.app_id(), index.definition().entity_type())
+    self.__composite_tables.get(app_kind, {}).pop(index.id(), None)
+
+  def __FindCompositeIndex(self, app, required_index):
+    """Finds an existing composite index that can serve a query.
+
+    Args:
+      app: string, the resolved app id
+      required_index: the tuple returned by
+          datastore_index.CompositeIndexForQuery() for the query
+
+    Returns:
+      entity_pb.CompositeIndex, if one exists; otherwise None
+    """
+    return datastore_stub_util.FindCompositeIndex(self.__indexes.get(app, []),
+                                                  required_index)
+
   def __FindIndex(self, index):
     """Finds an existing index by definition.
 
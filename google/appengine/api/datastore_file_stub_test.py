@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+#
+# Copyright 2007 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests for google.appengine.api.datastore_file_stub."""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+os.environ.setdefault('APPLICATION_ID', 'test')
+
+from google.appengine.api import api_base_pb
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import datastore
+from google.appengine.api import datastore_file_stub
+from google.appengine.datastore import datastore_pb
+from google.appengine.runtime import apiproxy_errors
+
+
+class TransactionTest(unittest.TestCase):
+  """Tests the optimistic transactions of DatastoreFileStub."""
+
+  def setUp(self):
+    self.stub = datastore_file_stub.DatastoreFileStub('test', None, None)
+    apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+    apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', self.stub)
+
+    entity = datastore.Entity('Counter', name='counter')
+    entity['count'] = 0
+    self.key = datastore.Put(entity)
+
+  def Call(self, method, request, response):
+    self.stub.MakeSyncCall('datastore_v3', method, request, response)
+    return response
+
+  def BeginTransaction(self):
+    return self.Call('BeginTransaction', api_base_pb.VoidProto(),
+                     datastore_pb.Transaction())
+
+  def Increment(self, transaction):
+    """Gets and puts the counter in a transaction."""
+    get_request = datastore_pb.GetRequest()
+    get_request.key_list().append(self.key._ToPb())
+    get_request.mutable_transaction().CopyFrom(transaction)
+    get_response = self.Call('Get', get_request, datastore_pb.GetResponse())
+
+    entity = datastore.Entity._FromPb(get_response.entity(0).entity())
+    entity['count'] += 1
+    put_request = datastore_pb.PutRequest()
+    put_request.entity_list().append(entity._ToPb())
+    put_request.mutable_transaction().CopyFrom(transaction)
+    self.Call('Put', put_request, datastore_pb.PutResponse())
+
+  def Commit(self, transaction):
+    self.Call('Commit', transaction, api_base_pb.VoidProto())
+
+  def testLastCommitConflicts(self):
+    first = self.BeginTransaction()
+    second = self.BeginTransaction()
+    self.Increment(first)
+    self.Increment(second)
+    self.Commit(first)
+
+    try:
+      self.Commit(second)
+      self.fail('Expected CONCURRENT_TRANSACTION')
+    except apiproxy_errors.ApplicationError, e:
+      self.assertEqual(datastore_pb.Error.CONCURRENT_TRANSACTION,
+                       e.application_error)
+
+    self.assertEqual(1, datastore.Get(self.key)['count'])
+
+  def testFailedCommitEndsTransaction(self):
+    first = self.BeginTransaction()
+    second = self.BeginTransaction()
+    self.Increment(first)
+    self.Increment(second)
+    self.Commit(first)
+    self.assertRaises(apiproxy_errors.ApplicationError, self.Commit, second)
+
+    try:
+      self.Commit(second)
+      self.fail('Expected BAD_REQUEST')
+    except apiproxy_errors.ApplicationError, e:
+      self.assertEqual(datastore_pb.Error.BAD_REQUEST, e.application_error)
+
+  def testRunInTransactionRetries(self):
+    other = self.BeginTransaction()
+    self.Increment(other)
+    concurrent = [other]
+
+    def Increment():
+      entity = datastore.Get(self.key)
+      entity['count'] += 1
+      datastore.Put(entity)
+      if concurrent:
+        self.Commit(concurrent.pop())
+
+    datastore.RunInTransaction(Increment)
+    self.assertEqual(2, datastore.Get(self.key)['count'])
+
+
+class WriteLogTest(unittest.TestCase):
+  """Tests switching between runs with and without the write log."""
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.datastore_file = os.path.join(self.directory, 'datastore')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def StartStub(self, use_write_log):
+    stub = datastore_file_stub.DatastoreFileStub(
+        'test', self.datastore_file, None, use_write_log=use_write_log)
+    apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+    apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', stub)
+    return stub
+
+  def Put(self, name, value):
+    entity = datastore.Entity('Item', name=name)
+    entity['value'] = value
+    return datastore.Put(entity)
+
+  def Values(self):
+    return dict((entity.key().name(), entity['value'])
+                for entity in datastore.Query('Item').Get(100))
+
+  def testRunWithoutLogSupersedesLog(self):
+    self.StartStub(use_write_log=True)
+    self.Put('a', 1)
+    self.Put('b', 1)
+
+    self.StartStub(use_write_log=False)
+    self.assertEqual({'a': 1, 'b': 1}, self.Values())
+    self.Put('a', 2)
+    datastore.Delete(datastore.Key.from_path('Item', 'b'))
+    for filename in datastore_file_stub.DatastoreFileStub.LogFilenames(
+        self.datastore_file):
+      self.failIf(os.path.exists(filename))
+
+    self.StartStub(use_write_log=True)
+    self.assertEqual({'a': 2}, self.Values())
+
+  def testWriteWithoutEntitiesRemovesLog(self):
+    self.StartStub(use_write_log=True)
+    self.Put('a', 1)
+
+    stub = self.StartStub(use_write_log=False)
+    datastore.Delete(datastore.Key.from_path('Item', 'a'))
+    stub.Write()
+
+    self.StartStub(use_write_log=False)
+    self.assertEqual({}, self.Values())
+
+  def testCompactKeepsLaterWrites(self):
+    stub = self.StartStub(use_write_log=True)
+    self.Put('a', 1)
+    stub.Compact()
+    self.Put('a', 2)
+
+    self.StartStub(use_write_log=True)
+    self.assertEqual({'a': 2}, self.Values())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,783 @@
+#!/usr/bin/env python
+#
+# Copyright 2007 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+SQLite-backed persistent stub for the Python datastore API. Implements the
+same calls as DatastoreFileStub, but keeps entities on disk instead of in
+memory, so startup time and memory use don't grow with the datastore.
+
+Entities are stored as encoded protocol buffers in the Entities table, keyed
+by (app, kind, path). Every indexed property value also gets a row in the
+EntitiesByProperty table. Paths and values are stored with the
+order-preserving encodings from datastore_stub_util, so SQLite's BLOB
+comparisons sort them the same way DatastoreFileStub does. That includes
+comparing ints and floats numerically, as the old stubs' eval() did, rather
+than in the production datastore's order. Queries are translated into SQL
+that uses the primary keys of those tables as indexes.
+
+Transactions are serialized through __tx_lock. A transaction's puts and
+deletes are kept in memory until Commit() writes them in a single SQLite
+transaction, and Rollback() discards them, so writes made outside the
+transaction, e.g. by other requests, are committed as they happen and never
+rolled back with it.
+"""
+
+
+
+
+
+import logging
+import sys
+import threading
+import time
+import types
+
+try:
+  import sqlite3
+except ImportError:
+  from pysqlite2 import dbapi2 as sqlite3
+
+from google.appengine.api import api_base_pb
+from google.appengine.api import datastore
+from google.appengine.api import datastore_errors
+from google.appengine.datastore import datastore_index
+from google.appengine.datastore import datastore_pb
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.datastore import entity_pb
+from google.appengine.runtime import apiproxy_errors
+from google.net.proto import ProtocolBuffer
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS Entities (
+  app TEXT NOT NULL,
+  kind TEXT NOT NULL,
+  path BLOB NOT NULL,
+  entity BLOB NOT NULL,
+  PRIMARY KEY (app, kind, path)
+);
+
+CREATE TABLE IF NOT EXISTS EntitiesByProperty (
+  app TEXT NOT NULL,
+  kind TEXT NOT NULL,
+  name TEXT NOT NULL,
+  value BLOB NOT NULL,
+  path BLOB NOT NULL,
+  PRIMARY KEY (app, kind, name, value, path)
+);
+
+CREATE INDEX IF NOT EXISTS EntitiesByPropertyPath
+  ON EntitiesByProperty (app, kind, path);
+
+CREATE TABLE IF NOT EXISTS QueryHistory (
+  query BLOB PRIMARY KEY,
+  count INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS Metadata (
+  name TEXT PRIMARY KEY,
+  value INTEGER NOT NULL
+);
+"""
+
+_OPERATORS = {
+  datastore_pb.Query_Filter.LESS_THAN:             '<',
+  datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL:    '<=',
+  datastore_pb.Query_Filter.GREATER_THAN:          '>',
+  datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL: '>=',
+  datastore_pb.Query_Filter.EQUAL:                 '=',
+  }
+
+_SCHEMA_VALUES = {
+  entity_pb.PropertyValue.kint64Value:
+      lambda value: value.set_int64value(-sys.maxint - 1),
+  entity_pb.PropertyValue.kbooleanValue:
+      lambda value: value.set_booleanvalue(False),
+  entity_pb.PropertyValue.kstringValue:
+      lambda value: value.set_stringvalue(''),
+  entity_pb.PropertyValue.kdoubleValue:
+      lambda value: value.set_doublevalue(float('-inf')),
+  entity_pb.PropertyValue.kPointValueGroup:
+      lambda value: (value.mutable_pointvalue().set_x(float('-inf')),
+                     value.mutable_pointvalue().set_y(float('-inf'))),
+  entity_pb.PropertyValue.kUserValueGroup:
+      lambda value: (value.mutable_uservalue().set_gaiaid(-sys.maxint - 1),
+                     value.mutable_uservalue().set_email(''),
+                     value.mutable_uservalue().set_auth_domain(''),
+                     value.mutable_uservalue().set_nickname('')),
+  entity_pb.PropertyValue.kReferenceValueGroup:
+      lambda value: value.mutable_referencevalue().set_app(''),
+  }
+
+
+class DatastoreSqliteStub(object):
+  """ Persistent stub for the Python datastore API, backed by SQLite.
+
+  A DatastoreSqliteStub instance handles a single app's data and is backed by
+  a single SQLite database file, which also holds the query history.
+
+  Query results are read from the database one Next() batch at a time.
+  Cursors are discarded after CURSOR_TTL seconds of disuse, or when there are
+  more than MAX_CURSORS.
+  """
+
+  CURSOR_TTL = 10 * 60
+
+  MAX_CURSORS = 1000
+
+  def __init__(self, app_id, datastore_file, require_indexes=False):
+    """Constructor.
+
+    Opens the database, creating it if it doesn't exist yet.
+
+    Args:
+      app_id: string
+      datastore_file: string, the SQLite database file. Use None or
+          ':memory:' not to use a file.
+      require_indexes: bool, default False.  If True, composite indexes must
+          exist in index.yaml for queries that need them.
+    """
+    assert isinstance(app_id, types.StringTypes) and app_id != ''
+    self.__app_id = app_id
+    self.__datastore_file = datastore_file or ':memory:'
+
+    self.__queries = {}
+
+    self.__transactions = {}
+
+    self.__indexes = {}
+    self.__require_indexes = require_indexes
+
+    self.__next_cursor = 1
+    self.__next_tx_handle = 1
+    self.__next_index_id = 1
+    self.__cursor_lock = threading.Lock()
+    self.__tx_handle_lock = threading.Lock()
+    self.__index_id_lock = threading.Lock()
+    self.__tx_lock = threading.Lock()
+    self.__db_lock = threading.RLock()
+    self.__indexes_lock = threading.Lock()
+
+    self.__connection = sqlite3.connect(self.__datastore_file,
+                                        check_same_thread=False)
+    self.__connection.text_factory = str
+    try:
+      self.__connection.executescript(_SCHEMA)
+      self.__connection.commit()
+    except sqlite3.DatabaseError, e:
+      raise datastore_errors.InternalError(
+          'Data in %s is corrupt or a different version. '
+          'Try running with the --clear_datastore flag.\n%r' %
+          (self.__datastore_file, e))
+
+  def Clear(self):
+    """ Clears the datastore by deleting all currently stored entities and
+    queries. """
+    self.__db_lock.acquire()
+    try:
+      for table in ('Entities', 'EntitiesByProperty', 'QueryHistory',
+                    'Metadata'):
+        self.__connection.execute('DELETE FROM %s' % table)
+      self.__connection.commit()
+    finally:
+      self.__db_lock.release()
+
+    self.__queries = {}
+    self.__transactions = {}
+
+  def Close(self):
+    """ Closes the database. The stub can't be used afterwards. """
+    self.__connection.close()
+
+  def MakeSyncCall(self, service, call, request, response):
+    """ The main RPC entry point. service must be 'datastore_v3'. So far, the
+    supported calls are 'Get', 'Put', 'RunQuery', 'Next', and 'Count'.
+    """
+
+    assert service == 'datastore_v3'
+
+    explanation = []
+    assert request.IsInitialized(explanation), explanation
+
+    (getattr(self, "_Dynamic_" + call))(request, response)
+
+    assert response.IsInitialized(explanation), explanation
+
+  def ResolveAppId(self, app):
+    """ If the given app name is the placeholder for the local app, returns
+    our app_id. Otherwise returns the app name unchanged.
+    """
+    assert app != ''
+    if app == datastore._LOCAL_APP_ID:
+      return self.__app_id
+    else:
+      return app
+
+  def QueryHistory(self):
+    """Returns a dict that maps Query PBs to times they've been run.
+    """
+    history = {}
+    for encoded_query, count in self.__Execute(
+        'SELECT query, count FROM QueryHistory').fetchall():
+      query = datastore_pb.Query(str(encoded_query))
+      if query.app() == self.__app_id:
+        history[query] = count
+    return history
+
+  def __Execute(self, statement, params=()):
+    """Runs an SQL statement under the database lock.
+
+    Args:
+      statement: string
+      params: sequence of query parameters
+
+    Returns:
+      sqlite3.Cursor
+    """
+    self.__db_lock.acquire()
+    try:
+      return self.__connection.execute(statement, params)
+    finally:
+      self.__db_lock.release()
+
+  def __AllocateId(self):
+    """Returns the next unused entity id, and records it in the database.
+
+    Must be called with __db_lock held. The caller commits.
+    """
+    row = self.__connection.execute(
+        "SELECT value FROM Metadata WHERE name = 'next_id'").fetchone()
+    if row:
+      next_id = row[0]
+    else:
+      next_id = 1
+    self.__connection.execute(
+        "INSERT OR REPLACE INTO Metadata (name, value) VALUES ('next_id', ?)",
+        (next_id + 1,))
+    return next_id
+
+  def __KeyColumns(self, key):
+    """Returns the (app, kind, path) column values for a key.
+
+    Args:
+      key: entity_pb.Reference, with a resolved app id
+
+    Returns:
+      tuple
+    """
+    elements = key.path().element_list()
+    return (key.app(), elements[-1].type(),
+            buffer(datastore_stub_util.EncodePath(elements)))
+
+  def __GetTransaction(self, transaction):
+    """Returns the writes of a transaction in progress.
+
+    Args:
+      transaction: datastore_pb.Transaction
+
+    Returns:
+      dict mapping encoded keys to the entity_pb.EntityProto put there, or to
+      None if the entity was deleted
+    """
+    try:
+      return self.__transactions[transaction.handle()]
+    except KeyError:
+      raise apiproxy_errors.ApplicationError(
+        datastore_pb.Error.BAD_REQUEST,
+        'Transaction handle %d not found' % transaction.handle())
+
+  def __ApplyWrites(self, entities, keys):
+    """Stores and deletes entities and their index rows, and commits.
+
+    Must be called with __db_lock held.
+
+    Args:
+      entities: list of entity_pb.EntityProto to store, with resolved app ids
+      keys: list of entity_pb.Reference to delete, with resolved app ids
+    """
+    for entity in entities:
+      app, kind, path = self.__KeyColumns(entity.key())
+      self.__connection.execute(
+          'INSERT OR REPLACE INTO Entities (app, kind, path, entity) '
+          'VALUES (?, ?, ?, ?)', (app, kind, path, buffer(entity.Encode())))
+      self.__connection.execute(
+          'DELETE FROM EntitiesByProperty '
+          'WHERE app = ? AND kind = ? AND path = ?', (app, kind, path))
+
+      values = set()
+      for prop in entity.property_list():
+        values.add((prop.name(), datastore_stub_util.EncodePropertyValue(
+            prop.value())))
+      self.__connection.executemany(
+          'INSERT INTO EntitiesByProperty (app, kind, name, value, path) '
+          'VALUES (?, ?, ?, ?, ?)',
+          [(app, kind, name, buffer(value), path) for name, value in values])
+
+    for key in keys:
+      columns = self.__KeyColumns(key)
+      self.__connection.execute(
+          'DELETE FROM Entities WHERE app = ? AND kind = ? AND path = ?',
+          columns)
+      self.__connection.execute(
+          'DELETE FROM EntitiesByProperty '
+          'WHERE app = ? AND kind = ? AND path = ?', columns)
+
+    self.__connection.commit()
+
+  def _Dynamic_Put(self, put_request, put_response):
+    tx = None
+    if put_request.has_transaction():
+      tx = self.__GetTransaction(put_request.transaction())
+
+    clones = []
+    for entity in put_request.entity_list():
+      clone = entity_pb.EntityProto()
+      clone.CopyFrom(entity)
+      clones.append(clone)
+
+      assert clone.has_key()
+      assert clone.key().path().element_size() > 0
+
+      app = self.ResolveAppId(clone.key().app())
+      clone.mutable_key().set_app(app)
+
+    self.__db_lock.acquire()
+    try:
+      for clone in clones:
+        last_path = clone.key().path().element_list()[-1]
+        if last_path.id() == 0 and not last_path.has_name():
+          last_path.set_id(self.__AllocateId())
+
+          assert clone.entity_group().element_size() == 0
+          group = clone.mutable_entity_group()
+          root = clone.key().path().element(0)
+          group.add_element().CopyFrom(root)
+
+        else:
+          assert (clone.has_entity_group() and
+                  clone.entity_group().element_size() > 0)
+
+      if tx is None:
+        self.__ApplyWrites(clones, [])
+      else:
+        for clone in clones:
+          tx[clone.key().Encode()] = clone
+        self.__connection.commit()
+    finally:
+      self.__db_lock.release()
+
+    put_response.key_list().extend([c.key() for c in clones])
+
+  def _Dynamic_Get(self, get_request, get_response):
+    tx = None
+    if get_request.has_transaction():
+      tx = self.__GetTransaction(get_request.transaction())
+
+    for key in get_request.key_list():
+      app = self.ResolveAppId(key.app())
+      key.set_app(app)
+
+      group = get_response.add_entity()
+      if tx is not None and key.Encode() in tx:
+        entity = tx[key.Encode()]
+        if entity is not None:
+          group.mutable_entity().CopyFrom(entity)
+        continue
+
+      row = self.__Execute(
+          'SELECT entity FROM Entities WHERE app = ? AND kind = ? AND path = ?',
+          self.__KeyColumns(key)).fetchone()
+      if row:
+        group.mutable_entity().ParseFromString(str(row[0]))
+
+  def _Dynamic_Delete(self, delete_request, delete_response):
+    for key in delete_request.key_list():
+      key.set_app(self.ResolveAppId(key.app()))
+
+    if delete_request.has_transaction():
+      tx = self.__GetTransaction(delete_request.transaction())
+      for key in delete_request.key_list():
+        tx[key.Encode()] = None
+    else:
+      self.__db_lock.acquire()
+      try:
+        self.__ApplyWrites([], delete_request.key_list())
+      finally:
+        self.__db_lock.release()
+
+  def __QueryToSql(self, query, columns):
+    """Translates a query into an SQL SELECT statement.
+
+    Each filter becomes a range lookup in the primary key of the
+    EntitiesByProperty table. Each sort order sorts multi-valued properties
+    by the same value as datastore_stub_util.SortValueKey(), in either
+    direction, and also implies an existence filter. Ties are broken by key.
+
+    Args:
+      query: datastore_pb.Query, with a resolved app id
+      columns: string, the SQL expression to select
+
+    Returns:
+      (statement, params) tuple
+    """
+    conditions = ['e.app = ?', 'e.kind = ?']
+    params = [query.app(), query.kind()]
+
+    if query.has_ancestor():
+      ancestor = datastore_stub_util.EncodePath(
+          query.ancestor().path().element_list())
+      conditions.append('e.path >= ? AND e.path < ?')
+      params.extend([buffer(ancestor), buffer(ancestor + '\xff')])
+
+    property_lookup = ('e.path IN (SELECT path FROM EntitiesByProperty '
+                       'WHERE app = e.app AND kind = e.kind AND name = ?%s)')
+
+    for filt in query.filter_list():
+      assert filt.op() != datastore_pb.Query_Filter.IN
+      prop = filt.property(0)
+      conditions.append(property_lookup % (' AND value %s ?' %
+                                           _OPERATORS[filt.op()]))
+      params.extend([prop.name(), buffer(
+          datastore_stub_util.EncodePropertyValue(prop.value()))])
+
+    orderings = []
+    order_params = []
+    for order in query.order_list():
+      conditions.append(property_lookup % '')
+      params.append(order.property())
+
+      if order.direction() == datastore_pb.Query_Order.DESCENDING:
+        direction = 'DESC'
+      else:
+        direction = 'ASC'
+      orderings.append('(SELECT %s(value) FROM EntitiesByProperty '
+                       'WHERE app = e.app AND kind = e.kind AND name = ? '
+                       'AND path = e.path) %s' %
+                       (datastore_stub_util.SORT_VALUE_SQL_AGGREGATE,
+                        direction))
+      order_params.append(order.property())
+    orderings.append('e.path')
+
+    statement = 'SELECT %s FROM Entities e WHERE %s ORDER BY %s' % (
+        columns, ' AND '.join(conditions), ', '.join(orderings))
+    params.extend(order_params)
+
+    if query.has_limit():
+      statement += ' LIMIT ?'
+      params.append(query.limit())
+
+    return statement, params
+
+  def _Dynamic_RunQuery(self, query, query_result):
+    if not self.__tx_lock.acquire(False):
+      raise apiproxy_errors.ApplicationError(
+        datastore_pb.Error.BAD_REQUEST, "Can't query inside a transaction.")
+    else:
+      self.__tx_lock.release()
+
+    app = self.ResolveAppId(query.app())
+
+    if self.__require_indexes:
+      required_index = datastore_index.CompositeIndexForQuery(query)
+      if required_index is not None:
+        if not self.__indexes.get(app):
+          raise apiproxy_errors.ApplicationError(
+              datastore_pb.Error.BAD_REQUEST,
+              "This query requires a composite index, but none are defined. "
+              "You must create an index.yaml file in your application root.")
+        elif not datastore_stub_util.FindCompositeIndex(self.__indexes[app],
+                                                        required_index):
+          raise apiproxy_errors.ApplicationError(
+              datastore_pb.Error.BAD_REQUEST,
+              "This query requires a composite index that is not defined. "
+              "You must update the index.yaml file in your application root.")
+
+    query.set_app(app)
+    statement, params = self.__QueryToSql(query, 'e.entity')
+    query_cursor = datastore_stub_util.QueryCursor(
+        self.__FetchRows(self.__Execute(statement, params)))
+
+    clone = datastore_pb.Query()
+    clone.CopyFrom(query)
+    clone.clear_hint()
+    self.__db_lock.acquire()
+    try:
+      encoded_query = buffer(clone.Encode())
+      self.__connection.execute(
+          'INSERT OR IGNORE INTO QueryHistory (query, count) VALUES (?, 0)',
+          (encoded_query,))
+      self.__connection.execute(
+          'UPDATE QueryHistory SET count = count + 1 WHERE query = ?',
+          (encoded_query,))
+      self.__connection.commit()
+    finally:
+      self.__db_lock.release()
+
+    self.__cursor_lock.acquire()
+    try:
+      cursor = self.__next_cursor
+      self.__next_cursor += 1
+      self.__EvictCursors()
+      self.__queries[cursor] = query_cursor
+    finally:
+      self.__cursor_lock.release()
+
+    query_result.mutable_cursor().set_cursor(cursor)
+    query_result.set_more_results(query_cursor.HasMore())
+
+  def __FetchRows(self, sql_cursor):
+    """Yields the first column of each row an SQLite cursor selects, as a
+    string.
+
+    Rows are fetched one at a time under the database lock, as the returned
+    iterator is consumed, so a query only holds the rows of the batch being
+    returned.
+
+    Args:
+      sql_cursor: sqlite3.Cursor
+    """
+    while True:
+      self.__db_lock.acquire()
+      try:
+        row = sql_cursor.fetchone()
+      finally:
+        self.__db_lock.release()
+      if row is None:
+        return
+      yield str(row[0])
+
+  def __EvictCursors(self):
+    """Discards cursors that haven't been used for CURSOR_TTL seconds, then,
+    if there are still MAX_CURSORS or more, the least recently used ones.
+
+    Must be called with __cursor_lock held.
+    """
+    expired = time.time() - self.CURSOR_TTL
+    for cursor, query_cursor in self.__queries.items():
+      if query_cursor.last_access < expired:
+        del self.__queries[cursor]
+
+    excess = len(self.__queries) - self.MAX_CURSORS + 1
+    if excess > 0:
+      by_access = sorted([(query_cursor.last_access, cursor)
+                          for cursor, query_cursor in self.__queries.items()])
+      for last_access, cursor in by_access[:excess]:
+        del self.__queries[cursor]
+
+  def _Dynamic_Next(self, next_request, query_result):
+    cursor = next_request.cursor().cursor()
+
+    try:
+      query_cursor = self.__queries[cursor]
+    except KeyError:
+      raise apiproxy_errors.ApplicationError(datastore_pb.Error.BAD_REQUEST,
+                                             'Cursor %d not found' % cursor)
+
+    for encoded_entity in query_cursor.Next(next_request.count()):
+      query_result.add_result().ParseFromString(encoded_entity)
+
+    query_result.set_more_results(query_cursor.HasMore())
+
+  def _Dynamic_Count(self, query, integer64proto):
+    query_result = datastore_pb.QueryResult()
+    self._Dynamic_RunQuery(query, query_result)
+    cursor = query_result.cursor().cursor()
+    self.__cursor_lock.acquire()
+    try:
+      query_cursor = self.__queries.pop(cursor)
+    finally:
+      self.__cursor_lock.release()
+    integer64proto.set_value(query_cursor.Count())
+
+  def _Dynamic_BeginTransaction(self, request, transaction):
+    self.__tx_handle_lock.acquire()
+    handle = self.__next_tx_handle
+    self.__next_tx_handle += 1
+    self.__tx_handle_lock.release()
+
+    self.__tx_lock.acquire()
+    self.__transactions[handle] = {}
+    transaction.set_handle(handle)
+
+  def _Dynamic_Commit(self, transaction, transaction_response):
+    writes = self.__GetTransaction(transaction)
+    del self.__transactions[transaction.handle()]
+
+    entities = []
+    keys = []
+    for encoded, entity in writes.items():
+      if entity is None:
+        keys.append(entity_pb.Reference(encoded))
+      else:
+        entities.append(entity)
+
+    self.__db_lock.acquire()
+    try:
+      self.__ApplyWrites(entities, keys)
+    finally:
+      self.__db_lock.release()
+      self.__tx_lock.release()
+
+  def _Dynamic_Rollback(self, transaction, transaction_response):
+    self.__GetTransaction(transaction)
+    del self.__transactions[transaction.handle()]
+    self.__tx_lock.release()
+
+  def _Dynamic_GetSchema(self, app_str, schema):
+    app_str = self.ResolveAppId(app_str.value())
+
+    kinds = []
+
+    for kind, in self.__Execute(
+        'SELECT DISTINCT kind FROM Entities WHERE app = ? ORDER BY kind',
+        (app_str,)).fetchall():
+      kind_pb = entity_pb.EntityProto()
+      kind_pb.mutable_key().set_app('')
+      kind_pb.mutable_key().mutable_path().add_element().set_type(kind)
+      kind_pb.mutable_entity_group()
+      kinds.append(kind_pb)
+
+      props = {}
+      for name, tag in self.__Execute(
+          'SELECT DISTINCT name, substr(value, 1, 1) FROM EntitiesByProperty '
+          'WHERE app = ? AND kind = ?', (app_str, kind)).fetchall():
+        value_pb = props.setdefault(name, entity_pb.PropertyValue())
+        tag = ord(str(tag))
+        if tag == entity_pb.PropertyValue.kint64Value:
+          self.__SetNumericSchemaValues(app_str, kind, name, value_pb)
+        else:
+          set_value = _SCHEMA_VALUES.get(tag)
+          if set_value:
+            set_value(value_pb)
+
+      for name, value_pb in props.items():
+        prop_pb = kind_pb.add_property()
+        prop_pb.set_name(name)
+        prop_pb.mutable_value().CopyFrom(value_pb)
+
+    schema.kind_list().extend(kinds)
+
+  def __SetNumericSchemaValues(self, app, kind, name, value_pb):
+    """Sets the schema values for the numeric types a property has.
+
+    Ints and doubles share an encoding in EntitiesByProperty, so this looks
+    at the entities themselves to tell which of the two the property holds.
+
+    Args:
+      app, kind: string
+      name: string, the property name
+      value_pb: entity_pb.PropertyValue, the property's schema value
+    """
+    tags = set()
+    for encoded_entity, in self.__Execute(
+        'SELECT entity FROM Entities WHERE app = ? AND kind = ? AND path IN '
+        '(SELECT path FROM EntitiesByProperty '
+        'WHERE app = ? AND kind = ? AND name = ? AND substr(value, 1, 1) = ?)',
+        (app, kind, app, kind, name,
+         buffer(chr(entity_pb.PropertyValue.kint64Value)))).fetchall():
+      entity = entity_pb.EntityProto(str(encoded_entity))
+      for prop in entity.property_list():
+        if prop.name() == name:
+          if prop.value().has_int64value():
+            tags.add(entity_pb.PropertyValue.kint64Value)
+          elif prop.value().has_doublevalue():
+            tags.add(entity_pb.PropertyValue.kdoubleValue)
+      if len(tags) == 2:
+        break
+
+    for tag in tags:
+      _SCHEMA_VALUES[tag](value_pb)
+
+  def _Dynamic_CreateIndex(self, index, id_response):
+    if index.id() != 0:
+      raise apiproxy_errors.ApplicationError(datastore_pb.Error.BAD_REQUEST,
+                                             'New index id must be 0.')
+    elif self.__FindIndex(index):
+      raise apiproxy_errors.ApplicationError(datastore_pb.Error.BAD_REQUEST,
+                                             'Index already exists.')
+
+    self.__index_id_lock.acquire()
+    index.set_id(self.__next_index_id)
+    id_response.set_value(self.__next_index_id)
+    self.__next_index_id += 1
+    self.__index_id_lock.release()
+
+    clone = entity_pb.CompositeIndex()
+    clone.CopyFrom(index)
+    app = self.ResolveAppId(index.app_id())
+    clone.set_app_id(app)
+
+    self.__indexes_lock.acquire()
+    try:
+      if app not in self.__indexes:
+        self.__indexes[app] = []
+      self.__indexes[app].append(clone)
+    finally:
+      self.__indexes_lock.release()
+
+  def _Dynamic_GetIndices(self, app_str, composite_indices):
+    composite_indices.index_list().extend(
+      self.__indexes.get(self.ResolveAppId(app_str.value()), []))
+
+  def _Dynamic_UpdateIndex(self, index, void):
+    stored_index = self.__FindIndex(index)
+    if not stored_index:
+      raise apiproxy_errors.ApplicationError(datastore_pb.Error.BAD_REQUEST,
+                                             "Index doesn't exist.")
+    elif index.state() != stored_index.state() + 1:
+      raise apiproxy_errors.ApplicationError(
+        datastore_pb.Error.BAD_REQUEST,
+        "cannot move index state from %s to %s" %
+          (entity_pb.CompositeIndex.State_Name(stored_index.state()),
+          (entity_pb.CompositeIndex.State_Name(index.state()))))
+
+    self.__indexes_lock.acquire()
+    try:
+      stored_index.set_state(index.state())
+    finally:
+      self.__indexes_lock.release()
+
+  def _Dynamic_DeleteIndex(self, index, void):
+    stored_index = self.__FindIndex(index)
+    if not stored_index:
+      raise apiproxy_errors.ApplicationError(datastore_pb.Error.BAD_REQUEST,
+                                             "Index doesn't exist.")
+
+    app = self.ResolveAppId(index.app_id())
+    self.__indexes_lock.acquire()
+    try:
+      self.__indexes[app].remove(stored_index)
+    finally:
+      self.__indexes_lock.release()
+
+  def __FindIndex(self, index):
+    """Finds an existing index by definition.
+
+    Args:
+      definition: entity_pb.CompositeIndex
+
+    Returns:
+      entity_pb.CompositeIndex, if it exists; otherwise None
+    """
+    app = self.ResolveAppId(index.app_id())
+
+    if app in self.__indexes:
+      for stored_index in self.__indexes[app]:
+        if index.definition() == stored_index.definition():
+          return stored_index
+
+    return None
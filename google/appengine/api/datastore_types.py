@@ -108,9 +108,11 @@ class Key(object):
   datastore with Get().
 
   Key implements __hash__, and key instances are immutable, so Keys may be
-  used in sets and as dictionary keys.
+  used in sets and as dictionary keys. A Key encodes its reference, and works
+  out the app and path it compares by, at most once.
   """
-  __reference = None
+  __slots__ = ('_Key__reference', '_Key__encoded', '_Key__comparison',
+               '_Key__hash')
 
   def __init__(self, encoded=None):
     """Constructor. Creates a Key from a string.
@@ -119,6 +121,9 @@ class Key(object):
       # a base64-encoded primary key, generated by Key.__str__
       encoded: str
     """
+    self.__encoded = None
+    self.__comparison = None
+    self.__hash = None
     if encoded is not None:
       if not isinstance(encoded, basestring):
         try:
@@ -136,6 +141,7 @@ class Key(object):
         encoded_pb = base64.urlsafe_b64decode(str(encoded))
         self.__reference = entity_pb.Reference(encoded_pb)
         assert self.__reference.IsInitialized()
+        self.__encoded = encoded_pb
 
       except (AssertionError, TypeError), e:
         raise datastore_errors.BadKeyError(
@@ -355,11 +361,68 @@ class Key(object):
         'Key constructor takes an entity_pb.Reference; received %s (a %s).' %
         (pb, typename(pb)))
 
-    key = Key()
+    key = Key.__new__(Key)
     key.__reference = entity_pb.Reference()
     key.__reference.CopyFrom(pb)
+    key.__encoded = None
+    key.__comparison = None
+    key.__hash = None
     return key
 
+  def _CopyFromPb(self, pb):
+    """Replaces this Key's reference with a copy of an entity_pb.Reference.
+
+    Used to fill in an incomplete key once the datastore has assigned it an
+    id. Since it forgets what the key has cached, this is the only way the
+    reference of an existing Key may be changed.
+
+    Args:
+      pb: entity_pb.Reference
+    """
+    self.__reference.CopyFrom(pb)
+    self.__encoded = None
+    self.__comparison = None
+    self.__hash = None
+
+  def __Encoded(self):
+    """Returns this Key's reference, encoded, and caches it.
+
+    Returns:
+      string
+    """
+    if self.__encoded is None:
+      self.__encoded = self.__reference.Encode()
+    return self.__encoded
+
+  def __Comparison(self):
+    """Returns the (app, encoded path) pair this Key compares by, and caches
+    it. The app is None for the local app, which matches any other app.
+
+    Returns:
+      tuple
+    """
+    if self.__comparison is None:
+      app = self.__reference.app()
+      if not app or app == _LOCAL_APP_ID.encode('utf-8'):
+        app = None
+      self.__comparison = (app, self.__reference.path().Encode())
+    return self.__comparison
+
+  def __getstate__(self):
+    """Returns the pickled state of this Key: just its reference."""
+    return {'_Key__reference': self.__reference}
+
+  def __setstate__(self, state):
+    """Restores a Key pickled by __getstate__.
+
+    Args:
+      state: dict
+    """
+    self.__reference = state['_Key__reference']
+    self.__encoded = None
+    self.__comparison = None
+    self.__hash = None
+
   def _ToPb(self):
     """Converts this Key to its protocol buffer representation.
 
@@ -397,7 +460,7 @@ class Key(object):
       string
     """
     if (self.has_id_or_name()):
-      encoded = base64.urlsafe_b64encode(self.__reference.Encode())
+      encoded = base64.urlsafe_b64encode(self.__Encoded())
       return encoded.replace('=', '')
     else:
       raise datastore_errors.BadKeyError(
@@ -432,26 +495,15 @@ class Key(object):
     Returns:
       bool
     """
-    if not isinstance(that, Key):
+    if self is that:
+      return True
+    elif not isinstance(that, Key):
       return False
 
-    if (self.app() in (_LOCAL_APP_ID, None) or
-        that.app() in (_LOCAL_APP_ID, None)):
-      orig_self_app = self.__reference.app()
-      self.__reference.clear_app()
-      orig_that_app = that.__reference.app()
-      that.__reference.clear_app()
-
-    ret = self.__reference.Equals(that.__reference)
-
-    if not self.__reference.has_app():
-      assert not that.__reference.has_app()
-      if orig_self_app:
-        self.__reference.set_app(orig_self_app)
-      if orig_that_app:
-        that.__reference.set_app(orig_that_app)
-
-    return ret
+    self_app, self_path = self.__Comparison()
+    that_app, that_path = that.__Comparison()
+    return (self_path == that_path and
+            (self_app is None or that_app is None or self_app == that_app))
 
   def __ne__(self, that):
     """Returns False if the argument is the same Key as this, True otherwise.
@@ -468,12 +520,18 @@ class Key(object):
     """Returns a 32-bit integer hash of this key.
 
     Implements Python's hash protocol so that Keys may be used in sets and as
-    dictionary keys.
+    dictionary keys. Only the path is hashed, since keys in different apps
+    may compare equal. Raises a BadKeyError if this key is incomplete.
 
     Returns:
       int
     """
-    return hash(self.__str__())
+    if self.__hash is None:
+      if not self.has_id_or_name():
+        raise datastore_errors.BadKeyError(
+          'Cannot hash an incomplete key!\n%s' % self.__reference)
+      self.__hash = hash(self.__Comparison()[1])
+    return self.__hash
 
 
 class Category(unicode):
@@ -895,10 +953,7 @@ def ToPropertyPb(name, values):
     # DoubleProperty, PointProperty, UserProperty, or ReferenceProperty.
     [entity_pb.*Property, ...]
   """
-  ValidateString(name, 'property name', datastore_errors.BadPropertyError)
-  if RESERVED_PROPERTY_NAME.match(name):
-    raise datastore_errors.BadPropertyError('%s is a reserved property name.' %
-                                            name)
+  ValidatePropertyName(name)
 
   if isinstance(values, tuple):
     raise datastore_errors.BadValueError(
@@ -939,63 +994,21 @@ def ToPropertyPb(name, values):
     raise datastore_errors.BadValueError(
       'Unsupported type for property %s: %s' % (name, proptype))
 
+  pack = _PACK_PROPERTY_VALUES[proptype]
+  encoded_name = name.encode('utf-8')
+  meaning = _PROPERTY_MEANINGS.get(proptype)
+
   pbs = []
   for v in values:
     pb = entity_pb.Property()
-    pb.set_name(name.encode('utf-8'))
+    pb.set_name(encoded_name)
     pb.set_multiple(multiple)
-    if _PROPERTY_MEANINGS.has_key(proptype):
-      pb.set_meaning(_PROPERTY_MEANINGS[proptype])
+    if meaning is not None:
+      pb.set_meaning(meaning)
 
     pbvalue = pb.mutable_value()
-    if v is None:
-      pass
-    elif isinstance(v, Blob):
-      pbvalue.set_stringvalue(v)
-    elif isinstance(v, (basestring, IM)):
-      if not isinstance(v, Text):
-        if isinstance(v, Link):
-          max_len = _MAX_LINK_PROPERTY_LENGTH
-        else:
-          max_len = _MAX_STRING_LENGTH
-        if len(v) > max_len:
-          raise datastore_errors.BadValueError(
-            'Property %s is %d bytes long; it must be %d or less. '
-            'Consider Text instead, which can store strings of any length.' %
-            (name, len(v), max_len))
-      pbvalue.set_stringvalue(unicode(v).encode('utf-8'))
-    elif isinstance(v, datetime.datetime):
-      if v.tzinfo:
-        v = v.astimezone(UTC)
-      pbvalue.set_int64value(
-        long(calendar.timegm(v.timetuple()) * 1000000L) + v.microsecond)
-    elif isinstance(v, GeoPt):
-      pbvalue.mutable_pointvalue().set_x(v.lat)
-      pbvalue.mutable_pointvalue().set_y(v.lon)
-    elif isinstance(v, users.User):
-      pbvalue.mutable_uservalue().set_email(v.email().encode('utf-8'))
-      pbvalue.mutable_uservalue().set_nickname(v.nickname().encode('utf-8'))
-      pbvalue.mutable_uservalue().set_auth_domain(
-        v.auth_domain().encode('utf-8'))
-      pbvalue.mutable_uservalue().set_gaiaid(0)
-    elif isinstance(v, Key):
-      ref = v._Key__reference
-      pbvalue.mutable_referencevalue().set_app(ref.app())
-      for elem in ref.path().element_list():
-        pbvalue.mutable_referencevalue().add_pathelement().CopyFrom(elem)
-    elif isinstance(v, bool):
-      pbvalue.set_booleanvalue(v)
-    elif isinstance(v, long):
-      pbvalue.set_int64value(v)
-      try:
-        pbvalue.Encode()
-      except ProtocolBuffer.ProtocolBufferEncodeError, e:
-        pbvalue.clear_int64value()
-        raise OverflowError(e)
-    elif isinstance(v, float):
-      pbvalue.set_doublevalue(v)
-    else:
-      assert False, "Shouldn't reach here; property type was validated above."
+    if v is not None:
+      pack(name, pbvalue, v)
 
     pbs.append(pb)
 
@@ -1005,6 +1018,184 @@ def ToPropertyPb(name, values):
     return pbs[0]
 
 
+def ValidatePropertyName(name):
+  """Raises BadPropertyError if name isn't a valid property name.
+
+  Names that pass are remembered, so checking the same names again is cheap.
+
+  Args:
+    name: string
+  """
+  if name.__class__ in (str, unicode) and name in _VALID_PROPERTY_NAMES:
+    return
+
+  ValidateString(name, 'property name', datastore_errors.BadPropertyError)
+  if RESERVED_PROPERTY_NAME.match(name):
+    raise datastore_errors.BadPropertyError('%s is a reserved property name.' %
+                                            name)
+
+  if len(_VALID_PROPERTY_NAMES) >= _MAX_VALID_PROPERTY_NAMES:
+    _VALID_PROPERTY_NAMES.clear()
+  _VALID_PROPERTY_NAMES[name] = True
+
+
+def PackPropertyValues(name, encoded_name, values):
+  """A faster ToPropertyPb() for values of a single, common type.
+
+  Doesn't validate the name, and only handles a value, or a non-empty list of
+  values, that all have exactly the same class. For anything else, returns
+  None, and the caller should use ToPropertyPb(), which does all of the checks
+  and raises the appropriate errors.
+
+  Args:
+    # the property name, already checked with ValidatePropertyName()
+    name: string
+    # the property name encoded as UTF-8
+    encoded_name: str
+    # a supported type, or a list of them
+    values: string, int, long, float, datetime, Key, or list
+
+  Returns:
+    # the property PBs, and whether they're raw properties (Blob or Text)
+    ([entity_pb.Property, ...], bool), or None
+  """
+  proptype = values.__class__
+  if proptype is not list:
+    pack = _PACK_PROPERTY_VALUES.get(proptype)
+    if pack is None or (proptype is Key and not values.has_id_or_name()):
+      return None
+    pb = entity_pb.Property()
+    pb.set_name(encoded_name)
+    pb.set_multiple(False)
+    meaning = _PROPERTY_MEANINGS.get(proptype)
+    if meaning is not None:
+      pb.set_meaning(meaning)
+    pack(name, pb.mutable_value(), values)
+    return [pb], proptype in (Blob, Text)
+
+  if not values:
+    return None
+
+  proptype = values[0].__class__
+  pack = _PACK_PROPERTY_VALUES.get(proptype)
+  if pack is None:
+    return None
+  for v in values:
+    if v.__class__ is not proptype:
+      return None
+  if proptype is Key:
+    for v in values:
+      if not v.has_id_or_name():
+        return None
+
+  meaning = _PROPERTY_MEANINGS.get(proptype)
+  pbs = []
+  for v in values:
+    pb = entity_pb.Property()
+    pb.set_name(encoded_name)
+    pb.set_multiple(True)
+    if meaning is not None:
+      pb.set_meaning(meaning)
+    pack(name, pb.mutable_value(), v)
+    pbs.append(pb)
+
+  return pbs, proptype in (Blob, Text)
+
+
+def _PackString(name, pbvalue, value, max_len=_MAX_STRING_LENGTH):
+  if len(value) > max_len:
+    raise datastore_errors.BadValueError(
+      'Property %s is %d bytes long; it must be %d or less. '
+      'Consider Text instead, which can store strings of any length.' %
+      (name, len(value), max_len))
+  pbvalue.set_stringvalue(unicode(value).encode('utf-8'))
+
+
+def _PackLink(name, pbvalue, value):
+  _PackString(name, pbvalue, value, _MAX_LINK_PROPERTY_LENGTH)
+
+
+def _PackText(name, pbvalue, value):
+  pbvalue.set_stringvalue(unicode(value).encode('utf-8'))
+
+
+def _PackBlob(name, pbvalue, value):
+  pbvalue.set_stringvalue(value)
+
+
+def _PackDatetime(name, pbvalue, value):
+  if value.tzinfo:
+    value = value.astimezone(UTC)
+  pbvalue.set_int64value(
+    long(calendar.timegm(value.timetuple()) * 1000000L) + value.microsecond)
+
+
+def _PackGeoPt(name, pbvalue, value):
+  pbvalue.mutable_pointvalue().set_x(value.lat)
+  pbvalue.mutable_pointvalue().set_y(value.lon)
+
+
+def _PackUser(name, pbvalue, value):
+  pbvalue.mutable_uservalue().set_email(value.email().encode('utf-8'))
+  pbvalue.mutable_uservalue().set_nickname(value.nickname().encode('utf-8'))
+  pbvalue.mutable_uservalue().set_auth_domain(
+    value.auth_domain().encode('utf-8'))
+  pbvalue.mutable_uservalue().set_gaiaid(0)
+
+
+def _PackKey(name, pbvalue, value):
+  ref = value._Key__reference
+  pbvalue.mutable_referencevalue().set_app(ref.app())
+  for elem in ref.path().element_list():
+    pbvalue.mutable_referencevalue().add_pathelement().CopyFrom(elem)
+
+
+def _PackBool(name, pbvalue, value):
+  pbvalue.set_booleanvalue(value)
+
+
+def _PackInteger(name, pbvalue, value):
+  if value < -0x8000000000000000 or value > 0x7fffffffffffffff:
+    raise OverflowError('int64 too big')
+  pbvalue.set_int64value(value)
+
+
+def _PackFloat(name, pbvalue, value):
+  pbvalue.set_doublevalue(value)
+
+
+def _PackNone(name, pbvalue, value):
+  pass
+
+
+_PACK_PROPERTY_VALUES = {
+  str:               _PackString,
+  unicode:           _PackString,
+  Category:          _PackString,
+  Email:             _PackString,
+  IM:                _PackString,
+  PhoneNumber:       _PackString,
+  PostalAddress:     _PackString,
+  Link:              _PackLink,
+  Text:              _PackText,
+  Blob:              _PackBlob,
+  datetime.datetime: _PackDatetime,
+  GeoPt:             _PackGeoPt,
+  users.User:        _PackUser,
+  Key:               _PackKey,
+  bool:              _PackBool,
+  int:               _PackInteger,
+  long:              _PackInteger,
+  Rating:            _PackInteger,
+  float:             _PackFloat,
+  type(None):        _PackNone,
+  }
+
+_VALID_PROPERTY_NAMES = {}
+
+_MAX_VALID_PROPERTY_NAMES = 10000
+
+
 def FromReferenceProperty(value):
   """Converts a reference PropertyValue to a Key. Raises BadValueError is prop
   is not a PropertyValue.
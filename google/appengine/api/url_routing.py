@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+#
+# Copyright 2007 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Finds the first of an ordered list of URL patterns that matches a URL.
+
+Both the development app server's URLMatcher and webapp's WSGIApplication
+map URLs to handlers by trying a list of regular expressions in order. Trying
+each one from Python costs time proportional to the number of routes, so
+RouteTable compiles them into:
+
+  - a dict of the routes that match a single literal URL,
+  - a dict of routes keyed by the first path segment of their literal prefix,
+    e.g. '/static/' for '/static/(.*)', so only routes that can possibly
+    match a URL are tried,
+  - a few large alternations of the remaining routes, each route wrapped in
+    a named group, so the regular expression engine tries them in one call.
+
+The route that RouteTable.Match() returns is always the first one in the
+original list that matches, as with trying them in order.
+"""
+
+
+
+
+
+import re
+import sre_constants
+import sre_parse
+
+
+_MAX_GROUPS = 99
+
+
+def _LiteralPrefix(regex):
+  """Finds the literal text that every match of a regular expression starts with.
+
+  Args:
+    regex: compiled regular expression, as from re.compile()
+
+  Returns:
+    (prefix, exact) tuple. prefix is a string, possibly empty. exact is True
+    if the expression matches nothing but prefix, or prefix followed by a
+    newline as '$' allows.
+  """
+  if regex.flags:
+    return '', False
+  try:
+    items = list(sre_parse.parse(regex.pattern))
+  except (sre_constants.error, AssertionError):
+    return '', False
+
+  if isinstance(regex.pattern, unicode):
+    to_char = unichr
+  else:
+    to_char = chr
+
+  position = 0
+  if items and items[0] == (sre_constants.AT, sre_constants.AT_BEGINNING):
+    position = 1
+  chars = []
+  while (position < len(items) and
+         items[position][0] == sre_constants.LITERAL):
+    chars.append(to_char(items[position][1]))
+    position += 1
+
+  exact = (position == len(items) - 1 and
+           items[position] == (sre_constants.AT, sre_constants.AT_END))
+  return ''.join(chars), exact
+
+
+def _SegmentKey(url):
+  """Returns the first path segment of a URL, e.g. '/static/', or None."""
+  end = url.find('/', 1)
+  if end < 0:
+    return None
+  return url[:end + 1]
+
+
+def _CanMerge(regex):
+  """Returns True if a regular expression can be part of an alternation.
+
+  Expressions with flags apply them to the whole alternation, named groups
+  would clash with the ones RouteTable adds, and group references would
+  refer to the wrong groups once the groups are renumbered.
+  """
+  if regex.flags or regex.groupindex:
+    return False
+  pattern = regex.pattern
+  for index in xrange(len(pattern) - 1):
+    if pattern[index] == '\\' and pattern[index + 1].isdigit():
+      return False
+  return '(?P=' not in pattern and '(?(' not in pattern
+
+
+class RouteTable(object):
+  """Matches URLs against an ordered list of regular expressions.
+
+  Matching a URL gives the same result as calling match() on each expression
+  in turn and stopping at the first that matches.
+  """
+
+  def __init__(self, regexes):
+    """Initializer.
+
+    Args:
+      regexes: list of compiled regular expressions, as from re.compile(),
+        in the order they should be tried. They are matched with match(), so
+        they are anchored at the start of the URL.
+    """
+    self.__regexes = list(regexes)
+    self.__exact = {}
+    general = []
+    prefixed = {}
+
+    for index, regex in enumerate(self.__regexes):
+      prefix, exact = _LiteralPrefix(regex)
+      if exact:
+        self.__exact.setdefault(prefix, index)
+        continue
+      key = _SegmentKey(prefix)
+      if key is None:
+        general.append(index)
+      else:
+        prefixed.setdefault(key, []).append(index)
+
+    self.__general = self.__Compile(general)
+    self.__prefixed = {}
+    for key, indexes in prefixed.iteritems():
+      self.__prefixed[key] = self.__Compile(indexes)
+
+  def __Compile(self, indexes):
+    """Compiles routes into as few regular expressions as possible.
+
+    Args:
+      indexes: list of ints, indexes of the routes in increasing order
+
+    Returns:
+      list of (first_index, regex, index) tuples in route order. If index is
+      None, regex is an alternation of the routes from first_index on and
+      the name of the group that matched, e.g. '_12', gives the route;
+      otherwise regex is the route's own expression.
+    """
+    chunks = []
+    patterns = []
+    first_index = None
+    groups = 0
+
+    def Flush():
+      if patterns:
+        chunks.append((first_index, re.compile('|'.join(patterns)), None))
+        del patterns[:]
+
+    for index in indexes:
+      regex = self.__regexes[index]
+      if not _CanMerge(regex) or regex.groups + 1 > _MAX_GROUPS:
+        Flush()
+        chunks.append((index, regex, index))
+        continue
+      if groups + regex.groups + 1 > _MAX_GROUPS:
+        Flush()
+      if not patterns:
+        first_index = index
+        groups = 0
+      patterns.append('(?P<_%d>%s)' % (index, regex.pattern))
+      groups += regex.groups + 1
+    Flush()
+    return chunks
+
+  def __FirstMatch(self, chunks, url, limit):
+    """Finds the first route in chunks that matches a URL.
+
+    Args:
+      chunks: list, as returned by __Compile()
+      url: string
+      limit: int, the index of a route already known to match, or None
+
+    Returns:
+      int, the index of the first matching route if it comes before limit,
+      otherwise None
+    """
+    for first_index, regex, index in chunks:
+      if limit is not None and first_index >= limit:
+        return None
+      match = regex.match(url)
+      if match:
+        if index is None:
+          index = int(match.lastgroup[1:])
+        if limit is None or index < limit:
+          return index
+        return None
+    return None
+
+  def Match(self, url):
+    """Finds the first route that matches a URL.
+
+    Args:
+      url: string
+
+    Returns:
+      (index, match) tuple, where index is the position of the route in the
+      list given to the initializer and match is the match object its
+      expression returns for url, or (None, None) if no route matches.
+    """
+    best = self.__exact.get(url)
+    if url.endswith('\n'):
+      stripped = self.__exact.get(url[:-1])
+      if stripped is not None and (best is None or stripped < best):
+        best = stripped
+
+    key = _SegmentKey(url)
+    if key is not None and key in self.__prefixed:
+      index = self.__FirstMatch(self.__prefixed[key], url, best)
+      if index is not None:
+        best = index
+
+    index = self.__FirstMatch(self.__general, url, best)
+    if index is not None:
+      best = index
+
+    if best is None:
+      return None, None
+    return best, self.__regexes[best].match(url)
@@ -0,0 +1,1046 @@
+#!/usr/bin/env python
+#
+# Copyright 2007 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Query primitives shared by the datastore stubs.
+
+Queries are compiled into plain Python callables that work directly on stored
+entity_pb.EntityProto instances, so the stubs never need to convert entities
+to datastore.Entity objects (or eval() anything) just to filter and sort them.
+
+Property values are compared through PropertyValueKey(), which maps an
+entity_pb.PropertyValue to a tuple. Values are grouped by type first, in this
+order:
+
+  null < numbers (ints, longs, floats, datetimes, ratings) < bool < string
+       < point < user < reference
+
+and then sorted by value within each type. Integers and doubles share a group
+and compare numerically, which keeps the old stubs' eval() comparison of ints
+and floats: filtering a float property with an int literal, or the reverse,
+works as it does in Python. This is not the order the production datastore
+uses, since it keeps doubles apart from integers instead of comparing them.
+
+PropertyIndex keeps the values of a single property in this order, so the
+stubs can answer filters on that property with a bisection instead of a scan.
+CompositeIndexTable does the same for the rows of a composite index, which
+also answers the query's sort orders.
+
+EncodePropertyValue() and EncodePath() map values and keys onto byte strings
+that sort in the same order, for stubs that keep their indexes in a database.
+
+LazyEntityProto parses stored entities without decoding their properties
+until something reads them, and DecodeEntityKey() decodes nothing but the
+key, for stubs that keep entities encoded.
+"""
+
+
+
+
+
+import array
+import bisect
+import heapq
+import itertools
+import operator
+import struct
+import time
+
+from google.appengine.api import datastore_admin
+from google.appengine.datastore import datastore_index
+from google.appengine.datastore import datastore_pb
+from google.appengine.datastore import entity_pb
+from google.net.proto import ProtocolBuffer
+
+
+_NULL_TAG = 0
+
+_OPERATORS = {
+  datastore_pb.Query_Filter.LESS_THAN:             operator.lt,
+  datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL:    operator.le,
+  datastore_pb.Query_Filter.GREATER_THAN:          operator.gt,
+  datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL: operator.ge,
+  datastore_pb.Query_Filter.EQUAL:                 operator.eq,
+  }
+
+
+def PropertyValueKey(value):
+  """Returns a comparable key for a property value.
+
+  Integer and double values are both keyed under the int64 tag, so they
+  compare numerically with each other.
+
+  Reference values are compared by path only. A stub only serves a single app,
+  and keys built on the client may still carry the local app placeholder.
+
+  Args:
+    value: entity_pb.PropertyValue
+
+  Returns:
+    tuple
+  """
+  if value.has_int64value():
+    return (entity_pb.PropertyValue.kint64Value, value.int64value())
+  elif value.has_booleanvalue():
+    return (entity_pb.PropertyValue.kbooleanValue, bool(value.booleanvalue()))
+  elif value.has_stringvalue():
+    return (entity_pb.PropertyValue.kstringValue, value.stringvalue())
+  elif value.has_doublevalue():
+    return (entity_pb.PropertyValue.kint64Value, value.doublevalue())
+  elif value.has_pointvalue():
+    point = value.pointvalue()
+    return (entity_pb.PropertyValue.kPointValueGroup, point.x(), point.y())
+  elif value.has_uservalue():
+    user = value.uservalue()
+    return (entity_pb.PropertyValue.kUserValueGroup, user.email(),
+            user.auth_domain())
+  elif value.has_referencevalue():
+    return (entity_pb.PropertyValue.kReferenceValueGroup,
+            _PathKey(value.referencevalue().pathelement_list()))
+  else:
+    return (_NULL_TAG,)
+
+
+def SortValueKey(value_keys):
+  """Returns the value key an entity is sorted by for one sort order.
+
+  An entity with several values for an order property is sorted by its
+  lowest value, whether the order is ascending or descending.
+  SORT_VALUE_SQL_AGGREGATE is the same rule for stubs that sort encoded
+  values in SQL.
+
+  Args:
+    value_keys: non-empty list of tuples, as returned by PropertyValueKeys()
+
+  Returns:
+    tuple
+  """
+  return min(value_keys)
+
+SORT_VALUE_SQL_AGGREGATE = 'MIN'
+
+
+def _PathKey(elements):
+  """Returns a comparable key for a list of path elements.
+
+  Elements with ids sort before elements with names, as in the datastore.
+
+  Args:
+    elements: list of entity_pb.Path_Element or
+        entity_pb.PropertyValue_ReferenceValuePathElement
+
+  Returns:
+    tuple
+  """
+  key = []
+  for elem in elements:
+    if elem.has_name():
+      key.append((elem.type(), 1, elem.name()))
+    else:
+      key.append((elem.type(), 0, elem.id()))
+  return tuple(key)
+
+
+def PropertyValueKeys(entity, name):
+  """Returns the keys of all values of the named property in an entity.
+
+  Only indexed properties are considered; raw (Blob and Text) properties can't
+  be filtered or sorted on.
+
+  Args:
+    entity: entity_pb.EntityProto
+    name: string, the UTF-8 encoded property name
+
+  Returns:
+    list of tuples, empty if the entity doesn't have the property
+  """
+  return [PropertyValueKey(prop.value()) for prop in entity.property_list()
+          if prop.name() == name]
+
+
+def _EncodeString(value):
+  """Returns an order-preserving encoding of a byte string.
+
+  Null bytes are escaped as '\\x00\\xff' and the string is terminated with
+  '\\x00\\x01', so no encoded string is a prefix of another.
+  """
+  return value.replace('\x00', '\x00\xff') + '\x00\x01'
+
+
+def _EncodeInt64(value):
+  """Returns an order-preserving encoding of a signed 64-bit integer.
+  """
+  return struct.pack('>Q', value + 0x8000000000000000)
+
+
+def _EncodeDouble(value):
+  """Returns an order-preserving encoding of a double.
+
+  Positive doubles get their sign bit set, negative doubles have all of their
+  bits flipped, so that the big-endian IEEE 754 bytes sort numerically.
+  Negative zero is encoded as zero, since they compare equal.
+  """
+  if value == 0:
+    value = 0.0
+  bits, = struct.unpack('>Q', struct.pack('>d', value))
+  if bits & 0x8000000000000000:
+    bits ^= 0xffffffffffffffff
+  else:
+    bits |= 0x8000000000000000
+  return struct.pack('>Q', bits)
+
+
+def _EncodeNumber(value):
+  """Returns an order-preserving encoding of an int or a float.
+
+  Ints and floats are encoded alike, so they sort numerically with each
+  other and equal numbers, e.g. 3 and 3.0, have equal encodings. The number
+  is encoded as the nearest double, followed by the integer difference
+  between the number and that double. The difference keeps ints that don't
+  fit in a double in order, and is always zero for floats.
+  """
+  if isinstance(value, float):
+    remainder = 0
+  else:
+    remainder = value - long(float(value))
+  return _EncodeDouble(float(value)) + _EncodeInt64(remainder)
+
+
+def EncodePath(elements):
+  """Returns a byte string that sorts in the same order as _PathKey().
+
+  The encoding of an ancestor's path is a prefix of the encodings of all of its
+  descendants' paths, and no encoded path continues with a '\\xff' byte, so
+  the descendants of an ancestor are exactly the paths in
+  [EncodePath(ancestor), EncodePath(ancestor) + '\\xff').
+
+  Args:
+    elements: list of entity_pb.Path_Element or
+        entity_pb.PropertyValue_ReferenceValuePathElement
+
+  Returns:
+    string
+  """
+  encoded = []
+  for elem in elements:
+    encoded.append(_EncodeString(elem.type()))
+    if elem.has_name():
+      encoded.append('\x01' + _EncodeString(elem.name()))
+    else:
+      encoded.append('\x00' + _EncodeInt64(elem.id()))
+  return ''.join(encoded)
+
+
+def EncodePropertyValue(value):
+  """Returns a byte string that sorts in the same order as PropertyValueKey().
+
+  Args:
+    value: entity_pb.PropertyValue
+
+  Returns:
+    string
+  """
+  if value.has_int64value():
+    return (chr(entity_pb.PropertyValue.kint64Value) +
+            _EncodeNumber(value.int64value()))
+  elif value.has_booleanvalue():
+    return (chr(entity_pb.PropertyValue.kbooleanValue) +
+            chr(bool(value.booleanvalue())))
+  elif value.has_stringvalue():
+    return (chr(entity_pb.PropertyValue.kstringValue) +
+            _EncodeString(value.stringvalue()))
+  elif value.has_doublevalue():
+    return (chr(entity_pb.PropertyValue.kint64Value) +
+            _EncodeNumber(value.doublevalue()))
+  elif value.has_pointvalue():
+    point = value.pointvalue()
+    return (chr(entity_pb.PropertyValue.kPointValueGroup) +
+            _EncodeDouble(point.x()) + _EncodeDouble(point.y()))
+  elif value.has_uservalue():
+    user = value.uservalue()
+    return (chr(entity_pb.PropertyValue.kUserValueGroup) +
+            _EncodeString(user.email()) + _EncodeString(user.auth_domain()))
+  elif value.has_referencevalue():
+    return (chr(entity_pb.PropertyValue.kReferenceValueGroup) +
+            EncodePath(value.referencevalue().pathelement_list()))
+  else:
+    return chr(_NULL_TAG)
+
+
+def CompileFilter(filt):
+  """Compiles a query filter into a predicate.
+
+  The predicate returns True if any value of the entity's property compares
+  true against any of the filter's values.
+
+  Args:
+    filt: datastore_pb.Query_Filter, with any operator but IN and EXISTS
+
+  Returns:
+    a function that takes an entity_pb.EntityProto and returns a bool
+  """
+  op = _OPERATORS[filt.op()]
+  name = filt.property(0).name()
+  filter_keys = [PropertyValueKey(prop.value())
+                 for prop in filt.property_list()]
+
+  if len(filter_keys) == 1:
+    filter_key = filter_keys[0]
+
+    def passes(entity):
+      for prop in entity.property_list():
+        if prop.name() == name and op(PropertyValueKey(prop.value()),
+                                      filter_key):
+          return True
+      return False
+  else:
+    def passes(entity):
+      for prop in entity.property_list():
+        if prop.name() == name:
+          value_key = PropertyValueKey(prop.value())
+          for filter_key in filter_keys:
+            if op(value_key, filter_key):
+              return True
+      return False
+
+  return passes
+
+
+def CompileAncestor(ancestor):
+  """Compiles an ancestor restriction into a predicate.
+
+  Args:
+    ancestor: entity_pb.Reference
+
+  Returns:
+    a function that takes an entity_pb.EntityProto and returns True if the
+    entity is the ancestor or one of its descendants
+  """
+  ancestor_key = _PathKey(ancestor.path().element_list())
+  depth = len(ancestor_key)
+
+  def is_descendant(entity):
+    path = entity.key().path().element_list()
+    return (len(path) >= depth and
+            _PathKey(path[:depth]) == ancestor_key)
+
+  return is_descendant
+
+
+def CompileQuery(query):
+  """Compiles a query's ancestor and filters into a list of predicates.
+
+  Args:
+    query: datastore_pb.Query
+
+  Returns:
+    list of functions that take an entity_pb.EntityProto and return a bool.
+    An entity matches the query if it passes all of them.
+  """
+  predicates = []
+  if query.has_ancestor():
+    predicates.append(CompileAncestor(query.ancestor()))
+
+  for filt in query.filter_list():
+    assert filt.op() != datastore_pb.Query_Filter.IN
+    predicates.append(CompileFilter(filt))
+
+  return predicates
+
+
+def FindCompositeIndex(indexes, required_index):
+  """Finds a composite index that can serve a query.
+
+  Args:
+    indexes: list of entity_pb.CompositeIndex
+    required_index: the tuple returned by
+        datastore_index.CompositeIndexForQuery() for the query
+
+  Returns:
+    entity_pb.CompositeIndex, if one of the indexes matches; otherwise None
+  """
+  kind, ancestor, props, num_eq_filters = required_index
+  required_key = kind, ancestor, props
+  eq_filters_set = set(props[:num_eq_filters])
+  remaining_filters = props[num_eq_filters:]
+
+  for index in indexes:
+    definition = datastore_admin.ProtoToIndexDefinition(index)
+    index_key = datastore_index.IndexToKey(definition)
+    if required_key == index_key:
+      return index
+    if num_eq_filters > 1 and (kind, ancestor) == index_key[:2]:
+      this_props = index_key[2]
+      this_eq_filters_set = set(this_props[:num_eq_filters])
+      this_remaining_filters = this_props[num_eq_filters:]
+      if (eq_filters_set == this_eq_filters_set and
+          remaining_filters == this_remaining_filters):
+        return index
+
+  return None
+
+
+def FilterEntities(entities, predicates):
+  """Returns the entities that pass all of the given predicates.
+
+  The entities are filtered lazily, as the returned iterator is consumed.
+
+  Args:
+    entities: iterable of entity_pb.EntityProto
+    predicates: list of functions, as returned by CompileQuery()
+
+  Returns:
+    iterator of entity_pb.EntityProto
+  """
+  results = iter(entities)
+  for predicate in predicates:
+    results = itertools.ifilter(predicate, results)
+  return results
+
+
+def SortEntities(entities, orders, limit=None):
+  """Sorts entities according to the given sort orders.
+
+  Entities with multiple values for an order property are sorted by
+  SortValueKey(). Entities that don't have an order property are removed, since
+  a sort order implies an existence filter. Entities that compare equal keep
+  their relative order.
+
+  Each entity's sort key is computed once. If a limit is given, only the
+  first limit entities are kept, using a heap, so sorting n entities costs
+  O(n log limit) instead of O(n log n).
+
+  Args:
+    entities: iterable of entity_pb.EntityProto
+    orders: list of datastore_pb.Query_Order
+    limit: int, optional, the number of entities to return
+
+  Returns:
+    list of entity_pb.EntityProto. If there are no orders, an iterator over
+    entities instead, which is consumed lazily.
+  """
+  if not orders:
+    if limit is None:
+      return iter(entities)
+    return itertools.islice(entities, limit)
+
+  order_specs = [(order.property(),
+                  order.direction() == datastore_pb.Query_Order.DESCENDING)
+                 for order in orders]
+  decorated = _DecorateWithSortKeys(entities, order_specs)
+
+  get_sort_key = operator.itemgetter(0)
+  if limit is None:
+    decorated = sorted(decorated, key=get_sort_key)
+  else:
+    decorated = heapq.nsmallest(limit, decorated, key=get_sort_key)
+
+  return [entity for sort_key, entity in decorated]
+
+
+def _DecorateWithSortKeys(entities, order_specs):
+  """Yields a (sort key, entity) tuple for each entity that has all of the
+  order properties.
+
+  Args:
+    entities: iterable of entity_pb.EntityProto
+    order_specs: list of (property name, bool descending) tuples
+  """
+  for entity in entities:
+    sort_key = []
+    for name, descending in order_specs:
+      value_keys = PropertyValueKeys(entity, name)
+      if not value_keys:
+        break
+      if descending:
+        sort_key.append(_Descending(SortValueKey(value_keys)))
+      else:
+        sort_key.append(SortValueKey(value_keys))
+    else:
+      yield tuple(sort_key), entity
+
+
+class _MaxKey(object):
+  """Sorts after every other value. Used as an upper bisect bound."""
+
+  def __cmp__(self, other):
+    if other is self:
+      return 0
+    return 1
+
+_MAX_KEY = _MaxKey()
+
+
+class _Descending(object):
+  """Wraps a value key so that it sorts in reverse order."""
+
+  __slots__ = ('key',)
+
+  def __init__(self, key):
+    self.key = key
+
+  def __cmp__(self, other):
+    if other is _MAX_KEY:
+      return -1
+    return cmp(other.key, self.key)
+
+
+_REVERSED_OPERATORS = {
+  datastore_pb.Query_Filter.LESS_THAN:
+      datastore_pb.Query_Filter.GREATER_THAN,
+  datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL:
+      datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL,
+  datastore_pb.Query_Filter.GREATER_THAN:
+      datastore_pb.Query_Filter.LESS_THAN,
+  datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL:
+      datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL,
+  datastore_pb.Query_Filter.EQUAL:
+      datastore_pb.Query_Filter.EQUAL,
+  }
+
+
+def _RangeBounds(rows, prefix, op, key, start, end):
+  """Narrows a range of sorted rows by comparing one row key component.
+
+  Args:
+    rows: sorted list of (row key, path key, entity) tuples
+    prefix: tuple, the row key components that all rows in the range share
+    op: datastore_pb.Query_Filter operator, applied to the component after
+        the prefix
+    key: the value to compare that component to
+    start, end: int, the range of rows to narrow
+
+  Returns:
+    (start, end) tuple of row offsets
+  """
+  if op in (datastore_pb.Query_Filter.EQUAL,
+            datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL,
+            datastore_pb.Query_Filter.LESS_THAN):
+    split = bisect.bisect_left(rows, (prefix + (key,),), start, end)
+  else:
+    split = bisect.bisect_left(rows, (prefix + (key, _MAX_KEY),), start, end)
+
+  if op == datastore_pb.Query_Filter.EQUAL:
+    return split, bisect.bisect_left(rows, (prefix + (key, _MAX_KEY),),
+                                     split, end)
+  elif op in (datastore_pb.Query_Filter.LESS_THAN,
+              datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL):
+    return start, split
+  else:
+    return split, end
+
+
+class _IndexTable(object):
+  """Base class for the sorted row tables that back the stub indexes.
+
+  Each row is a (row key, path key, entity) tuple, where the row key is a
+  tuple of comparable components and the path key is the _PathKey() of the
+  entity's key. Rows are sorted, so the entities that match a query on the
+  leading row key components form one contiguous run of rows that can be
+  found by bisection. Subclasses define the row keys an entity is indexed
+  under by implementing _RowKeys().
+
+  A stub that doesn't keep its entities as entity_pb.EntityProto, e.g. keeps
+  them encoded, passes a function that converts them. The table then holds
+  and returns entities in the stub's form, and only converts them to work out
+  their rows.
+  """
+
+  def __init__(self, entities=(), load=None):
+    """Constructor. Builds the table from the given entities.
+
+    Args:
+      entities: iterable of stored entities
+      load: function that takes a stored entity and returns it as an
+          entity_pb.EntityProto, or None if entities are stored as
+          entity_pb.EntityProto
+    """
+    self.__load = load
+    self._rows = []
+    for entity in entities:
+      self._rows.extend(self.__Rows(entity))
+    self._rows.sort()
+
+  def _RowKeys(self, entity):
+    """Returns the distinct row keys for an entity.
+
+    Args:
+      entity: entity_pb.EntityProto
+
+    Returns:
+      set of tuples
+    """
+    raise NotImplementedError()
+
+  def __Rows(self, stored):
+    """Returns the rows for a stored entity, sorted.
+    """
+    if self.__load is None:
+      entity = stored
+    else:
+      entity = self.__load(stored)
+    path_key = _PathKey(entity.key().path().element_list())
+    return sorted([(row_key, path_key, stored)
+                   for row_key in self._RowKeys(entity)])
+
+  def __len__(self):
+    return len(self._rows)
+
+  def Add(self, entity):
+    """Adds an entity's rows to the table. The entity must not already be in
+    the table; Remove() the old version of an entity before adding a new one.
+
+    Args:
+      entity: stored entity
+    """
+    for row in self.__Rows(entity):
+      bisect.insort(self._rows, row)
+
+  def Remove(self, entity):
+    """Removes an entity's rows from the table, if there are any.
+
+    Args:
+      entity: stored entity
+    """
+    for row in self.__Rows(entity):
+      i = bisect.bisect_left(self._rows, row[:2])
+      if i < len(self._rows) and self._rows[i][:2] == row[:2]:
+        del self._rows[i]
+
+  def Entities(self, start, end):
+    """Returns the entities in a range of rows, without duplicates, in row
+    order.
+
+    The range is copied right away, so later changes to the table don't
+    affect the results, but the entities are produced lazily.
+
+    Args:
+      start, end: int row offsets, as returned by Bounds()
+
+    Returns:
+      iterator of stored entities
+    """
+    return self.__UniqueEntities(self._rows[start:end])
+
+  def __UniqueEntities(self, rows):
+    """Yields the entity in each row, skipping entities already yielded.
+    """
+    seen = set()
+    for row_key, path_key, entity in rows:
+      if path_key not in seen:
+        seen.add(path_key)
+        yield entity
+
+
+class PropertyIndex(_IndexTable):
+  """A sorted index over the values of one property of one kind.
+
+  The row key is a 1-tuple holding the PropertyValueKey() of one of the
+  entity's values. An entity has one row for each distinct value of the
+  property, and no rows if it doesn't have the property.
+  """
+
+  def __init__(self, name, entities=(), load=None):
+    """Constructor. Builds the index over the given entities.
+
+    Args:
+      name: string, the UTF-8 encoded property name
+      entities: iterable of stored entities
+      load: as for _IndexTable
+    """
+    self.__name = name
+    _IndexTable.__init__(self, entities, load)
+
+  def _RowKeys(self, entity):
+    return set([(value_key,)
+                for value_key in PropertyValueKeys(entity, self.__name)])
+
+  def Bounds(self, filt):
+    """Returns the range of rows that match a filter on this property.
+
+    Args:
+      filt: datastore_pb.Query_Filter, with any operator but IN and EXISTS
+
+    Returns:
+      (start, end) tuple of row offsets
+    """
+    filter_key = PropertyValueKey(filt.property(0).value())
+    return _RangeBounds(self._rows, (), filt.op(), filter_key,
+                        0, len(self._rows))
+
+
+class CompositeIndexTable(_IndexTable):
+  """The materialized rows of a composite index.
+
+  The row key holds one component per index property, in index order: the
+  PropertyValueKey() of one of the entity's values for that property,
+  wrapped in _Descending for descending properties. Multi-valued properties
+  produce one row for every combination of values, as in the datastore.
+
+  Ancestor indexes have an extra leading component, the path key of one of
+  the entity's ancestors, and one set of rows for each ancestor (including
+  the entity itself).
+  """
+
+  def __init__(self, definition, entities=(), load=None):
+    """Constructor. Builds the index over the given entities.
+
+    Args:
+      definition: entity_pb.Index
+      entities: iterable of stored entities
+      load: as for _IndexTable
+    """
+    self.__ancestor = definition.ancestor()
+    self.__properties = [(prop.name(), prop.direction())
+                         for prop in definition.property_list()]
+    _IndexTable.__init__(self, entities, load)
+
+  def __ComponentKeys(self, entity, name, direction):
+    """Returns the distinct row key components for one index property.
+    """
+    keys = set(PropertyValueKeys(entity, name))
+    if direction == entity_pb.Index_Property.DESCENDING:
+      return [_Descending(key) for key in keys]
+    else:
+      return list(keys)
+
+  def _RowKeys(self, entity):
+    if self.__ancestor:
+      path = entity.key().path().element_list()
+      row_keys = [(_PathKey(path[:i]),) for i in xrange(1, len(path) + 1)]
+    else:
+      row_keys = [()]
+
+    for name, direction in self.__properties:
+      components = self.__ComponentKeys(entity, name, direction)
+      row_keys = [row_key + (component,)
+                  for row_key in row_keys for component in components]
+      if not row_keys:
+        break
+
+    return set(row_keys)
+
+  def Bounds(self, query):
+    """Returns the range of rows that match a query.
+
+    The query's ancestor and equality filters must match a prefix of the
+    index, and its inequality filters, if any, the property after that.
+    Those filters are answered by the returned range; the rows in the range
+    are in the order the query asks for.
+
+    Args:
+      query: datastore_pb.Query, served by this index
+
+    Returns:
+      (start, end) tuple of row offsets, or None if the index can't serve the
+      query.
+    """
+    eq_keys = {}
+    ineq_filters = []
+    for filt in query.filter_list():
+      name = filt.property(0).name()
+      if filt.op() == datastore_pb.Query_Filter.EQUAL:
+        if name in eq_keys:
+          return None
+        eq_keys[name] = PropertyValueKey(filt.property(0).value())
+      elif filt.op() in _REVERSED_OPERATORS:
+        ineq_filters.append(filt)
+      else:
+        return None
+
+    if self.__ancestor != query.has_ancestor():
+      return None
+
+    prefix = ()
+    if self.__ancestor:
+      prefix += (_PathKey(query.ancestor().path().element_list()),)
+
+    properties = self.__properties[:]
+    while properties and properties[0][0] in eq_keys:
+      name, direction = properties.pop(0)
+      key = eq_keys.pop(name)
+      if direction == entity_pb.Index_Property.DESCENDING:
+        key = _Descending(key)
+      prefix += (key,)
+
+    if eq_keys:
+      return None
+
+    if prefix:
+      start = bisect.bisect_left(self._rows, (prefix,))
+      end = bisect.bisect_left(self._rows, (prefix + (_MAX_KEY,),), start)
+    else:
+      start, end = 0, len(self._rows)
+
+    if ineq_filters:
+      ineq_name = ineq_filters[0].property(0).name()
+      if not properties or properties[0][0] != ineq_name:
+        return None
+      direction = properties[0][1]
+
+      for filt in ineq_filters:
+        key = PropertyValueKey(filt.property(0).value())
+        op = filt.op()
+        if direction == entity_pb.Index_Property.DESCENDING:
+          key = _Descending(key)
+          op = _REVERSED_OPERATORS[op]
+        start, end = _RangeBounds(self._rows, prefix, op, key, start, end)
+
+    return start, end
+
+
+class QueryCursor(object):
+  """The pending results of a query, produced on demand.
+
+  Results are pulled from the underlying iterator one batch at a time, so a
+  query's memory use and time to first result scale with the batch size
+  rather than with the number of results. One result is always read ahead,
+  so that HasMore() is accurate.
+  """
+
+  def __init__(self, results):
+    """Constructor.
+
+    Args:
+      results: iterable of entity_pb.EntityProto, or of the stub's own form
+          of stored entities, e.g. encoded ones
+    """
+    self.__results = iter(results)
+    self.__lookahead = []
+    self.__Fill()
+    self.last_access = time.time()
+
+  def __Fill(self):
+    """Reads the next result into the lookahead, if there is one.
+    """
+    if not self.__lookahead:
+      for result in itertools.islice(self.__results, 1):
+        self.__lookahead.append(result)
+
+  def HasMore(self):
+    """Returns True if there are more results.
+    """
+    return bool(self.__lookahead)
+
+  def Next(self, count):
+    """Returns up to count more results.
+
+    Args:
+      count: int
+
+    Returns:
+      list of results, as given to the constructor
+    """
+    self.last_access = time.time()
+    if count <= 0:
+      return []
+    results = self.__lookahead
+    self.__lookahead = []
+    results.extend(itertools.islice(self.__results, count - len(results)))
+    self.__Fill()
+    return results
+
+  def Count(self):
+    """Consumes the remaining results and returns how many there were.
+    """
+    count = len(self.__lookahead)
+    self.__lookahead = []
+    for result in self.__results:
+      count += 1
+    return count
+
+
+def DecodeEntityKey(contents):
+  """Decodes the key of an encoded entity_pb.EntityProto, and nothing else.
+
+  Args:
+    contents: string
+
+  Returns:
+    entity_pb.Reference
+
+  Raises:
+    ProtocolBuffer.ProtocolBufferDecodeError if the entity has no key.
+  """
+  buf = array.array('B')
+  buf.fromstring(contents)
+  d = ProtocolBuffer.Decoder(buf, 0, len(buf))
+  while d.avail() > 0:
+    tt = d.getVarInt32()
+    if tt == 106:
+      length = d.getVarInt32()
+      key = entity_pb.Reference()
+      key.TryMerge(ProtocolBuffer.Decoder(buf, d.pos(), d.pos() + length))
+      return key
+    d.skipData(tt)
+  raise ProtocolBuffer.ProtocolBufferDecodeError, 'Entity has no key.'
+
+
+class LazyEntityProto(entity_pb.EntityProto):
+  """An EntityProto that only decodes its properties when they are used.
+
+  Parsing an encoded entity decodes its key, entity group, owner and kind
+  right away, but only records where its properties are in the encoded
+  string. They are decoded the first time property_ or raw_property_ is read,
+  e.g. through property_list(), and from then on the entity behaves like any
+  other EntityProto. Until then, encoding the entity copies the properties'
+  original bytes.
+
+  Properties are only left encoded if they are stored together, as
+  EntityProto.Encode() writes them. Otherwise they are decoded right away.
+  """
+
+  _PROPERTY_TAGS = (114, 122)
+
+  def __init__(self, contents=None):
+    self.__contents = None
+    self.__start = 0
+    self.__end = 0
+    entity_pb.EntityProto.__init__(self)
+    if contents is not None:
+      self.__LazyMergeFromString(contents)
+
+  def __LazyMergeFromString(self, contents):
+    """Parses an encoded entity, except for its properties.
+
+    Args:
+      contents: string
+    """
+    buf = array.array('B')
+    buf.fromstring(contents)
+    d = ProtocolBuffer.Decoder(buf, 0, len(buf))
+    start = end = None
+    while d.avail() > 0:
+      pos = d.pos()
+      tt = d.getVarInt32()
+      d.skipData(tt)
+      if tt in self._PROPERTY_TAGS:
+        if start is None:
+          start = pos
+        elif end != pos:
+          self.Clear()
+          entity_pb.EntityProto.MergeFromString(self, contents)
+          return
+        end = d.pos()
+      else:
+        entity_pb.EntityProto.TryMerge(
+            self, ProtocolBuffer.Decoder(buf, pos, d.pos()))
+
+    if start is not None:
+      self.__contents = contents
+      self.__start = start
+      self.__end = end
+      del self.property_
+      del self.raw_property_
+
+    dbg = []
+    if not self.IsInitialized(dbg):
+      raise ProtocolBuffer.ProtocolBufferDecodeError, '\n\t'.join(dbg)
+
+  def __getattr__(self, name):
+    if name in ('property_', 'raw_property_'):
+      self.__DecodeProperties()
+      return self.__dict__[name]
+    raise AttributeError(name)
+
+  def __DecodeProperties(self):
+    """Decodes the properties, and drops the encoded entity.
+    """
+    self.lazy_init_lock_.acquire()
+    try:
+      if self.__contents is None:
+        return
+
+      buf = array.array('B')
+      buf.fromstring(self.__contents[self.__start:self.__end])
+      d = ProtocolBuffer.Decoder(buf, 0, len(buf))
+      lists = {114: [], 122: []}
+      while d.avail() > 0:
+        tt = d.getVarInt32()
+        length = d.getVarInt32()
+        tmp = ProtocolBuffer.Decoder(buf, d.pos(), d.pos() + length)
+        d.skip(length)
+        prop = entity_pb.Property()
+        prop.Merge(tmp)
+        lists[tt].append(prop)
+
+      if 'property_' not in self.__dict__:
+        self.property_ = lists[114]
+      if 'raw_property_' not in self.__dict__:
+        self.raw_property_ = lists[122]
+      self.__contents = None
+    finally:
+      self.lazy_init_lock_.release()
+
+  def __IsLazy(self):
+    """Returns True if neither property list has been decoded or replaced.
+    """
+    return ('property_' not in self.__dict__ and
+            'raw_property_' not in self.__dict__)
+
+  def IsInitialized(self, debug_strs=None):
+    if not self.__IsLazy():
+      return entity_pb.EntityProto.IsInitialized(self, debug_strs)
+
+    initialized = 1
+    if (not self.has_key_):
+      initialized = 0
+      if debug_strs is not None:
+        debug_strs.append('Required field: key not set.')
+    elif not self.key_.IsInitialized(debug_strs): initialized = 0
+    if (not self.has_entity_group_):
+      initialized = 0
+      if debug_strs is not None:
+        debug_strs.append('Required field: entity_group not set.')
+    elif not self.entity_group_.IsInitialized(debug_strs): initialized = 0
+    if (self.has_owner_ and not self.owner_.IsInitialized(debug_strs)): initialized = 0
+    return initialized
+
+  def ByteSize(self):
+    if not self.__IsLazy():
+      return entity_pb.EntityProto.ByteSize(self)
+
+    n = 0
+    n += self.lengthString(self.key_.ByteSize())
+    n += self.lengthString(self.entity_group_.ByteSize())
+    if (self.has_owner_): n += 2 + self.lengthString(self.owner_.ByteSize())
+    if (self.has_kind_): n += 1 + self.lengthVarInt64(self.kind_)
+    if (self.has_kind_uri_): n += 1 + self.lengthString(len(self.kind_uri_))
+    n += self.__end - self.__start
+    return n + 3
+
+  def OutputUnchecked(self, out):
+    if not self.__IsLazy():
+      entity_pb.EntityProto.OutputUnchecked(self, out)
+      return
+
+    if (self.has_kind_):
+      out.putVarInt32(32)
+      out.putVarInt32(self.kind_)
+    if (self.has_kind_uri_):
+      out.putVarInt32(42)
+      out.putPrefixedString(self.kind_uri_)
+    out.putVarInt32(106)
+    out.putVarInt32(self.key_.ByteSize())
+    self.key_.OutputUnchecked(out)
+    out.putRawString(self.__contents[self.__start:self.__end])
+    out.putVarInt32(130)
+    out.putVarInt32(self.entity_group_.ByteSize())
+    self.entity_group_.OutputUnchecked(out)
+    if (self.has_owner_):
+      out.putVarInt32(138)
+      out.putVarInt32(self.owner_.ByteSize())
+      self.owner_.OutputUnchecked(out)
@@ -71,6 +71,16 @@ preconfigured to return all matching comments:
     for comment in story.comment_set:
        print comment.body
 
+Rendering many comments that refer to the same story fetches the story once
+per comment. To fetch each entity at most once per request, turn on the entity
+cache when the application starts:
+
+    db.enable_entity_cache()
+
+To fetch the stories of many comments with a single call, prefetch them:
+
+    comments = Comment.all().prefetch('story').fetch(50)
+
 """
 
 
@@ -79,7 +89,9 @@ preconfigured to return all matching comments:
 
 
 import datetime
+import itertools
 import logging
+import threading
 import time
 import urlparse
 
@@ -124,6 +136,14 @@ _SELF_REFERENCE = object()
 
 _RESERVED_WORDS = set(['key_name'])
 
+_PREFETCH_BATCH_SIZE = 20
+
+# Whether Model.from_entity() fully validates the property values it loads.
+# Even when it's False, list item types, required, choices and validators are
+# checked, so only a value whose type or range a scalar property would reject
+# can load without a BadValueError.
+VALIDATE_ON_LOAD = False
+
 
 
 
@@ -599,13 +619,35 @@ class Model(object):
     Raises:
       TransactionFailedError if the data could not be committed.
     """
-    self._save_to_entity()
-    return datastore.Put(self._entity)
+    entity_pb = self._save_to_entity_pb()
+    _uncache_keys([self._entity.key()])
+    return datastore._Put(self._entity, datastore._MakeSyncCall, [entity_pb])
 
   save = put
 
   def _save_to_entity(self, _entity_class=datastore.Entity):
     """Internal helper -- does everything save() does execpt the Put()."""
+    self._make_entity(_entity_class)
+    self._store_to_entity(self._entity)
+
+  def _save_to_entity_pb(self):
+    """Internal helper -- does what _save_to_entity() does, and returns the
+    entity's protocol buffer."""
+    cls = self.__class__
+    try:
+      serializer = cls.__dict__['_entity_serializer']
+    except KeyError:
+      serializer = _compile_entity_serializer(cls)
+      cls._entity_serializer = serializer
+
+    if serializer is None:
+      self._save_to_entity()
+      return self._entity._ToPb()
+    self._make_entity()
+    return serializer(self, self._entity)
+
+  def _make_entity(self, _entity_class=datastore.Entity):
+    """Internal helper -- creates the entity for a new instance."""
     if self._entity is None:
       if self._parent is not None:
         self._entity = _entity_class(self.kind(),
@@ -618,15 +660,15 @@ class Model(object):
                                      _app=self._app)
       del self._key_name
 
-    self._store_to_entity(self._entity)
-
   def delete(self):
     """Deletes this entity from the datastore.
 
     Raises:
       TransactionFailedError if the data could not be committed.
     """
-    datastore.Delete(self.key())
+    key = self.key()
+    _uncache_keys([key])
+    datastore.Delete(key)
     self._entity = None
 
 
@@ -870,7 +912,7 @@ class Model(object):
       entity: Entity which contain values to search dyanmic properties for.
     """
     entity_values = {}
-    for prop in cls.properties().values():
+    for prop in cls._properties.itervalues():
       if entity.has_key(prop.name):
         try:
           value = prop.make_value_from_datastore(entity[prop.name])
@@ -886,6 +928,12 @@ class Model(object):
 
     Converts datastore.Entity instance to an instance of cls.
 
+    Unless the class overrides __init__() or _load_entity_values(), the
+    instance is filled in directly from the entity without calling the
+    constructor. Unless VALIDATE_ON_LOAD is set, the values of scalar
+    properties then aren't checked against the property's type and range;
+    see _compile_entity_loader().
+
     Args:
       entity: Entity loaded directly from datastore.
 
@@ -896,6 +944,14 @@ class Model(object):
       raise KindError('Class %s cannot handle kind \'%s\'' %
                       (repr(cls), entity.kind()))
 
+    try:
+      loader = cls.__dict__['_entity_loader']
+    except KeyError:
+      loader = _compile_entity_loader(cls)
+      cls._entity_loader = loader
+    if loader is not None:
+      return loader(entity)
+
     entity_values = cls._load_entity_values(entity)
     instance = cls(None, **entity_values)
     instance._entity = entity
@@ -926,12 +982,239 @@ class Model(object):
     return cls.properties()
 
 
+def _compile_entity_loader(model_class):
+  """Builds a function that makes an instance of a model from an entity.
+
+  The function does what Model.from_entity() would do by calling the
+  constructor, but sets the instance's attributes directly. Property values
+  taken from the entity are only fully validated if VALIDATE_ON_LOAD is set.
+  Otherwise list properties are still validated, item types included, and
+  other properties are still checked for required, choices and their
+  validator, but not for the type and range checks of their validate().
+  Default values for properties missing from the entity, and properties that
+  override __set__(), such as ReferenceProperty, still go through __set__().
+
+  Args:
+    model_class: Model subclass
+
+  Returns:
+    A function taking a datastore.Entity and returning an instance of
+    model_class, or None if the class overrides __init__() or
+    _load_entity_values(), since the function couldn't do what they do.
+  """
+  if (model_class.__init__.im_func is not Model.__init__.im_func or
+      model_class._load_entity_values.im_func is not
+      Model._load_entity_values.im_func):
+    return None
+
+  direct = []
+  indirect = []
+  for prop in model_class._properties.itervalues():
+    make_value = prop.make_value_from_datastore
+    if make_value.im_func is Property.make_value_from_datastore.im_func:
+      make_value = None
+    if isinstance(prop, ListProperty):
+      check = prop.validate
+    elif prop.required or prop.choices or prop.validator is not None:
+      check = Property.validate.im_func.__get__(prop, prop.__class__)
+    else:
+      check = None
+    if prop.__set__.im_func is Property.__set__.im_func:
+      direct.append((prop.name, prop._attr_name(), make_value, prop, check))
+    else:
+      indirect.append((prop.name, make_value, prop))
+
+  new_instance = object.__new__
+
+  def load(entity):
+    instance = new_instance(model_class)
+    attributes = {'_parent': None, '_entity': entity, '_app': None}
+    validate = VALIDATE_ON_LOAD
+    for name, attr_name, make_value, prop, check in direct:
+      if name in entity:
+        value = entity[name]
+        if make_value is not None:
+          try:
+            value = make_value(value)
+          except KeyError:
+            value = []
+        if validate:
+          value = prop.validate(value)
+        elif check is not None:
+          value = check(value)
+        attributes[attr_name] = value
+      else:
+        attributes[attr_name] = prop.validate(prop.default_value())
+    instance.__dict__.update(attributes)
+
+    for name, make_value, prop in indirect:
+      if name in entity:
+        value = entity[name]
+        if make_value is not None:
+          try:
+            value = make_value(value)
+          except KeyError:
+            value = []
+      else:
+        value = prop.default_value()
+      prop.__set__(instance, value)
+    return instance
+
+  return load
+
+
+def _compile_entity_serializer(model_class):
+  """Builds a function that saves a model instance to its entity.
+
+  The function does what Model._store_to_entity() does, and also returns the
+  entity's protocol buffer, as Entity._ToPb() would. It checks the property
+  names once, here, and packs values of the common types straight into
+  property protocol buffers. Other values, and properties in the entity that
+  the model doesn't define, go through Entity's usual checks.
+
+  Args:
+    model_class: Model subclass
+
+  Returns:
+    A function taking an instance of model_class and its datastore.Entity,
+    and returning an entity_pb.EntityProto, or None if the class overrides
+    _store_to_entity() or has an invalid property name.
+  """
+  if (model_class._store_to_entity.im_func is not
+      Model._store_to_entity.im_func):
+    return None
+
+  fields = []
+  for prop in model_class._properties.itervalues():
+    try:
+      datastore_types.ValidatePropertyName(prop.name)
+    except datastore_errors.BadPropertyError:
+      return None
+    fields.append((prop.name, prop.name.encode('utf-8'), prop))
+  fields.sort()
+  names = frozenset([name for name, encoded_name, prop in fields])
+
+  set_value = dict.__setitem__
+  pack_values = datastore_types.PackPropertyValues
+  is_raw = lambda value: isinstance(value, (Blob, Text))
+
+  def serialize(model_instance, entity):
+    properties = []
+    for name, encoded_name, prop in fields:
+      value = prop.get_value_for_datastore(model_instance)
+      if value == []:
+        if name in entity:
+          del entity[name]
+        continue
+
+      packed = pack_values(name, encoded_name, value)
+      if packed is None:
+        entity[name] = value
+        pbs = datastore_types.ToPropertyPb(name, value)
+        if isinstance(value, list):
+          packed = pbs, is_raw(value[0])
+        else:
+          packed = [pbs], is_raw(value)
+      else:
+        set_value(entity, name, value)
+      properties.append((name, packed))
+
+    if len(entity) > len(properties):
+      for name, value in entity.iteritems():
+        if name not in names:
+          pbs = datastore_types.ToPropertyPb(name, value)
+          if isinstance(value, list):
+            properties.append((name, (pbs, is_raw(value[0]))))
+          else:
+            properties.append((name, ([pbs], is_raw(value))))
+      properties.sort()
+
+    pb = entity._ToPbWithoutProperties()
+    for name, (pbs, raw) in properties:
+      if raw:
+        pb.raw_property_list().extend(pbs)
+      else:
+        pb.property_list().extend(pbs)
+    return pb
+
+  return serialize
+
+
+class _EntityCache(threading.local):
+  """The Model instances get() has fetched in the current request, by Key.
+
+  Each thread has its own, since each thread serves its own request.
+  """
+
+  def __init__(self):
+    self.models = {}
+
+
+_entity_cache = _EntityCache()
+
+_entity_cache_enabled = False
+
+
+def enable_entity_cache(enabled=True):
+  """Turns the request-scoped entity cache on or off.
+
+  While it's on, get() and everything built on it, such as Model.get(),
+  Model.get_by_key_name(), Model.get_by_id() and ReferenceProperty resolution,
+  only call the datastore for keys that haven't been fetched yet in the current
+  request. Fetching a key again returns the same Model instance, including any
+  changes that have been made to it since. Putting or deleting an instance
+  drops its key from the cache, and gets inside a transaction always go to the
+  datastore. get_async() doesn't use the cache.
+
+  webapp.WSGIApplication clears the cache at the end of each request.
+  Applications that don't use it should call clear_entity_cache() themselves.
+
+  Args:
+    enabled: True to turn the cache on, False to turn it off.
+  """
+  global _entity_cache_enabled
+  _entity_cache_enabled = enabled
+  clear_entity_cache()
+
+
+def clear_entity_cache():
+  """Empties the current request's entity cache."""
+  _entity_cache.models.clear()
+
+
+def _entity_cache_for_get():
+  """Returns the current request's entity cache, if get() should use it.
+
+  Returns:
+    A dict mapping Keys to Model instances, or None.
+  """
+  if _entity_cache_enabled and not datastore.IsInTransaction():
+    return _entity_cache.models
+  return None
+
+
+def _uncache_keys(keys):
+  """Drops keys that are about to be written from the entity cache.
+
+  Args:
+    keys: list of Keys. Incomplete keys are ignored.
+  """
+  if _entity_cache_enabled:
+    models = _entity_cache.models
+    for key in keys:
+      if key.has_id_or_name():
+        models.pop(key, None)
+
+
 def get(keys):
   """Fetch the specific Model instance with the given key from the datastore.
 
   We support Key objects and string keys (we convert them to Key objects
   automatically).
 
+  If the entity cache is on, keys that have already been fetched in this
+  request aren't fetched again; see enable_entity_cache().
+
   Args:
     keys: Key within datastore entity collection to find; or string key;
       or list of Keys or string keys.
@@ -943,11 +1226,69 @@ def get(keys):
       None.
   """
   keys, multiple = datastore.NormalizeAndTypeCheckKeys(keys)
+  cache = _entity_cache_for_get()
+  if cache is not None:
+    return _get_cached(keys, multiple, cache)
   try:
     entities = datastore.Get(keys)
   except datastore_errors.EntityNotFoundError:
     assert not multiple
     return None
+  return _models_from_entities(entities, multiple)
+
+
+def _get_cached(keys, multiple, cache):
+  """Implements get() when the entity cache is on.
+
+  Args:
+    keys: list of Keys
+    multiple: whether get() was given a list of keys
+    cache: dict, the entity cache
+
+  Returns:
+    What get() returns.
+  """
+  missing = [key for key in keys if key not in cache]
+  if missing:
+    models = _models_from_entities(datastore.Get(missing), True)
+    for key, model in zip(missing, models):
+      if model is not None:
+        cache[key] = model
+  models = [cache.get(key) for key in keys]
+  if multiple:
+    return models
+  assert len(models) == 1
+  return models[0]
+
+
+def get_async(keys):
+  """Start fetching Model instances with the given keys from the datastore.
+
+  Like get(), but returns without waiting for the datastore.
+
+  Args:
+    keys: Key within datastore entity collection to find; or string key;
+      or list of Keys or string keys.
+
+  Returns:
+    A Future, whose get_result() returns what get() returns.
+  """
+  keys, multiple = datastore.NormalizeAndTypeCheckKeys(keys)
+  def result_hook(future):
+    return _models_from_entities(future.GetResult(), multiple)
+  return Future(datastore.GetAsync(keys), result_hook)
+
+
+def _models_from_entities(entities, multiple):
+  """Converts the result of a datastore get to Model instances.
+
+  Args:
+    entities: list of datastore.Entity or None
+    multiple: whether get() was given a list of keys
+
+  Returns:
+    A list of Model instances or None if multiple, else a single one.
+  """
   models = []
   for entity in entities:
     if entity is None:
@@ -975,10 +1316,10 @@ def put(models):
     TransactionFailedError if the data could not be committed.
   """
   models, multiple = datastore.NormalizeAndTypeCheck(models, Model)
-  for model in models:
-    model._save_to_entity()
+  entity_pbs = [model._save_to_entity_pb() for model in models]
   entities = [model._entity for model in models]
-  keys = datastore.Put(entities)
+  _uncache_keys([entity.key() for entity in entities])
+  keys = datastore._Put(entities, datastore._MakeSyncCall, entity_pbs)
   if multiple:
     return keys
   assert len(keys) == 1
@@ -987,6 +1328,32 @@ def put(models):
 save = put
 
 
+def put_async(models):
+  """Start storing one or more Model instances.
+
+  Like put(), but returns without waiting for the datastore. New instances
+  have their keys once the result has been fetched.
+
+  Args:
+    models: Model instance or list of Model instances.
+
+  Returns:
+    A Future, whose get_result() returns what put() returns.
+  """
+  models, multiple = datastore.NormalizeAndTypeCheck(models, Model)
+  entity_pbs = [model._save_to_entity_pb() for model in models]
+  entities = [model._entity for model in models]
+  _uncache_keys([entity.key() for entity in entities])
+  def result_hook(future):
+    keys = future.GetResult()
+    if multiple:
+      return keys
+    assert len(keys) == 1
+    return keys[0]
+  return Future(datastore._Put(entities, datastore._MakeAsyncCall, entity_pbs),
+                result_hook)
+
+
 def delete(models):
   """Delete one or more Model instances.
 
@@ -997,8 +1364,109 @@ def delete(models):
     TransactionFailedError if the data could not be committed.
   """
   models, multiple = datastore.NormalizeAndTypeCheck(models, Model)
-  entities = [model.key() for model in models]
-  keys = datastore.Delete(entities)
+  keys = [model.key() for model in models]
+  _uncache_keys(keys)
+  datastore.Delete(keys)
+
+
+def delete_async(models):
+  """Start deleting one or more Model instances.
+
+  Like delete(), but returns without waiting for the datastore.
+
+  Args:
+    models: Model instance or list of Model instances.
+
+  Returns:
+    A Future, whose get_result() returns None.
+  """
+  models, multiple = datastore.NormalizeAndTypeCheck(models, Model)
+  keys = [model.key() for model in models]
+  _uncache_keys(keys)
+  return Future(datastore.DeleteAsync(keys), lambda future: future.GetResult())
+
+
+def prefetch_references(models, *property_names):
+  """Resolves the ReferenceProperties of many Model instances at once.
+
+  Collects the keys that the named properties refer to and that haven't been
+  resolved yet, across all of the instances, and fetches them with a single
+  get(). Reading the properties afterwards doesn't call the datastore.
+  References to entities that don't exist are left unresolved.
+
+  For example, this fetches the stories of 50 comments with two calls instead
+  of 51:
+
+    comments = Comment.all().fetch(50)
+    db.prefetch_references(comments, 'story')
+
+  Args:
+    models: list of Model instances
+    property_names: names of ReferenceProperties of the instances
+
+  Raises:
+    PropertyError if a name isn't a ReferenceProperty of an instance's class.
+  """
+  unresolved = []
+  fetched = {}
+  for model in models:
+    for name in property_names:
+      prop = getattr(model.__class__, name, None)
+      if not isinstance(prop, ReferenceProperty):
+        raise PropertyError('%s has no ReferenceProperty named %r' %
+                            (model.kind(), name))
+      key = prop._unresolved_key(model)
+      if key is not None:
+        unresolved.append((model, prop, key))
+        fetched[key] = None
+
+  if not fetched:
+    return
+
+  keys = fetched.keys()
+  for key, instance in zip(keys, get(keys)):
+    fetched[key] = instance
+  for model, prop, key in unresolved:
+    instance = fetched[key]
+    if instance is not None:
+      prop._set_resolved(model, instance)
+
+
+class Future(object):
+  """The pending result of get_async(), put_async() or delete_async().
+
+  get_result() waits for the datastore, then returns what the corresponding
+  synchronous function would have returned, or raises what it would have
+  raised.
+  """
+
+  def __init__(self, future, result_hook):
+    """Constructor.
+
+    Args:
+      future: datastore.Future for the underlying datastore call.
+      result_hook: Callable that takes the datastore.Future and returns the
+        result.
+    """
+    self.__future = future
+    self.__result_hook = result_hook
+    self.__done = False
+    self.__result = None
+
+  def wait(self):
+    """Wait for the datastore call to finish."""
+    self.__future.Wait()
+
+  def get_result(self):
+    """Wait for the datastore call to finish, and return its result.
+
+    Returns:
+      The result of the synchronous function.
+    """
+    if not self.__done:
+      self.__result = self.__result_hook(self.__future)
+      self.__done = True
+    return self.__result
 
 
 class Expando(Model):
@@ -1193,6 +1661,7 @@ class _BaseQuery(object):
         model_class: Model class from which entities are constructed.
     """
     self._model_class = model_class
+    self._prefetch_properties = ()
 
   def _get_query(self):
     """Subclass must override (and not call their super method).
@@ -1211,7 +1680,25 @@ class _BaseQuery(object):
     Returns:
       Iterator for this query.
     """
-    return _QueryIterator(self._model_class, iter(self._get_query().Run()))
+    return _QueryIterator(self._model_class, iter(self._get_query().Run()),
+                          self._prefetch_properties)
+
+  def run_async(self):
+    """Start running this query.
+
+    Like run(), but returns without waiting for the datastore.
+
+    Beware: run_async() ignores the LIMIT clause on GQL queries.
+
+    Returns:
+      A Future, whose get_result() returns what run() returns.
+    """
+    model_class = self._model_class
+    prefetch_properties = self._prefetch_properties
+    def result_hook(future):
+      return _QueryIterator(model_class, iter(future.GetResult()),
+                            prefetch_properties)
+    return Future(self._get_query().RunAsync(), result_hook)
 
   def __iter__(self):
     """Iterator for this query.
@@ -1229,6 +1716,11 @@ class _BaseQuery(object):
     Returns:
       First result from running the query if there are any, else None.
     """
+    if self._prefetch_properties:
+      results = self.fetch(1)
+      if results:
+        return results[0]
+      return None
     iterator = self.run()
     try:
       return iterator.next()
@@ -1276,7 +1768,26 @@ class _BaseQuery(object):
     raw = self._get_query().Get(offset+limit)
     if offset:
       del raw[:offset]
-    return map(self._model_class.from_entity, raw)
+    models = map(self._model_class.from_entity, raw)
+    if self._prefetch_properties:
+      prefetch_references(models, *self._prefetch_properties)
+    return models
+
+  def prefetch(self, *property_names):
+    """Resolves ReferenceProperties of the results in batches.
+
+    The named properties of the results of fetch(), get(), indexing and
+    iteration are resolved with one get() per batch of results, rather than
+    one per result. See prefetch_references().
+
+    Args:
+      property_names: names of ReferenceProperties of the model class
+
+    Returns:
+      Self to support method chaining.
+    """
+    self._prefetch_properties += property_names
+    return self
 
   def __getitem__(self, arg):
     """Support for query[index] and query[start:stop].
@@ -1324,17 +1835,23 @@ class _QueryIterator(object):
 
   The datastore returns entities. We wrap the datastore iterator to
   return Model instances instead.
+
+  If there are properties to prefetch, instances are made
+  _PREFETCH_BATCH_SIZE at a time, and their references resolved together.
   """
 
-  def __init__(self, model_class, datastore_iterator):
+  def __init__(self, model_class, datastore_iterator, prefetch_properties=()):
     """Iterator constructor
 
     Args:
       model_class: Model class from which entities are constructed.
       datastore_iterator: Underlying datastore iterator.
+      prefetch_properties: Names of ReferenceProperties to prefetch.
     """
     self.__model_class = model_class
     self.__iterator = datastore_iterator
+    self.__prefetch_properties = prefetch_properties
+    self.__buffer = []
 
   def __iter__(self):
     """Iterator on self.
@@ -1353,7 +1870,17 @@ class _QueryIterator(object):
     Raises:
       StopIteration when there are no more results in query.
     """
-    return self.__model_class.from_entity(self.__iterator.next())
+    if not self.__prefetch_properties:
+      return self.__model_class.from_entity(self.__iterator.next())
+
+    if not self.__buffer:
+      entities = itertools.islice(self.__iterator, _PREFETCH_BATCH_SIZE)
+      self.__buffer = map(self.__model_class.from_entity, entities)
+      if not self.__buffer:
+        raise StopIteration
+      prefetch_references(self.__buffer, *self.__prefetch_properties)
+      self.__buffer.reverse()
+    return self.__buffer.pop()
 
 
 class Query(_BaseQuery):
@@ -1531,7 +2058,8 @@ class GqlQuery(_BaseQuery):
   def run(self):
     """Override _BaseQuery.run() so the LIMIT clause is handled properly."""
     query_run = self._proto_query.Run(*self._args, **self._kwds)
-    return _QueryIterator(self._model_class, iter(query_run))
+    return _QueryIterator(self._model_class, iter(query_run),
+                          self._prefetch_properties)
 
   def _get_query(self):
     return self._proto_query.Bind(self._args, self._kwds)
@@ -2271,6 +2799,26 @@ class ReferenceProperty(Property):
 
     return value
 
+  def _unresolved_key(self, model_instance):
+    """Get the key of the reference, if it hasn't been resolved yet.
+
+    Used by prefetch_references().
+
+    Returns:
+      Key of the referenced entity, or None if the property is unset or
+      already resolved.
+    """
+    reference_id = getattr(model_instance, self.__id_attr_name(), None)
+    if reference_id is None:
+      return None
+    if getattr(model_instance, self.__resolved_attr_name(), None):
+      return None
+    return reference_id
+
+  def _set_resolved(self, model_instance, instance):
+    """Store an instance fetched by prefetch_references() as resolved."""
+    setattr(model_instance, self.__resolved_attr_name(), instance)
+
   def __id_attr_name(self):
     """Get attribute of referenced id.
 
@@ -69,6 +69,8 @@ import webob
 import wsgiref.headers
 import wsgiref.util
 
+from google.appengine.api import url_routing
+
 RE_FIND_GROUPS = re.compile('\(.*?\)')
 
 class Error(Exception):
@@ -460,6 +462,16 @@ class WSGIApplication(object):
 
   def __call__(self, environ, start_response):
     """Called by WSGI when a request comes in."""
+    try:
+      return self.__Dispatch(environ, start_response)
+    finally:
+      # Only applications that have imported db have an entity cache.
+      db = sys.modules.get('google.appengine.ext.db')
+      if db is not None:
+        db.clear_entity_cache()
+
+  def __Dispatch(self, environ, start_response):
+    """Handles a request. Implements __call__()."""
     request = Request(environ)
     response = Response()
 
@@ -467,13 +479,11 @@ class WSGIApplication(object):
 
     handler = None
     groups = ()
-    for regexp, handler_class in self._url_mapping:
-      match = regexp.match(request.path)
-      if match:
-        handler = handler_class()
-        handler.initialize(request, response)
-        groups = match.groups()
-        break
+    index, match = self._route_table.Match(request.path)
+    if match:
+      handler = self._url_mapping[index][1]()
+      handler.initialize(request, response)
+      groups = match.groups()
 
     self.current_request_args = groups
 
@@ -535,6 +545,8 @@ class WSGIApplication(object):
     self._handler_map = handler_map
     self._pattern_map = pattern_map
     self._url_mapping = url_mapping
+    self._route_table = url_routing.RouteTable(
+        [compiled for compiled, handler in url_mapping])
 
   def get_registered_handler_by_name(self, handler_name):
     """Returns the handler given the handler's name.
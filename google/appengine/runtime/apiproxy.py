@@ -228,6 +228,15 @@ class RPC(object):
         raise
 
 
+def CreateRPC():
+  """Creates an RPC object for an asynchronous API call.
+
+  Returns:
+    RPC
+  """
+  return RPC()
+
+
 def MakeSyncCall(package, call, request, response):
   """Makes a synchronous (i.e. blocking) API call within the specified
   package for the specified call method. request and response must be the
@@ -50,14 +50,19 @@ import os
 import pickle
 import pprint
 import random
+import rfc822
 
 import re
+import SocketServer
 import sre_compile
 import sre_constants
 import sre_parse
 
+import shutil
 import socket
+import stat
 import sys
+import threading
 import urlparse
 import time
 import traceback
@@ -71,12 +76,14 @@ from google.appengine.api import appinfo
 from google.appengine.api import datastore_admin
 from google.appengine.api import datastore_file_stub
 from google.appengine.api import urlfetch_stub
+from google.appengine.api import url_routing
 from google.appengine.api import mail_stub
 from google.appengine.api import user_service_stub
 from google.appengine.api import yaml_errors
 
 from google.appengine.tools import dev_appserver_index
 from google.appengine.tools import dev_appserver_login
+from google.appengine.tools import dev_appserver_stats
 
 
 PYTHON_LIB_VAR = '$PYTHON_LIB'
@@ -86,11 +93,23 @@ FILE_MISSING_EXCEPTIONS = frozenset([errno.ENOENT, errno.ENOTDIR])
 
 MAX_URL_LENGTH = 2047
 
+STATIC_CACHE_MAX_SIZE = 10 * 1024 * 1024
+STATIC_CACHE_MAX_FILE_SIZE = 256 * 1024
+STATIC_CHUNK_SIZE = 64 * 1024
+
 HEADER_TEMPLATE = 'logging_console_header.html'
 SCRIPT_TEMPLATE = 'logging_console.js'
 MIDDLE_TEMPLATE = 'logging_console_middle.html'
 FOOTER_TEMPLATE = 'logging_console_footer.html'
 
+# Held while a request runs application code, or does the bookkeeping around
+# it, since both use or swap the process-global state that CGIs run in:
+# sys.modules, os.environ, sys.stdout, the builtins, the logging handlers and
+# the API stubs. Only one such request runs at a time, even when the server
+# handles requests on many threads. Requests for static files don't take it.
+_execution_lock = threading.RLock()
+
+
 DEFAULT_ENV = {
   'GATEWAY_INTERFACE': 'CGI/1.1',
   'AUTH_DOMAIN': 'gmail.com',
@@ -189,6 +208,7 @@ class URLMatcher(object):
   def __init__(self):
     """Initializer."""
     self._url_patterns = []
+    self._route_table = None
 
   def AddURL(self, regex, dispatcher, path, requires_login, admin_only):
     """Adds a URL pattern to the list of patterns.
@@ -225,6 +245,7 @@ class URLMatcher(object):
 
     match_tuple = (url_re, dispatcher, path, requires_login, admin_only)
     self._url_patterns.append(match_tuple)
+    self._route_table = None
 
   def Match(self,
             relative_url,
@@ -246,13 +267,18 @@ class URLMatcher(object):
     """
     adjusted_url, query_string = split_url(relative_url)
 
-    for url_tuple in self._url_patterns:
-      url_re, dispatcher, path, requires_login, admin_only = url_tuple
-      the_match = url_re.match(adjusted_url)
+    route_table = self._route_table
+    if route_table is None:
+      route_table = url_routing.RouteTable(
+          [url_tuple[0] for url_tuple in self._url_patterns])
+      self._route_table = route_table
 
-      if the_match:
-        adjusted_path = the_match.expand(path)
-        return dispatcher, adjusted_path, requires_login, admin_only
+    index, the_match = route_table.Match(adjusted_url)
+    if the_match:
+      url_re, dispatcher, path, requires_login, admin_only = (
+          self._url_patterns[index])
+      adjusted_path = the_match.expand(path)
+      return dispatcher, adjusted_path, requires_login, admin_only
 
     return None, None, None, None
 
@@ -352,6 +378,21 @@ class MatcherDispatcher(URLDispatcher):
                   'in application configuration.'
                   % (httplib.NOT_FOUND, relative_url))
 
+  def Match(self, relative_url):
+    """Returns the dispatcher that Dispatch() would use for a URL.
+
+    Args:
+      relative_url: String containing the URL accessed.
+
+    Returns:
+      URLDispatcher instance, or None if no matcher matches the URL.
+    """
+    for matcher in self._url_matchers:
+      dispatcher = matcher.Match(relative_url)[0]
+      if dispatcher is not None:
+        return dispatcher
+    return None
+
 
 class ApplicationLoggingHandler(logging.Handler):
   """Python Logging handler that displays the debugging console to users."""
@@ -1738,26 +1779,30 @@ class CGIDispatcher(URLDispatcher):
                outfile,
                base_env_dict=None):
     """Dispatches the Python CGI."""
-    handler = self._create_logging_handler()
-    logging.getLogger().addHandler(handler)
-    before_level = logging.root.level
+    _execution_lock.acquire()
     try:
-      env = {}
-      if base_env_dict:
-        env.update(base_env_dict)
-      cgi_path = self._path_adjuster.AdjustPath(path)
-      env.update(self._setup_env(cgi_path, relative_url, headers))
-      self._exec_cgi(self._root_path,
-                     path,
-                     cgi_path,
-                     env,
-                     infile,
-                     outfile,
-                     self._module_dict)
-      handler.AddDebuggingConsole(relative_url, env, outfile)
+      handler = self._create_logging_handler()
+      logging.getLogger().addHandler(handler)
+      before_level = logging.root.level
+      try:
+        env = {}
+        if base_env_dict:
+          env.update(base_env_dict)
+        cgi_path = self._path_adjuster.AdjustPath(path)
+        env.update(self._setup_env(cgi_path, relative_url, headers))
+        self._exec_cgi(self._root_path,
+                       path,
+                       cgi_path,
+                       env,
+                       infile,
+                       outfile,
+                       self._module_dict)
+        handler.AddDebuggingConsole(relative_url, env, outfile)
+      finally:
+        logging.root.level = before_level
+        logging.getLogger().removeHandler(handler)
     finally:
-      logging.root.level = before_level
-      logging.getLogger().removeHandler(handler)
+      _execution_lock.release()
 
   def __str__(self):
     """Returns a string representation of this dispatcher."""
@@ -1800,8 +1845,12 @@ class LocalCGIDispatcher(CGIDispatcher):
 
   def Dispatch(self, *args, **kwargs):
     """Preserves sys.modules for CGIDispatcher.Dispatch."""
-    self._module_dict.update(sys.modules)
-    CGIDispatcher.Dispatch(self, *args, **kwargs)
+    _execution_lock.acquire()
+    try:
+      self._module_dict.update(sys.modules)
+      CGIDispatcher.Dispatch(self, *args, **kwargs)
+    finally:
+      _execution_lock.release()
 
   def __str__(self):
     """Returns a string representation of this dispatcher."""
@@ -1842,18 +1891,22 @@ class PathAdjuster(object):
     return path
 
 
-class StaticFileMimeTypeMatcher(object):
-  """Computes mime type based on URLMap and file extension.
+class StaticFileConfigMatcher(object):
+  """Computes mime type and cache expiration based on URLMap and file path.
 
   To determine the mime type, we first see if there is any mime-type property
   on each URLMap entry. If non is specified, we use the mimetypes module to
   guess the mime type from the file path extension, and use
   application/octet-stream if we can't find the mimetype.
+
+  The expiration is the one of the first URLMap entry that matches and has
+  an expiration property, or else the application's default expiration.
   """
 
   def __init__(self,
                url_map_list,
-               path_adjuster):
+               path_adjuster,
+               default_expiration=None):
     """Initializer.
 
     Args:
@@ -1861,12 +1914,17 @@ class StaticFileMimeTypeMatcher(object):
         If empty or None, then we always use the mime type chosen by the
         mimetypes module.
       path_adjuster: PathAdjuster object used to adjust application file paths.
+      default_expiration: String describing the default cache expiration
+        time for static files, as in app.yaml, or None.
     """
     self._patterns = []
+    self._default_expiration = None
+    if default_expiration is not None:
+      self._default_expiration = appinfo.ParseExpiration(default_expiration)
 
     if url_map_list:
       for entry in url_map_list:
-        if entry.mime_type is None:
+        if entry.mime_type is None and entry.expiration is None:
           continue
         handler_type = entry.GetHandlerType()
         if handler_type not in (appinfo.STATIC_FILES, appinfo.STATIC_DIR):
@@ -1883,7 +1941,10 @@ class StaticFileMimeTypeMatcher(object):
         except re.error, e:
           raise InvalidAppConfigError('regex does not compile: %s' % e)
 
-        self._patterns.append((path_re, entry.mime_type))
+        expiration = None
+        if entry.expiration is not None:
+          expiration = appinfo.ParseExpiration(entry.expiration)
+        self._patterns.append((path_re, entry.mime_type, expiration))
 
   def GetMimeType(self, path):
     """Returns the mime type that we should use when serving the specified file.
@@ -1895,14 +1956,32 @@ class StaticFileMimeTypeMatcher(object):
       String containing the mime type to use. Will be 'application/octet-stream'
       if we have no idea what it should be.
     """
-    for (path_re, mime_type) in self._patterns:
-      the_match = path_re.match(path)
-      if the_match:
+    for (path_re, mime_type, expiration) in self._patterns:
+      if mime_type is not None and path_re.match(path):
         return mime_type
 
     filename, extension = os.path.splitext(path)
     return mimetypes.types_map.get(extension, 'application/octet-stream')
 
+  def GetExpiration(self, path):
+    """Returns the cache expiration to use when serving the specified file.
+
+    Args:
+      path: String containing the file's path on disk.
+
+    Returns:
+      Integer number of seconds clients may cache the file for, or None if
+      they should not cache it.
+    """
+    for (path_re, mime_type, expiration) in self._patterns:
+      if expiration is not None and path_re.match(path):
+        return expiration
+
+    return self._default_expiration
+
+
+StaticFileMimeTypeMatcher = StaticFileConfigMatcher
+
 
 def ReadDataFile(data_path, openfile=file):
   """Reads a file on disk, returning a corresponding HTTP status and data.
@@ -1936,24 +2015,143 @@ def ReadDataFile(data_path, openfile=file):
   return status, data
 
 
+class StaticFileCache(object):
+  """Least recently used cache of the contents of small static files.
+
+  Entries are keyed by the file's path, modification time and size, so a
+  file that changes is read again and its old contents age out of the cache.
+  """
+
+  def __init__(self,
+               max_size=STATIC_CACHE_MAX_SIZE,
+               max_file_size=STATIC_CACHE_MAX_FILE_SIZE):
+    """Initializer.
+
+    Args:
+      max_size: Maximum total size in bytes of the cached file contents.
+      max_file_size: Size in bytes of the largest file that will be cached.
+    """
+    self.max_size = max_size
+    self.max_file_size = max_file_size
+    self.__entries = {}
+    self.__size = 0
+    self.__clock = 0
+    self.__lock = threading.Lock()
+
+  def Get(self, key):
+    """Returns the cached contents for a key, or None if there are none."""
+    self.__lock.acquire()
+    try:
+      entry = self.__entries.get(key)
+      if entry is None:
+        return None
+      self.__clock += 1
+      entry[1] = self.__clock
+      return entry[0]
+    finally:
+      self.__lock.release()
+
+  def Put(self, key, data):
+    """Caches file contents, evicting the least recently used if needed.
+
+    Args:
+      key: Tuple (path, mtime, size) identifying the file.
+      data: String containing the file's contents. Ignored if it is larger
+        than max_file_size.
+    """
+    if len(data) > self.max_file_size:
+      return
+
+    self.__lock.acquire()
+    try:
+      if key in self.__entries:
+        return
+      self.__clock += 1
+      self.__entries[key] = [data, self.__clock]
+      self.__size += len(data)
+      while self.__size > self.max_size:
+        oldest = min(self.__entries, key=lambda k: self.__entries[k][1])
+        self.__size -= len(self.__entries.pop(oldest)[0])
+    finally:
+      self.__lock.release()
+
+
+class ResponseFile(object):
+  """Output file that dispatchers write their CGI responses to.
+
+  Written output is buffered so RewriteResponse() can turn it into an HTTP
+  response. A dispatcher that already has a complete response, such as
+  FileDispatcher serving a static file, can instead hand it over with
+  SetResponse(), so it is sent as is and its body can be read straight from
+  the file.
+
+  Attributes:
+    response: Tuple (status_code, status_message, header_data, body) given
+      to SetResponse(), or None.
+  """
+
+  def __init__(self):
+    """Initializer."""
+    self._buffer = cStringIO.StringIO()
+    self.response = None
+
+  def __getattr__(self, name):
+    """Delegates file methods to the output buffer."""
+    return getattr(self._buffer, name)
+
+  def SetResponse(self, status_code, status_message, header_data, body):
+    """Sets the complete response to send instead of the written output.
+
+    Args:
+      status_code: Integer HTTP response status.
+      status_message: String containing the status message.
+      header_data: String containing the HTTP headers, including
+        Content-Length, each ending with CRLF.
+      body: String containing the body, or an open file to send the body
+        from, which will be closed once it has been sent.
+    """
+    self.response = (status_code, status_message, header_data, body)
+
+
 class FileDispatcher(URLDispatcher):
-  """Dispatcher that reads data files from disk."""
+  """Dispatcher that reads data files from disk.
+
+  Responses carry ETag and Last-Modified headers, so conditional requests for
+  files that have not changed get a 304 response, and a Cache-Control header
+  based on the expiration configured in app.yaml. Small files are served
+  from a StaticFileCache. When the outfile is a ResponseFile, the response
+  bypasses RewriteResponse() and larger files are sent from disk in chunks
+  instead of being read into memory.
+  """
 
   def __init__(self,
                path_adjuster,
-               static_file_mime_type_matcher,
-               read_data_file=ReadDataFile):
+               static_file_config_matcher,
+               read_data_file=ReadDataFile,
+               static_file_cache=None,
+               stat_file=os.stat,
+               openfile=file,
+               get_time=time.time):
     """Initializer.
 
     Args:
       path_adjuster: Instance of PathAdjuster to use for finding absolute
         paths of data files on disk.
-      static_file_mime_type_matcher: StaticFileMimeTypeMatcher object.
-      read_data_file: Used for dependency injection.
+      static_file_config_matcher: StaticFileConfigMatcher object.
+      static_file_cache: StaticFileCache to keep small files in. A new one
+        is created if None.
+      read_data_file, stat_file, openfile, get_time: Used for dependency
+        injection.
     """
     self._path_adjuster = path_adjuster
-    self._static_file_mime_type_matcher = static_file_mime_type_matcher
+    self._static_file_config_matcher = static_file_config_matcher
     self._read_data_file = read_data_file
+    if static_file_cache is None:
+      static_file_cache = StaticFileCache()
+    self._static_file_cache = static_file_cache
+    self._stat_file = stat_file
+    self._openfile = openfile
+    self._get_time = get_time
 
   def Dispatch(self,
                relative_url,
@@ -1964,13 +2162,127 @@ class FileDispatcher(URLDispatcher):
                base_env_dict=None):
     """Reads the file and returns the response status and data."""
     full_path = self._path_adjuster.AdjustPath(path)
-    status, data = self._read_data_file(full_path)
-    content_type = self._static_file_mime_type_matcher.GetMimeType(full_path)
+    content_type = self._static_file_config_matcher.GetMimeType(full_path)
+    method = (base_env_dict or {}).get('REQUEST_METHOD', 'GET')
+
+    try:
+      file_stat = self._stat_file(full_path)
+    except (OSError, IOError):
+      file_stat = None
+    if file_stat is None or not stat.S_ISREG(file_stat.st_mode):
+      status, data = self._read_data_file(full_path)
+      self._WriteResponse(outfile, status,
+                          [('Content-type', content_type),
+                           ('Cache-Control', 'no-cache')], data)
+      return
+
+    mtime = file_stat.st_mtime
+    size = file_stat.st_size
+    header_list = [
+        ('ETag', '"%x-%x"' % (int(mtime * 1000), size)),
+        ('Last-Modified', rfc822.formatdate(mtime)),
+    ]
+    expiration = self._static_file_config_matcher.GetExpiration(full_path)
+    if expiration is None:
+      header_list.append(('Cache-Control', 'no-cache'))
+    else:
+      header_list.append(('Cache-Control', 'public, max-age=%d' % expiration))
+      header_list.append(('Expires', rfc822.formatdate(
+          self._get_time() + expiration)))
+
+    if (method in ('GET', 'HEAD') and
+        self._IsNotModified(headers, header_list[0][1], mtime)):
+      self._WriteResponse(outfile, httplib.NOT_MODIFIED, header_list, '')
+      return
+
+    header_list.insert(0, ('Content-type', content_type))
+    direct = isinstance(outfile, ResponseFile)
+    if direct and method == 'HEAD':
+      self._WriteResponse(outfile, httplib.OK, header_list, '', size)
+      return
+
+    if size <= self._static_file_cache.max_file_size:
+      cache_key = (full_path, mtime, size)
+      data = self._static_file_cache.Get(cache_key)
+      if data is None:
+        status, data = self._read_data_file(full_path)
+        if status != httplib.OK:
+          self._WriteResponse(outfile, status,
+                              [('Content-type', content_type),
+                               ('Cache-Control', 'no-cache')], data)
+          return
+        if len(data) == size:
+          self._static_file_cache.Put(cache_key, data)
+      self._WriteResponse(outfile, httplib.OK, header_list, data)
+      return
+
+    try:
+      data_file = self._openfile(full_path, 'rb')
+    except (OSError, IOError):
+      status, data = self._read_data_file(full_path)
+      self._WriteResponse(outfile, status,
+                          [('Content-type', content_type),
+                           ('Cache-Control', 'no-cache')], data)
+      return
+    self._WriteResponse(outfile, httplib.OK, header_list, data_file, size)
+
+  def _IsNotModified(self, headers, etag, mtime):
+    """Checks whether a conditional request can get a 304 response.
+
+    Args:
+      headers: Instance of mimetools.Message with headers from the request.
+      etag: String containing the file's entity tag.
+      mtime: Float, the file's modification time.
+
+    Returns:
+      True if the If-None-Match header lists the file's entity tag or, if
+      there is none, the If-Modified-Since header is no earlier than the
+      file's modification time.
+    """
+    if_none_match = headers.get('if-none-match')
+    if if_none_match:
+      tags = [tag.strip() for tag in if_none_match.split(',')]
+      return '*' in tags or etag in tags or 'W/' + etag in tags
+
+    if_modified_since = headers.get('if-modified-since')
+    if if_modified_since:
+      since = rfc822.parsedate_tz(if_modified_since.split(';', 1)[0])
+      if since is not None:
+        return int(mtime) <= rfc822.mktime_tz(since)
+    return False
+
+  def _WriteResponse(self, outfile, status, header_list, body,
+                     body_length=None):
+    """Writes a response, handing it to outfile if it is a ResponseFile.
+
+    Args:
+      outfile: File-like object where output data should be written.
+      status: Integer HTTP response status.
+      header_list: List of (name, value) header tuples.
+      body: String containing the body, or an open file to copy it from.
+      body_length: Length of the body, if it is not len(body).
+    """
+    if body_length is None:
+      body_length = len(body)
+
+    if isinstance(outfile, ResponseFile):
+      header_data = ''.join(['%s: %s\r\n' % header for header in header_list])
+      header_data += 'Content-Length: %d\r\n' % body_length
+      outfile.SetResponse(status, httplib.responses.get(status, ''),
+                          header_data, body)
+      return
 
     outfile.write('Status: %d\r\n' % status)
-    outfile.write('Content-type: %s\r\n' % content_type)
+    for header in header_list:
+      outfile.write('%s: %s\r\n' % header)
     outfile.write('\r\n')
-    outfile.write(data)
+    if isinstance(body, basestring):
+      outfile.write(body)
+    else:
+      try:
+        shutil.copyfileobj(body, outfile, STATIC_CHUNK_SIZE)
+      finally:
+        body.close()
 
   def __str__(self):
     """Returns a string representation of this dispatcher."""
@@ -2003,7 +2315,32 @@ def RewriteResponse(response_file):
       body: String containing the body of the response.
   """
   headers = mimetools.Message(response_file)
+  status_code, status_message, body = RewriteResponseHeaders(headers)
+  if body is None:
+    body = response_file.read()
+
+  headers['content-length'] = str(len(body))
 
+  header_data = ''.join(headers.headers)
+  return status_code, status_message, header_data, body
+
+
+def RewriteResponseHeaders(headers):
+  """Interprets the server-side headers of a CGI response.
+
+  Handles the 'status' and 'location' headers as described for
+  RewriteResponse, and adds a 'Cache-Control: no-cache' header if there is no
+  Cache-Control header.
+
+  Args:
+    headers: Instance of mimetools.Message with the response headers, which
+      is modified in place.
+
+  Returns:
+    Tuple (status_code, status_message, error_body) where error_body is None,
+    or a string containing the body to send instead of the response's own
+    body because the 'status' header was invalid.
+  """
   response_status = '%d Good to go' % httplib.OK
 
   location_value = headers.getheader('location')
@@ -2022,15 +2359,225 @@ def RewriteResponse(response_file):
   try:
     status_code = int(status_code)
   except ValueError:
-    status_code = 500
-    body = 'Error: Invalid "status" header value returned.'
-  else:
-    body = response_file.read()
+    return 500, status_message, 'Error: Invalid "status" header value returned.'
+  return status_code, status_message, None
 
-  headers['content-length'] = str(len(body))
 
-  header_data = ''.join(headers.headers)
-  return status_code, status_message, header_data, body
+class StreamingResponseFile(ResponseFile):
+  """ResponseFile that sends CGI output to the client as it is written.
+
+  Output is buffered only until the blank line that ends the CGI headers.
+  The headers are then rewritten as by RewriteResponse() and sent, and the
+  body is passed on in chunks of up to STATIC_CHUNK_SIZE bytes. It is sent
+  with the Content-Length the application set, if any. Otherwise it is sent
+  with chunked transfer encoding if that is enabled, or else its end is
+  marked by closing the connection.
+
+  If the output never ends its headers, Finish() leaves it all buffered for
+  RewriteResponse(), as with a ResponseFile.
+
+  Attributes:
+    started: True once the status line and headers have been sent.
+  """
+
+  def __init__(self, start_response, wfile, chunked=False, send_body=True):
+    """Initializer.
+
+    Args:
+      start_response: Function taking (status_code, status_message,
+        header_data) that sends the status line and headers to the client.
+      wfile: File-like object to write the response body to.
+      chunked: True to use chunked transfer encoding for responses without
+        a Content-Length header. Only for HTTP/1.1 connections.
+      send_body: False to drop the body, as for HEAD requests.
+    """
+    ResponseFile.__init__(self)
+    self.started = False
+    self.__start_response = start_response
+    self.__wfile = wfile
+    self.__chunked = chunked
+    self.__send_body = send_body
+    self.__tail = '\n'
+    self.__pending = []
+    self.__pending_size = 0
+    self.__remaining = None
+    self.__dropped = 0
+    self.__disconnected = False
+
+  def write(self, data):
+    """Writes CGI output, sending it once the headers are complete."""
+    if self.started:
+      self.__WriteBody(data)
+      return
+
+    self._buffer.write(data)
+    text = self.__tail + data
+    self.__tail = text[-3:]
+    if '\n\n' in text or '\n\r\n' in text:
+      self.__Start()
+
+  def writelines(self, lines):
+    """Writes a sequence of strings of CGI output."""
+    for line in lines:
+      self.write(line)
+
+  def flush(self):
+    """Sends any buffered body output to the client."""
+    if self.started:
+      self.__Flush()
+
+  def Finish(self):
+    """Sends the rest of a streamed response.
+
+    Returns:
+      True if the response has been sent. False if the output never ended
+      its headers; it is then still buffered, for RewriteResponse().
+    """
+    if not self.started:
+      return False
+
+    self.__Flush()
+    if self.__chunked:
+      self.__Send('0\r\n\r\n')
+    if self.__dropped:
+      logging.warning('Dropped %d bytes of response body beyond its '
+                      'Content-Length or in response to a HEAD request',
+                      self.__dropped)
+    if self.__remaining and self.__send_body:
+      logging.warning('Response body was %d bytes shorter than its '
+                      'Content-Length', self.__remaining)
+    return True
+
+  def __Start(self):
+    """Rewrites and sends the headers and whatever body has been written."""
+    self._buffer.seek(0)
+    headers = mimetools.Message(self._buffer)
+    status_code, status_message, error_body = RewriteResponseHeaders(headers)
+    if error_body is not None:
+      body = error_body
+      headers['content-length'] = str(len(body))
+    else:
+      body = self._buffer.read()
+    self._buffer = cStringIO.StringIO()
+
+    content_length = headers.getheader('content-length')
+    if content_length is not None:
+      try:
+        self.__remaining = int(content_length)
+      except ValueError:
+        del headers['content-length']
+      else:
+        self.__chunked = False
+    if self.__remaining is None and self.__chunked:
+      if self.__send_body:
+        headers['Transfer-Encoding'] = 'chunked'
+      else:
+        self.__chunked = False
+
+    self.started = True
+    self.__start_response(status_code, status_message,
+                          ''.join(headers.headers))
+    self.__WriteBody(body)
+    if error_body is not None:
+      self.__remaining = 0
+
+  def __WriteBody(self, data):
+    """Queues body data, sending it once a chunk's worth is queued."""
+    if not self.__send_body:
+      self.__dropped += len(data)
+      return
+    if self.__remaining is not None:
+      if len(data) > self.__remaining:
+        self.__dropped += len(data) - self.__remaining
+        data = data[:self.__remaining]
+      self.__remaining -= len(data)
+    if not data:
+      return
+
+    self.__pending.append(data)
+    self.__pending_size += len(data)
+    if self.__pending_size >= STATIC_CHUNK_SIZE:
+      self.__Flush()
+
+  def __Flush(self):
+    """Sends the queued body data."""
+    if not self.__pending:
+      return
+    data = ''.join(self.__pending)
+    self.__pending = []
+    self.__pending_size = 0
+    if self.__chunked:
+      data = '%x\r\n%s\r\n' % (len(data), data)
+    self.__Send(data)
+
+  def __Send(self, data):
+    """Writes data to the client, discarding it if the client went away."""
+    if self.__disconnected:
+      return
+    try:
+      self.__wfile.write(data)
+    except (IOError, OSError, socket.error), e:
+      if e.args and e.args[0] in (errno.EPIPE, errno.ECONNRESET):
+        logging.debug('Client disconnected during streamed response')
+        self.__disconnected = True
+      else:
+        raise
+
+
+class BoundedInputFile(object):
+  """Read-only file that reads at most a given number of bytes from another.
+
+  Used to pass a request body to a handler straight from the client's
+  connection without reading past the end of the body.
+  """
+
+  def __init__(self, infile, length):
+    """Initializer.
+
+    Args:
+      infile: File-like object to read from.
+      length: Number of bytes that may be read from infile.
+    """
+    self.__infile = infile
+    self.__remaining = max(length, 0)
+
+  def read(self, size=-1):
+    """Reads at most size bytes, or up to the end of the input."""
+    if size is None or size < 0 or size > self.__remaining:
+      size = self.__remaining
+    if not size:
+      return ''
+    data = self.__infile.read(size)
+    self.__remaining -= len(data)
+    return data
+
+  def readline(self, size=-1):
+    """Reads one line, of at most size bytes."""
+    if size is None or size < 0 or size > self.__remaining:
+      size = self.__remaining
+    if not size:
+      return ''
+    data = self.__infile.readline(size)
+    self.__remaining -= len(data)
+    return data
+
+  def readlines(self, sizehint=0):
+    """Reads the remaining lines of the input."""
+    return list(self)
+
+  def __iter__(self):
+    """Iterates over the remaining lines of the input."""
+    return self
+
+  def next(self):
+    """Returns the next line of the input."""
+    line = self.readline()
+    if not line:
+      raise StopIteration
+    return line
+
+  def close(self):
+    """Does nothing; the input belongs to the client connection."""
 
 
 class ModuleManager(object):
@@ -2129,7 +2676,10 @@ def _ClearTemplateCache(module_dict=sys.modules):
     template_module.parser_cache.clear()
 
 
-def CreateRequestHandler(root_path, login_url, require_indexes=False):
+def CreateRequestHandler(root_path,
+                         login_url,
+                         require_indexes=False,
+                         stream_responses=False):
   """Creates a new BaseHTTPRequestHandler sub-class for use with the Python
   BaseHTTPServer module's HTTP server.
 
@@ -2142,11 +2692,16 @@ def CreateRequestHandler(root_path, login_url, require_indexes=False):
     root_path: Path to the root of the application running on the server.
     login_url: Relative URL which should be used for handling user logins.
     require_indexes: True if index.yaml is read-only gospel; default False.
+    stream_responses: True to send CGI output to the client as it is written
+      and to let handlers read request bodies straight from the connection,
+      instead of buffering both; default False.
 
   Returns:
     Sub-class of BaseHTTPRequestHandler.
   """
   application_module_dict = SetupSharedModules(sys.modules)
+  app_config_cache = AppConfigCache(root_path, application_module_dict,
+                                    login_url)
 
   if require_indexes:
     index_yaml_updater = None
@@ -2232,36 +2787,72 @@ def CreateRequestHandler(root_path, login_url, require_indexes=False):
         return
 
       tbhandler = cgitb.Hook(file=self.wfile).handle
+      outfile = None
+      streamed = False
+      app_request = False
       try:
-        if self.module_manager.AreModuleFilesModified():
-          self.module_manager.ResetModules()
-
-        implicit_matcher = CreateImplicitMatcher(self.module_dict,
-                                                 root_path,
-                                                 login_url)
-        config, explicit_matcher = LoadAppConfig(root_path, self.module_dict)
+        start = time.time()
+        config, implicit_matcher, explicit_matcher = (
+            app_config_cache.GetConfig())
+        logging.debug('Got application configuration in %.2f ms',
+                      (time.time() - start) * 1000)
         dispatcher = MatcherDispatcher(login_url,
                                        [implicit_matcher, explicit_matcher])
 
-        if require_indexes:
-          dev_appserver_index.SetupIndexes(config.application, root_path)
+        app_request = not isinstance(dispatcher.Match(self.path),
+                                     FileDispatcher)
+
+        content_length = int(self.headers.get('content-length', 0))
+        if stream_responses:
+          infile = BoundedInputFile(self.rfile, content_length)
+          outfile = StreamingResponseFile(
+              self._StartResponse,
+              self.wfile,
+              chunked=(self.protocol_version == 'HTTP/1.1' and
+                       self.request_version == 'HTTP/1.1'),
+              send_body=self.command != 'HEAD')
+        else:
+          infile = cStringIO.StringIO(self.rfile.read(content_length))
+          outfile = ResponseFile()
 
-        infile = cStringIO.StringIO(self.rfile.read(
-            int(self.headers.get('content-length', 0))))
-        outfile = cStringIO.StringIO()
-        try:
+        if app_request:
+          _execution_lock.acquire()
+          try:
+            self._ResetModifiedModules()
+            if require_indexes:
+              dev_appserver_index.SetupIndexes(config.application, root_path)
+            try:
+              dispatcher.Dispatch(self.path,
+                                  None,
+                                  self.headers,
+                                  infile,
+                                  outfile,
+                                  base_env_dict=env_dict)
+            finally:
+              self.module_manager.UpdateModuleFileModificationTimes()
+          finally:
+            _execution_lock.release()
+        else:
           dispatcher.Dispatch(self.path,
                               None,
                               self.headers,
                               infile,
                               outfile,
                               base_env_dict=env_dict)
-        finally:
-          self.module_manager.UpdateModuleFileModificationTimes()
 
-        outfile.flush()
-        outfile.seek(0)
-        status_code, status_message, header_data, body = RewriteResponse(outfile)
+        if stream_responses:
+          while infile.read(STATIC_CHUNK_SIZE):
+            pass
+
+        if outfile.response is not None:
+          status_code, status_message, header_data, body = outfile.response
+        elif stream_responses and outfile.Finish():
+          streamed = True
+        else:
+          outfile.flush()
+          outfile.seek(0)
+          status_code, status_message, header_data, body = (
+              RewriteResponse(outfile))
 
       except yaml_errors.EventListenerError, e:
         title = 'Fatal error when loading application configuration'
@@ -2273,18 +2864,16 @@ def CreateRequestHandler(root_path, login_url, require_indexes=False):
       except:
         msg = 'Exception encountered handling request'
         logging.exception(msg)
-        self.send_response(httplib.INTERNAL_SERVER_ERROR, msg)
-        tbhandler()
+        if isinstance(outfile, StreamingResponseFile) and outfile.started:
+          outfile.flush()
+          self.close_connection = 1
+        else:
+          self.send_response(httplib.INTERNAL_SERVER_ERROR, msg)
+          tbhandler()
       else:
         try:
-          self.send_response(status_code, status_message)
-          self.wfile.write(header_data)
-          self.wfile.write('\r\n')
-          if self.command != 'HEAD':
-            self.wfile.write(body)
-          elif body:
-            logging.warning('Dropping unexpected body in response '
-                            'to HEAD request')
+          if not streamed:
+            self._SendResponse(status_code, status_message, header_data, body)
         except (IOError, OSError), e:
           if e.errno != errno.EPIPE:
             raise e
@@ -2292,8 +2881,74 @@ def CreateRequestHandler(root_path, login_url, require_indexes=False):
           if len(e.args) >= 1 and e.args[0] != errno.EPIPE:
             raise e
         else:
-          if index_yaml_updater is not None:
-            index_yaml_updater.UpdateIndexYaml()
+          if app_request and index_yaml_updater is not None:
+            _execution_lock.acquire()
+            try:
+              index_yaml_updater.UpdateIndexYaml()
+            finally:
+              _execution_lock.release()
+
+    def _StartResponse(self, status_code, status_message, header_data):
+      """Sends the status line and headers of a response.
+
+      Args:
+        status_code: Integer HTTP response status.
+        status_message: String containing the status message.
+        header_data: String containing the HTTP headers, each ending with CRLF.
+      """
+      self.send_response(status_code, status_message)
+      self.wfile.write(header_data)
+      self.wfile.write('\r\n')
+
+    def _SendResponse(self, status_code, status_message, header_data, body):
+      """Sends a complete response to the client.
+
+      Args:
+        status_code, status_message, header_data: Passed to _StartResponse.
+        body: String containing the body, or an open file to send the body
+          from, which is closed afterwards.
+      """
+      try:
+        self._StartResponse(status_code, status_message, header_data)
+        if isinstance(body, basestring):
+          if self.command != 'HEAD':
+            self.wfile.write(body)
+          elif body:
+            logging.warning('Dropping unexpected body in response '
+                            'to HEAD request')
+        else:
+          self._SendFile(body)
+      finally:
+        if not isinstance(body, basestring):
+          body.close()
+
+    def _SendFile(self, body_file):
+      """Copies a response body from a file to the client in chunks.
+
+      Uses os.sendfile() where the platform's Python provides it.
+
+      Args:
+        body_file: File to send, read from its start.
+      """
+      sendfile = getattr(os, 'sendfile', None)
+      if sendfile is None:
+        shutil.copyfileobj(body_file, self.wfile, STATIC_CHUNK_SIZE)
+        return
+
+      self.wfile.flush()
+      out_fd = self.connection.fileno()
+      in_fd = body_file.fileno()
+      offset = 0
+      while True:
+        sent = sendfile(out_fd, in_fd, offset, STATIC_CHUNK_SIZE)
+        if not sent:
+          break
+        offset += sent
+
+    def _ResetModifiedModules(self):
+      """Clears the application's modules if any of their files changed."""
+      if self.module_manager.AreModuleFilesModified():
+        self.module_manager.ResetModules()
 
     def log_error(self, format, *args):
       """Redirect error messages through the logging module."""
@@ -2306,12 +2961,13 @@ def CreateRequestHandler(root_path, login_url, require_indexes=False):
   return DevAppServerRequestHandler
 
 
-def ReadAppConfig(appinfo_path, parse_app_config=appinfo.LoadSingleAppInfo):
+def ReadAppConfig(appinfo_path, parse_app_config=appinfo.LoadSingleAppInfo,
+                  openfile=file):
   """Reads app.yaml file and returns its app id and list of URLMap instances.
 
   Args:
     appinfo_path: String containing the path to the app.yaml file.
-    parse_app_config: Used for dependency injection.
+    parse_app_config, openfile: Used for dependency injection.
 
   Returns:
     AppInfoExternal instance.
@@ -2322,7 +2978,7 @@ def ReadAppConfig(appinfo_path, parse_app_config=appinfo.LoadSingleAppInfo):
     exception.
   """
   try:
-    appinfo_file = file(appinfo_path, 'r')
+    appinfo_file = openfile(appinfo_path, 'r')
     try:
       return parse_app_config(appinfo_file)
     finally:
@@ -2338,7 +2994,8 @@ def CreateURLMatcherFromMaps(root_path,
                              create_url_matcher=URLMatcher,
                              create_cgi_dispatcher=CGIDispatcher,
                              create_file_dispatcher=FileDispatcher,
-                             create_path_adjuster=PathAdjuster):
+                             create_path_adjuster=PathAdjuster,
+                             default_expiration=None):
   """Creates a URLMatcher instance from URLMap.
 
   Creates all of the correct URLDispatcher instances to handle the various
@@ -2354,6 +3011,8 @@ def CreateURLMatcherFromMaps(root_path,
       sys.modules dictionary.
     create_url_matcher, create_cgi_dispatcher, create_file_dispatcher,
     create_path_adjuster: Used for dependency injection.
+    default_expiration: String describing the default cache expiration time
+      for static files, as in app.yaml, or None.
 
   Returns:
     Instance of URLMatcher with the supplied URLMap objects properly loaded.
@@ -2362,7 +3021,7 @@ def CreateURLMatcherFromMaps(root_path,
   path_adjuster = create_path_adjuster(root_path)
   cgi_dispatcher = create_cgi_dispatcher(module_dict, root_path, path_adjuster)
   file_dispatcher = create_file_dispatcher(path_adjuster,
-      StaticFileMimeTypeMatcher(url_map_list, path_adjuster))
+      StaticFileConfigMatcher(url_map_list, path_adjuster, default_expiration))
 
   for url_map in url_map_list:
     admin_only = url_map.login == appinfo.LOGIN_ADMIN
@@ -2419,7 +3078,8 @@ def LoadAppConfig(root_path,
 
         matcher = create_matcher(root_path,
                                  config.handlers,
-                                 module_dict)
+                                 module_dict,
+                                 default_expiration=config.default_expiration)
 
         return (config, matcher)
       except gexcept.AbstractMethod:
@@ -2439,6 +3099,12 @@ def SetupStubs(app_id, **config):
     datastore_path: Path to the file to store Datastore file stub data in.
     history_path: Path to the file to store Datastore history in.
     clear_datastore: If the datastore and history should be cleared on startup.
+    datastore_write_log: If datastore writes should be appended to a log
+      instead of rewriting the datastore file.
+    datastore_compact: If the datastore should keep entities in memory
+      encoded, to save memory.
+    use_sqlite: If the datastore should be kept in an SQLite database at
+      datastore_path instead of in memory.
     smtp_host: SMTP host used for sending test mail.
     smtp_port: SMTP port.
     smtp_user: SMTP user.
@@ -2451,6 +3117,9 @@ def SetupStubs(app_id, **config):
   history_path = config['history_path']
   clear_datastore = config['clear_datastore']
   require_indexes = config.get('require_indexes', False)
+  datastore_write_log = config.get('datastore_write_log', False)
+  datastore_compact = config.get('datastore_compact', False)
+  use_sqlite = config.get('use_sqlite', False)
   smtp_host = config.get('smtp_host', None)
   smtp_port = config.get('smtp_port', 25)
   smtp_user = config.get('smtp_user', '')
@@ -2459,7 +3128,9 @@ def SetupStubs(app_id, **config):
   remove = config.get('remove', os.remove)
 
   if clear_datastore:
-    for path in (datastore_path, history_path):
+    log_paths = datastore_file_stub.DatastoreFileStub.LogFilenames(
+        datastore_path)
+    for path in [datastore_path, history_path] + log_paths:
       if os.path.lexists(path):
         logging.info('Attempting to remove file at %s', path)
         try:
@@ -2468,9 +3139,16 @@ def SetupStubs(app_id, **config):
           logging.warning('Removing file failed: %s', e)
 
   apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+  apiproxy_stub_map.apiproxy.AddPostCallHook(dev_appserver_stats.collector)
 
-  datastore = datastore_file_stub.DatastoreFileStub(
-      app_id, datastore_path, history_path, require_indexes=require_indexes)
+  if use_sqlite:
+    from google.appengine.api import datastore_sqlite_stub
+    datastore = datastore_sqlite_stub.DatastoreSqliteStub(
+        app_id, datastore_path, require_indexes=require_indexes)
+  else:
+    datastore = datastore_file_stub.DatastoreFileStub(
+        app_id, datastore_path, history_path, require_indexes=require_indexes,
+        use_write_log=datastore_write_log, compact_storage=datastore_compact)
   apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', datastore)
 
   fixed_login_url = '%s?%s=%%s' % (login_url,
@@ -2531,6 +3209,14 @@ def CreateImplicitMatcher(module_dict,
                      False)
 
 
+  stats_dispatcher = create_local_dispatcher(sys.modules, path_adjuster,
+                                             dev_appserver_stats.main)
+  url_matcher.AddURL('/_ah/stats',
+                     stats_dispatcher,
+                     '',
+                     False,
+                     False)
+
   admin_dispatcher = create_cgi_dispatcher(module_dict, root_path,
                                            path_adjuster)
   url_matcher.AddURL('/_ah/admin(?:/.*)?',
@@ -2542,6 +3228,92 @@ def CreateImplicitMatcher(module_dict,
   return url_matcher
 
 
+class AppConfigCache(object):
+  """Keeps an application's configuration and URL matchers between requests.
+
+  Reading app.yaml and compiling the handler patterns takes many milliseconds,
+  so they are only loaded again once app.yaml (or app.yml) has been created,
+  removed or modified, as shown by its modification time and size. The
+  matcher for the internal URLs never changes, so it is created once.
+
+  Attributes:
+    load_count: int, how many times the configuration has been loaded
+    load_time: float, how long the last load took, in seconds
+  """
+
+  def __init__(self,
+               root_path,
+               module_dict,
+               login_url,
+               load_app_config=LoadAppConfig,
+               create_implicit_matcher=CreateImplicitMatcher,
+               stat=os.stat):
+    """Initializer.
+
+    Args:
+      root_path: Path to the root of the application.
+      module_dict: Dictionary in which application-loaded modules should be
+        preserved between requests. This dictionary must be separate from the
+        sys.modules dictionary.
+      login_url: Relative URL which should be used for handling user logins.
+      load_app_config, create_implicit_matcher, stat: Used for dependency
+        injection.
+    """
+    self._root_path = root_path
+    self._module_dict = module_dict
+    self._load_app_config = load_app_config
+    self._stat = stat
+    self._implicit_matcher = create_implicit_matcher(module_dict, root_path,
+                                                     login_url)
+    self._lock = threading.Lock()
+    self._signature = None
+    self._config = None
+    self._explicit_matcher = None
+    self.load_count = 0
+    self.load_time = 0.0
+
+  def _Signature(self):
+    """Returns the modification times and sizes of the configuration files.
+    """
+    signature = []
+    for appinfo_path in [os.path.join(self._root_path, 'app.yaml'),
+                         os.path.join(self._root_path, 'app.yml')]:
+      try:
+        stat = self._stat(appinfo_path)
+        signature.append((stat.st_mtime, stat.st_size))
+      except OSError:
+        signature.append(None)
+    return tuple(signature)
+
+  def GetConfig(self):
+    """Returns the application's configuration and URL matchers, loading them
+    again if the configuration files have changed.
+
+    Raises an InvalidAppConfigError exception, or an exception from the YAML
+    parser, if the configuration can't be loaded.
+
+    Returns:
+      tuple: (AppInfoExternal, implicit URLMatcher, explicit URLMatcher)
+    """
+    signature = self._Signature()
+    self._lock.acquire()
+    try:
+      if signature != self._signature:
+        start = time.time()
+        config, matcher = self._load_app_config(self._root_path,
+                                                self._module_dict)
+        self.load_time = time.time() - start
+        self.load_count += 1
+        self._signature = signature
+        self._config = config
+        self._explicit_matcher = matcher
+        logging.info('Loaded application configuration in %.1f ms',
+                     self.load_time * 1000)
+      return self._config, self._implicit_matcher, self._explicit_matcher
+    finally:
+      self._lock.release()
+
+
 def SetupTemplates(template_dir):
   """Reads debugging console template files and initializes the console.
 
@@ -2568,13 +3340,26 @@ def SetupTemplates(template_dir):
   ApplicationLoggingHandler.InitializeTemplates(header, script, middle, footer)
 
 
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn,
+                         BaseHTTPServer.HTTPServer):
+  """HTTPServer that handles each request on a new thread.
+
+  Only static files are served concurrently, with each other and with the
+  application. Every other request runs application code in process-global
+  state, so those requests still run one at a time; see _execution_lock.
+  """
+  daemon_threads = True
+
+
 def CreateServer(root_path,
                  login_url,
                  port,
                  template_dir,
                  serve_address='',
                  require_indexes=False,
-                 python_path_list=sys.path):
+                 python_path_list=sys.path,
+                 threaded_static_files=False,
+                 stream_responses=False):
   """Creates an new HTTPServer for an application.
 
   Args:
@@ -2587,6 +3372,11 @@ def CreateServer(root_path,
     serve_address: Address on which the server should serve.
     require_indexes: True if index.yaml is read-only gospel; default False.
     python_path_list: Used for dependency injection.
+    threaded_static_files: True to serve static files on their own threads,
+      concurrently with the application; default False. Application
+      handlers still run one at a time.
+    stream_responses: True to stream request and response bodies instead of
+      buffering them; default False. See CreateRequestHandler.
 
   Returns:
     Instance of BaseHTTPServer.HTTPServer that's ready to start accepting.
@@ -2599,9 +3389,11 @@ def CreateServer(root_path,
                             template_dir])
 
   handler_class = CreateRequestHandler(absolute_root_path, login_url,
-                                       require_indexes)
+                                       require_indexes, stream_responses)
 
   if absolute_root_path not in python_path_list:
     python_path_list.insert(0, absolute_root_path)
 
+  if threaded_static_files:
+    return ThreadedHTTPServer((serve_address, port), handler_class)
   return BaseHTTPServer.HTTPServer((serve_address, port), handler_class)
@@ -26,6 +26,7 @@ from google.appengine.api import apiproxy_stub_map
 from google.appengine.api import datastore_admin
 from google.appengine.api import yaml_errors
 from google.appengine.datastore import datastore_index
+from google.appengine.datastore import entity_pb
 
 import yaml
 
@@ -238,6 +239,9 @@ def SetupIndexes(app_id, root_path):
   Note: this is similar to the algorithm used by the admin console for
   the same purpose.
 
+  New indexes are moved straight to the READ_WRITE state, since the datastore
+  stub builds an index's rows the first time a query needs them.
+
   Args:
     app_id: Application ID being served.
     root_path: Path to the root of the application.
@@ -272,6 +276,8 @@ def SetupIndexes(app_id, root_path):
   for key, index in requested.iteritems():
     if key not in existing:
       datastore_admin.CreateIndex(index)
+      index.set_state(entity_pb.CompositeIndex.READ_WRITE)
+      datastore_admin.UpdateIndex(index)
       created += 1
 
   deleted = 0
@@ -33,8 +33,28 @@ Options:
                              (Default %(datastore_path)s)
   --history_path=PATH        Path to use for storing Datastore history.
                              (Default %(history_path)s)
+  --datastore_write_log      Append Datastore writes to a log next to the
+                             Datastore file instead of rewriting the whole
+                             file on every write. (Default false)
+  --datastore_compact        Keep Datastore entities in memory encoded, which
+                             uses much less memory for large datastores but
+                             makes queries slower. (Default false)
+  --use_sqlite               Keep the Datastore in an SQLite database at the
+                             Datastore path instead of loading it all into
+                             memory. Query history is kept in the database
+                             too. Unless --datastore_path is given, the
+                             database is at %(sqlite_datastore_path)s.
+                             (Default false)
   --require_indexes          Disallows queries that require composite indexes
                              not defined in index.yaml.
+  --threaded_static_files    Serve static files on their own threads, so they
+                             are served while a handler is running. This
+                             does not make handlers concurrent: they still
+                             run one at a time. (Default false)
+  --stream_responses         Send handler output to the browser as it is
+                             written, and let handlers read request bodies
+                             as they arrive, instead of buffering them.
+                             (Default false)
   --smtp_host=HOSTNAME       SMTP host to send test mail to.  Leaving this
                              unset will disable SMTP mail sending.
                              (Default '%(smtp_host)s')
@@ -75,7 +95,9 @@ ARG_ADMIN_CONSOLE_SERVER = 'admin_console_server'
 ARG_ADMIN_CONSOLE_HOST = 'admin_console_host'
 ARG_AUTH_DOMAIN = 'auth_domain'
 ARG_CLEAR_DATASTORE = 'clear_datastore'
+ARG_DATASTORE_COMPACT = 'datastore_compact'
 ARG_DATASTORE_PATH = 'datastore_path'
+ARG_DATASTORE_WRITE_LOG = 'datastore_write_log'
 ARG_DEBUG_IMPORTS = 'debug_imports'
 ARG_ENABLE_SENDMAIL = 'enable_sendmail'
 ARG_HISTORY_PATH = 'history_path'
@@ -87,12 +109,18 @@ ARG_SMTP_HOST = 'smtp_host'
 ARG_SMTP_PASSWORD = 'smtp_password'
 ARG_SMTP_PORT = 'smtp_port'
 ARG_SMTP_USER = 'smtp_user'
+ARG_STREAM_RESPONSES = 'stream_responses'
 ARG_TEMPLATE_DIR = 'template_dir'
+ARG_THREADED_STATIC_FILES = 'threaded_static_files'
+ARG_USE_SQLITE = 'use_sqlite'
 
 
 BASE_PATH = os.path.abspath(
   os.path.join(os.path.dirname(dev_appserver.__file__), '../../../'))
 
+DEFAULT_SQLITE_DATASTORE_PATH = os.path.join(tempfile.gettempdir(),
+                                             'dev_appserver.sqlite')
+
 DEFAULT_ARGS = {
   ARG_PORT: 8080,
   ARG_LOG_LEVEL: logging.INFO,
@@ -102,7 +130,12 @@ DEFAULT_ARGS = {
                                  'dev_appserver.datastore.history'),
   ARG_LOGIN_URL: '/_ah/login',
   ARG_CLEAR_DATASTORE: False,
+  ARG_DATASTORE_WRITE_LOG: False,
+  ARG_DATASTORE_COMPACT: False,
   ARG_REQUIRE_INDEXES: False,
+  ARG_THREADED_STATIC_FILES: False,
+  ARG_STREAM_RESPONSES: False,
+  ARG_USE_SQLITE: False,
   ARG_TEMPLATE_DIR: os.path.join(BASE_PATH, 'templates'),
   ARG_SMTP_HOST: '',
   ARG_SMTP_PORT: 25,
@@ -124,6 +157,7 @@ def PrintUsageExit(code):
   """
   render_dict = DEFAULT_ARGS.copy()
   render_dict['script'] = os.path.basename(sys.argv[0])
+  render_dict['sqlite_datastore_path'] = DEFAULT_SQLITE_DATASTORE_PATH
   print sys.modules['__main__'].__doc__ % render_dict
   sys.stdout.flush()
   sys.exit(code)
@@ -154,7 +188,9 @@ def ParseArguments(argv):
         'admin_console_host=',
         'auth_domain=',
         'clear_datastore',
+        'datastore_compact',
         'datastore_path=',
+        'datastore_write_log',
         'debug',
         'debug_imports',
         'enable_sendmail',
@@ -167,12 +203,16 @@ def ParseArguments(argv):
         'smtp_password=',
         'smtp_port=',
         'smtp_user=',
+        'stream_responses',
         'template_dir=',
+        'threaded_static_files',
+        'use_sqlite',
       ])
   except getopt.GetoptError, e:
     print >>sys.stderr, 'Error: %s' % e
     PrintUsageExit(1)
 
+  datastore_path_given = False
   for option, value in opts:
     if option in ('-h', '--help'):
       PrintUsageExit(0)
@@ -194,6 +234,13 @@ def ParseArguments(argv):
 
     if option == '--datastore_path':
       option_dict[ARG_DATASTORE_PATH] = value
+      datastore_path_given = True
+
+    if option == '--datastore_write_log':
+      option_dict[ARG_DATASTORE_WRITE_LOG] = True
+
+    if option == '--datastore_compact':
+      option_dict[ARG_DATASTORE_COMPACT] = True
 
     if option == '--login_url':
       option_dict[ARG_LOGIN_URL] = value
@@ -207,6 +254,12 @@ def ParseArguments(argv):
     if option == '--require_indexes':
       option_dict[ARG_REQUIRE_INDEXES] = True
 
+    if option == '--threaded_static_files':
+      option_dict[ARG_THREADED_STATIC_FILES] = True
+
+    if option == '--stream_responses':
+      option_dict[ARG_STREAM_RESPONSES] = True
+
     if option == '--smtp_host':
       option_dict[ARG_SMTP_HOST] = value
 
@@ -237,12 +290,18 @@ def ParseArguments(argv):
     if option == '--template_dir':
       option_dict[ARG_TEMPLATE_DIR] = value
 
+    if option == '--use_sqlite':
+      option_dict[ARG_USE_SQLITE] = True
+
     if option == '--admin_console_server':
       option_dict[ARG_ADMIN_CONSOLE_SERVER] = value.strip()
 
     if option == '--admin_console_host':
       option_dict[ARG_ADMIN_CONSOLE_HOST] = value
 
+  if option_dict[ARG_USE_SQLITE] and not datastore_path_given:
+    option_dict[ARG_DATASTORE_PATH] = DEFAULT_SQLITE_DATASTORE_PATH
+
   return args, option_dict
 
 
@@ -288,7 +347,10 @@ def main(argv):
 
   config = None
   try:
+    start = time.time()
     config, matcher = dev_appserver.LoadAppConfig(root_path, {})
+    logging.info('Loaded application configuration in %.1f ms',
+                 (time.time() - start) * 1000)
   except yaml_errors.EventListenerError, e:
     logging.error('Fatal error when loading application configuration:\n' +
                   str(e))
@@ -318,7 +380,11 @@ def main(argv):
                                            port,
                                            template_dir,
                                            serve_address=serve_address,
-                                           require_indexes=require_indexes)
+                                           require_indexes=require_indexes,
+                                           threaded_static_files=option_dict[
+                                               ARG_THREADED_STATIC_FILES],
+                                           stream_responses=option_dict[
+                                               ARG_STREAM_RESPONSES])
 
   logging.info('Running application %s on port %d: http://%s:%d',
                config.application, port, serve_address, port)
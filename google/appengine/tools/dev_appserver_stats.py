@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+#
+# Copyright 2007 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Helper CGI that shows API call statistics in the development app server.
+
+The statistics are kept by the module's collector, which SetupStubs() in
+dev_appserver adds to the API proxy as a post-call hook. This CGI has one
+parameter:
+
+  action: If 'Reset', discard the statistics collected so far and redirect
+    back to the page.
+
+To see the calls a single page makes, reset the statistics, load the page, and
+then reload this one.
+"""
+
+
+import cgi
+import os
+import time
+
+from google.appengine.api import apiproxy_stub_map
+
+
+RESET_ACTION = 'Reset'
+
+ACTION_PARAM = 'action'
+
+collector = apiproxy_stub_map.CallStatsCollector()
+
+
+PAGE_TEMPLATE = """<html>
+<head>
+<title>API Call Statistics</title>
+<style type="text/css">
+body { font-family: arial, sans-serif; }
+table { border-collapse: collapse; }
+th, td { border: 1px solid #ccc; padding: 2px 6px; text-align: right; }
+th { background-color: #eee; }
+td.call { text-align: left; }
+</style>
+</head>
+<body>
+<h3>API Call Statistics</h3>
+<p>%(total_calls)d calls in the %(seconds)d seconds since the statistics were
+last reset, slowest first by total time. Percentiles are the upper bounds of
+the latency buckets they fall in.</p>
+<form method="post" action="%(path)s">
+<input type="hidden" name="%(action_param)s" value="%(reset_action)s">
+<input type="submit" value="Reset">
+</form>
+<table>
+<tr>
+<th>Call</th><th>Calls</th><th>Errors</th><th>Total ms</th><th>Mean ms</th>
+<th>50%% ms</th><th>90%% ms</th><th>99%% ms</th><th>Max ms</th>
+<th>Mean request bytes</th><th>Mean response bytes</th>
+%(bucket_headers)s
+</tr>
+%(rows)s
+</table>
+</body>
+</html>
+"""
+
+ROW_TEMPLATE = """<tr>
+<td class="call">%(service)s.%(call)s</td><td>%(count)d</td>
+<td>%(errors)d</td><td>%(total_ms).1f</td><td>%(mean_ms).1f</td>
+<td>%(p50)s</td><td>%(p90)s</td><td>%(p99)s</td><td>%(max_ms).1f</td>
+<td>%(request_bytes)d</td><td>%(response_bytes)d</td>
+%(buckets)s
+</tr>"""
+
+
+def _FormatBucket(index):
+  """Returns the heading of a latency bucket.
+
+  Args:
+    index: int, index into CallStatsCollector.LATENCY_BUCKETS, or its length
+      for the bucket of calls longer than all of them.
+
+  Returns:
+    string
+  """
+  buckets = apiproxy_stub_map.CallStatsCollector.LATENCY_BUCKETS
+  if index < len(buckets):
+    return '&le;%g ms' % (buckets[index] * 1000)
+  return '&gt;%g ms' % (buckets[-1] * 1000)
+
+
+def _Percentile(histogram, fraction):
+  """Estimates a latency percentile from a histogram.
+
+  Args:
+    histogram: list of counts, as in CallStatsCollector.Snapshot()
+    fraction: float between 0 and 1
+
+  Returns:
+    string, the heading of the bucket the percentile falls in
+  """
+  target = fraction * sum(histogram)
+  seen = 0
+  for index, count in enumerate(histogram):
+    seen += count
+    if count and seen >= target:
+      return _FormatBucket(index)
+  return ''
+
+
+def RenderStats(snapshot, start_time, path, now=None):
+  """Renders statistics as an HTML page.
+
+  Args:
+    snapshot: dict, as returned by CallStatsCollector.Snapshot()
+    start_time: float, when the statistics were last reset
+    path: string, the URL of the page, for the reset form
+    now: float, the current time. Used for dependency injection.
+
+  Returns:
+    string
+  """
+  if now is None:
+    now = time.time()
+
+  items = snapshot.items()
+  items.sort(key=lambda item: item[1]['total_time'], reverse=True)
+
+  rows = []
+  total_calls = 0
+  for (service, call), stats in items:
+    count = stats['count']
+    total_calls += count
+    histogram = stats['histogram']
+    rows.append(ROW_TEMPLATE % {
+        'service': cgi.escape(service),
+        'call': cgi.escape(call),
+        'count': count,
+        'errors': stats['errors'],
+        'total_ms': stats['total_time'] * 1000,
+        'mean_ms': stats['total_time'] * 1000 / count,
+        'p50': _Percentile(histogram, 0.5),
+        'p90': _Percentile(histogram, 0.9),
+        'p99': _Percentile(histogram, 0.99),
+        'max_ms': stats['max_time'] * 1000,
+        'request_bytes': stats['request_bytes'] / count,
+        'response_bytes': stats['response_bytes'] / count,
+        'buckets': ''.join(['<td>%d</td>' % bucket for bucket in histogram]),
+        })
+
+  bucket_count = len(apiproxy_stub_map.CallStatsCollector.LATENCY_BUCKETS) + 1
+  bucket_headers = ''.join(['<th>%s</th>' % _FormatBucket(index)
+                            for index in xrange(bucket_count)])
+  return PAGE_TEMPLATE % {
+      'total_calls': total_calls,
+      'seconds': now - start_time,
+      'path': cgi.escape(path, True),
+      'action_param': ACTION_PARAM,
+      'reset_action': RESET_ACTION,
+      'bucket_headers': bucket_headers,
+      'rows': '\n'.join(rows),
+      }
+
+
+def main():
+  """Runs the API call statistics CGI."""
+  form = cgi.FieldStorage()
+  path = os.environ['PATH_INFO']
+
+  if form.getfirst(ACTION_PARAM) == RESET_ACTION:
+    collector.Reset()
+    print 'Status: 302 Redirecting to statistics page'
+    print 'Location: %s' % path
+    print
+    return
+
+  print 'Content-Type: text/html'
+  print 'Cache-Control: no-cache'
+  print
+  print RenderStats(collector.Snapshot(), collector.StartTime(), path)
+
+
+if __name__ == '__main__':
+  main()
@@ -30,6 +30,26 @@ __all__ = ['ProtocolMessage', 'Encoder', 'Decoder',
 
 URL_RE = re.compile('^(https?)://([^/]+)(/.*)$')
 
+_UINT64_LIMIT = 1L << 64
+_INT64_MIN = -(1L << 63)
+_INT64_MAX = (1L << 63) - 1
+_INT32_MIN = -(1L << 31)
+_INT32_MAX = (1L << 31) - 1
+
+
+def _VarUint64Bytes(v):
+  """Returns the varint encoding of a non-negative integer as a string."""
+  bytes = []
+  while v > 127:
+    bytes.append(chr((v & 127) | 128))
+    v >>= 7
+  bytes.append(chr(v))
+  return ''.join(bytes)
+
+
+_VARINT_TABLE_SIZE = 1 << 14
+_VARINT_TABLE = [_VarUint64Bytes(v) for v in xrange(_VARINT_TABLE_SIZE)]
+
 class ProtocolMessage:
 
 
@@ -180,12 +200,15 @@ class ProtocolMessage:
   def lengthVarInt64(self, n):
     if n < 0:
       return 10
-    result = 0
-    while 1:
+    if n < (1 << 7):
+      return 1
+    if n < (1 << 14):
+      return 2
+    result = 2
+    n >>= 14
+    while n:
       result += 1
       n >>= 7
-      if n == 0:
-        break
     return result
 
   def lengthString(self, n):
@@ -246,73 +269,64 @@ class Encoder:
 
   def put8(self, v):
     if v < 0 or v >= (1<<8): raise ProtocolBufferEncodeError, "u8 too big"
-    self.buf.append(v & 255)
+    self.buf.append(v)
     return
 
   def put16(self, v):
     if v < 0 or v >= (1<<16): raise ProtocolBufferEncodeError, "u16 too big"
-    self.buf.append((v >> 0) & 255)
-    self.buf.append((v >> 8) & 255)
+    self.buf.fromstring(struct.pack("<H", v))
     return
 
   def put32(self, v):
     if v < 0 or v >= (1L<<32): raise ProtocolBufferEncodeError, "u32 too big"
-    self.buf.append((v >> 0) & 255)
-    self.buf.append((v >> 8) & 255)
-    self.buf.append((v >> 16) & 255)
-    self.buf.append((v >> 24) & 255)
+    self.buf.fromstring(struct.pack("<I", v))
     return
 
   def put64(self, v):
     if v < 0 or v >= (1L<<64): raise ProtocolBufferEncodeError, "u64 too big"
-    self.buf.append((v >> 0) & 255)
-    self.buf.append((v >> 8) & 255)
-    self.buf.append((v >> 16) & 255)
-    self.buf.append((v >> 24) & 255)
-    self.buf.append((v >> 32) & 255)
-    self.buf.append((v >> 40) & 255)
-    self.buf.append((v >> 48) & 255)
-    self.buf.append((v >> 56) & 255)
+    self.buf.fromstring(struct.pack("<Q", v))
     return
 
   def putVarInt32(self, v):
-    if v >= (1L << 31) or v < -(1L << 31):
+    if 0 <= v < 128:
+      self.buf.append(v)
+      return
+    if v > _INT32_MAX or v < _INT32_MIN:
       raise ProtocolBufferEncodeError, "int32 too big"
     self.putVarInt64(v)
     return
 
   def putVarInt64(self, v):
-    if v >= (1L << 63) or v < -(1L << 63):
+    if 0 <= v < _VARINT_TABLE_SIZE:
+      self.buf.fromstring(_VARINT_TABLE[v])
+      return
+    if v > _INT64_MAX or v < _INT64_MIN:
       raise ProtocolBufferEncodeError, "int64 too big"
     if v < 0:
-      v += (1L << 64)
+      v += _UINT64_LIMIT
     self.putVarUint64(v)
     return
 
   def putVarUint64(self, v):
-    if v < 0 or v >= (1L << 64):
+    if 0 <= v < _VARINT_TABLE_SIZE:
+      self.buf.fromstring(_VARINT_TABLE[v])
+      return
+    if v < 0 or v >= _UINT64_LIMIT:
       raise ProtocolBufferEncodeError, "uint64 too big"
-    while 1:
-      bits = v & 127
+    append = self.buf.append
+    while v > 127:
+      append((v & 127) | 128)
       v >>= 7
-      if (v != 0):
-        bits |= 128
-      self.buf.append(bits)
-      if v == 0:
-        break
+    append(v)
     return
 
 
   def putFloat(self, v):
-    a = array.array('B')
-    a.fromstring(struct.pack("f", v))
-    self.buf.extend(a)
+    self.buf.fromstring(struct.pack("f", v))
     return
 
   def putDouble(self, v):
-    a = array.array('B')
-    a.fromstring(struct.pack("d", v))
-    self.buf.extend(a)
+    self.buf.fromstring(struct.pack("d", v))
     return
 
   def putBoolean(self, v):
@@ -324,15 +338,11 @@ class Encoder:
 
   def putPrefixedString(self, v):
     self.putVarInt32(len(v))
-    a = array.array('B')
-    a.fromstring(v)
-    self.buf.extend(a)
+    self.buf.fromstring(v)
     return
 
   def putRawString(self, v):
-    a = array.array('B')
-    a.fromstring(v)
-    self.buf.extend(a)
+    self.buf.fromstring(v)
 
 
 class Decoder:
@@ -389,70 +399,70 @@ class Decoder:
 
   def get16(self):
     if self.idx + 2 > self.limit: raise ProtocolBufferDecodeError, "truncated"
-    c = self.buf[self.idx]
-    d = self.buf[self.idx + 1]
+    c = struct.unpack_from("<H", self.buf, self.idx)[0]
     self.idx += 2
-    return (d << 8) | c
+    return c
 
   def get32(self):
     if self.idx + 4 > self.limit: raise ProtocolBufferDecodeError, "truncated"
-    c = self.buf[self.idx]
-    d = self.buf[self.idx + 1]
-    e = self.buf[self.idx + 2]
-    f = long(self.buf[self.idx + 3])
+    c = struct.unpack_from("<I", self.buf, self.idx)[0]
     self.idx += 4
-    return (f << 24) | (e << 16) | (d << 8) | c
+    return long(c)
 
   def get64(self):
     if self.idx + 8 > self.limit: raise ProtocolBufferDecodeError, "truncated"
-    c = self.buf[self.idx]
-    d = self.buf[self.idx + 1]
-    e = self.buf[self.idx + 2]
-    f = long(self.buf[self.idx + 3])
-    g = long(self.buf[self.idx + 4])
-    h = long(self.buf[self.idx + 5])
-    i = long(self.buf[self.idx + 6])
-    j = long(self.buf[self.idx + 7])
+    c = struct.unpack_from("<Q", self.buf, self.idx)[0]
     self.idx += 8
-    return ((j << 56) | (i << 48) | (h << 40) | (g << 32) | (f << 24)
-            | (e << 16) | (d << 8) | c)
+    return long(c)
 
   def getVarInt32(self):
+    idx = self.idx
+    if idx < self.limit:
+      b = self.buf[idx]
+      if b < 128:
+        self.idx = idx + 1
+        return long(b)
     v = self.getVarInt64()
-    if v >= (1L << 31) or v < -(1L << 31):
+    if v > _INT32_MAX or v < _INT32_MIN:
       raise ProtocolBufferDecodeError, "corrupted"
     return v
 
   def getVarInt64(self):
     result = self.getVarUint64()
-    if result >= (1L << 63):
-      result -= (1L << 64)
+    if result > _INT64_MAX:
+      result -= _UINT64_LIMIT
     return result
 
   def getVarUint64(self):
-    result = long(0)
+    buf = self.buf
+    idx = self.idx
+    limit = self.limit
+    result = 0
     shift = 0
     while 1:
       if shift >= 64: raise ProtocolBufferDecodeError, "corrupted"
-      b = self.get8()
-      result |= (long(b & 127) << shift)
+      if idx >= limit: raise ProtocolBufferDecodeError, "truncated"
+      b = buf[idx]
+      idx += 1
+      result |= (b & 127) << shift
       shift += 7
-      if (b & 128) == 0:
-        if result >= (1L << 64): raise ProtocolBufferDecodeError, "corrupted"
-        return result
-    return result
+      if b < 128:
+        break
+    self.idx = idx
+    if result >= _UINT64_LIMIT: raise ProtocolBufferDecodeError, "corrupted"
+    return long(result)
 
   def getFloat(self):
     if self.idx + 4 > self.limit: raise ProtocolBufferDecodeError, "truncated"
-    a = self.buf[self.idx:self.idx+4]
+    c = struct.unpack_from("f", self.buf, self.idx)[0]
     self.idx += 4
-    return struct.unpack("f", a)[0]
+    return c
 
   def getDouble(self):
     if self.idx + 8 > self.limit: raise ProtocolBufferDecodeError, "truncated"
-    a = self.buf[self.idx:self.idx+8]
+    c = struct.unpack_from("d", self.buf, self.idx)[0]
     self.idx += 8
-    return struct.unpack("d", a)[0]
+    return c
 
   def getBoolean(self):
     b = self.get8()
@@ -461,16 +471,17 @@ class Decoder:
 
   def getPrefixedString(self):
     length = self.getVarInt32()
+    if length < 0: raise ProtocolBufferDecodeError, "corrupted"
     if self.idx + length > self.limit:
       raise ProtocolBufferDecodeError, "truncated"
-    r = self.buf[self.idx : self.idx + length]
+    r = str(buffer(self.buf, self.idx, length))
     self.idx += length
-    return r.tostring()
+    return r
 
   def getRawString(self):
-    r = self.buf[self.idx:self.limit]
+    r = str(buffer(self.buf, self.idx, self.limit - self.idx))
     self.idx = self.limit
-    return r.tostring()
+    return r
 
 
 class ProtocolBufferDecodeError(Exception): pass
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+#
+# Copyright 2007 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Times fetch(1000) on a db.Model with 15 properties.
+
+Model.from_entity() fills in instances from a compiled loader instead of
+calling the model's constructor, and only fully validates property values
+when db.VALIDATE_ON_LOAD is set. This script checks that the loader builds
+the same instances as the constructor, then times fetch(1000) and
+from_entity() on 1000 entities:
+
+  - with the loader,
+  - with the loader and VALIDATE_ON_LOAD,
+  - through the constructor, as before the loader.
+
+The entities are kept in a DatastoreFileStub in memory.
+
+Usage:
+  tools/benchmarks/model_fetch_benchmark.py
+"""
+
+
+import datetime
+import os
+import sys
+import time
+
+DIR_PATH = os.path.abspath(os.path.dirname(os.path.dirname(
+               os.path.dirname(os.path.realpath(__file__)))))
+
+EXTRA_PATHS = [
+  DIR_PATH,
+  os.path.join(DIR_PATH, 'lib', 'django'),
+  os.path.join(DIR_PATH, 'lib', 'webob'),
+  os.path.join(DIR_PATH, 'lib', 'yaml', 'lib'),
+]
+
+sys.path = EXTRA_PATHS + sys.path
+os.environ.setdefault('APPLICATION_ID', 'benchmark')
+os.environ.setdefault('AUTH_DOMAIN', 'gmail.com')
+os.environ.setdefault('USER_EMAIL', '')
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import datastore
+from google.appengine.api import datastore_file_stub
+from google.appengine.ext import db
+
+
+ENTITIES = 1000
+
+
+class Other(db.Model):
+  number = db.IntegerProperty()
+
+
+class Wide(db.Model):
+  """A model with 15 properties of the common types."""
+  string = db.StringProperty()
+  required = db.StringProperty(required=True, default='default')
+  choice = db.StringProperty(choices=['a', 'b'])
+  text = db.TextProperty()
+  integer = db.IntegerProperty()
+  default = db.IntegerProperty(default=7)
+  real = db.FloatProperty()
+  boolean = db.BooleanProperty()
+  created = db.DateTimeProperty(auto_now_add=True)
+  date = db.DateProperty()
+  time = db.TimeProperty()
+  numbers = db.ListProperty(long)
+  category = db.CategoryProperty()
+  other = db.ReferenceProperty(Other)
+  renamed = db.StringProperty(name='stored_name')
+
+
+def ConstructorFromEntity(entity):
+  """Makes a Wide instance from an entity the way from_entity() used to."""
+  instance = Wide(None, **Wide._load_entity_values(entity))
+  instance._entity = entity
+  del instance._key_name
+  return instance
+
+
+def Populate():
+  """Stores ENTITIES Wide entities and returns them as datastore.Entity."""
+  other = Other(number=1)
+  other.put()
+  models = []
+  for index in xrange(ENTITIES):
+    models.append(Wide(string='string%d' % index, choice='a',
+                       text=db.Text('text'), integer=index, real=index / 3.0,
+                       boolean=bool(index % 2),
+                       date=datetime.date(2008, 1, 1),
+                       time=datetime.time(1, 2), numbers=[long(index), 1L],
+                       category=db.Category('category'),
+                       other=index % 2 and other or None,
+                       renamed='renamed'))
+  db.put(models)
+  return datastore.Get([model.key() for model in models])
+
+
+def Time(function, repeat=5):
+  """Returns the best time of several calls to a function, in seconds."""
+  best = None
+  for i in xrange(repeat):
+    start = time.time()
+    function()
+    elapsed = time.time() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best
+
+
+def main():
+  apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+  apiproxy_stub_map.apiproxy.RegisterStub(
+      'datastore_v3',
+      datastore_file_stub.DatastoreFileStub('benchmark', None, None))
+
+  entities = Populate()
+  for entity in entities:
+    loaded = Wide.from_entity(entity)
+    constructed = ConstructorFromEntity(entity)
+    assert loaded.__dict__ == constructed.__dict__, (
+        'from_entity() differs from the constructor')
+
+  query = Wide.all()
+
+  def Report(label):
+    fetch_time = Time(lambda: query.fetch(ENTITIES))
+    load_time = Time(lambda: map(Wide.from_entity, entities))
+    print '%-28s fetch(%d) %7.1f ms  from_entity() %7.1f ms' % (
+        label, ENTITIES, fetch_time * 1000, load_time * 1000)
+
+  Report('loader')
+  db.VALIDATE_ON_LOAD = True
+  Report('loader, VALIDATE_ON_LOAD')
+  db.VALIDATE_ON_LOAD = False
+  Wide._entity_loader = None
+  Report('constructor')
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
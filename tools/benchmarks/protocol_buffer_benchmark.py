@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+#
+# Copyright 2007 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Microbenchmarks for the ProtocolBuffer Encoder and Decoder.
+
+Times encoding and decoding a batch of entity_pb.EntityProto with a mix of
+property types, and the Encoder and Decoder primitives they use most: varints
+of different sizes, fixed-width integers and doubles, and prefixed strings.
+
+It also prints an MD5 digest of the encoded entities. To compare with another
+SDK, run the script with that SDK's root directory. The digests must match,
+since the encoding has to stay byte-for-byte compatible.
+
+Usage:
+  tools/benchmarks/protocol_buffer_benchmark.py [sdk_root]
+
+sdk_root defaults to the SDK this script is in.
+"""
+
+
+import datetime
+import md5
+import os
+import random
+import sys
+import time
+
+if len(sys.argv) > 1:
+  DIR_PATH = os.path.abspath(sys.argv[1])
+else:
+  DIR_PATH = os.path.abspath(os.path.dirname(os.path.dirname(
+                 os.path.dirname(os.path.realpath(__file__)))))
+
+EXTRA_PATHS = [
+  DIR_PATH,
+  os.path.join(DIR_PATH, 'lib', 'django'),
+  os.path.join(DIR_PATH, 'lib', 'webob'),
+  os.path.join(DIR_PATH, 'lib', 'yaml', 'lib'),
+]
+
+sys.path = EXTRA_PATHS + sys.path
+os.environ.setdefault('APPLICATION_ID', 'benchmark')
+
+from google.appengine.api import datastore
+from google.appengine.api import datastore_types
+from google.appengine.datastore import entity_pb
+from google.net.proto import ProtocolBuffer
+
+
+ENTITIES = 300
+
+PRIMITIVE_VALUES = 10000
+
+
+def MakeEntities():
+  """Returns ENTITIES entity_pb.EntityProto with a mix of property types."""
+  random.seed(3)
+  entities = []
+  for index in xrange(ENTITIES):
+    entity = datastore.Entity('Item', name='item%d' % index)
+    entity['large'] = random.randint(-2 ** 40, 2 ** 40)
+    entity['small'] = random.randint(0, 100)
+    entity['negative'] = -index
+    entity['string'] = 'x' * random.randint(0, 50)
+    entity['unicode'] = u'caf\xe9 %d' % index
+    entity['float'] = random.random()
+    entity['datetime'] = datetime.datetime(2008, 1, 1 + index % 20)
+    entity['bool'] = bool(index % 2)
+    entity['list'] = [random.randint(0, 10 ** 6) for i in xrange(5)]
+    entity['reference'] = datastore_types.Key.from_path('Other', index + 1)
+    entities.append(entity._ToPb())
+  return entities
+
+
+def Time(function, repeat=5):
+  """Returns the best time of several calls to a function, in seconds."""
+  best = None
+  for i in xrange(repeat):
+    start = time.time()
+    function()
+    elapsed = time.time() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best
+
+
+def Report(label, seconds, count):
+  """Prints a time per item, in microseconds."""
+  print '%-36s %8.2f us' % (label, seconds / count * 1e6)
+
+
+def BenchmarkEntities():
+  """Times EntityProto encoding and decoding, and checks the round trip."""
+  entities = MakeEntities()
+  encoded = [entity.Encode() for entity in entities]
+  decoded = [entity_pb.EntityProto(contents) for contents in encoded]
+  assert [entity.Encode() for entity in decoded] == encoded, (
+      'EntityProto round trip changed the encoding')
+
+  print 'Encoded entities digest: %s' % md5.new(''.join(encoded)).hexdigest()
+  Report('EntityProto.Encode()',
+         Time(lambda: [entity.Encode() for entity in entities]), ENTITIES)
+  Report('EntityProto(contents)',
+         Time(lambda: [entity_pb.EntityProto(contents)
+                       for contents in encoded]), ENTITIES)
+
+
+def BenchmarkEncoder(method, values, label):
+  """Times an Encoder method on each of values, and returns the encoding."""
+  def Encode():
+    encoder = ProtocolBuffer.Encoder()
+    put = getattr(encoder, method)
+    for value in values:
+      put(value)
+    return encoder.buffer()
+
+  Report('Encoder.%s %s' % (method, label), Time(Encode), len(values))
+  return Encode()
+
+
+def BenchmarkDecoder(method, data, count, label):
+  """Times reading count values with a Decoder method."""
+  def Decode():
+    decoder = ProtocolBuffer.Decoder(data, 0, len(data))
+    get = getattr(decoder, method)
+    for i in xrange(count):
+      get()
+
+  Report('Decoder.%s %s' % (method, label), Time(Decode), count)
+
+
+def BenchmarkPrimitives():
+  """Times the Encoder and Decoder primitives on random values."""
+  random.seed(5)
+  small = [random.randint(0, 127) for i in xrange(PRIMITIVE_VALUES)]
+  medium = [random.randint(128, 2 ** 21) for i in xrange(PRIMITIVE_VALUES)]
+  large = [random.randint(-2 ** 62, 2 ** 62) for i in xrange(PRIMITIVE_VALUES)]
+  fixed32 = [random.randint(0, 2 ** 32 - 1) for i in xrange(PRIMITIVE_VALUES)]
+  fixed64 = [random.randint(0, 2 ** 64 - 1) for i in xrange(PRIMITIVE_VALUES)]
+  doubles = [random.random() for i in xrange(PRIMITIVE_VALUES)]
+  strings = ['x' * random.randint(0, 30) for i in xrange(PRIMITIVE_VALUES)]
+
+  for label, method, get_method, values in (
+      ('(1 byte)', 'putVarInt32', 'getVarInt32', small),
+      ('(2-3 bytes)', 'putVarInt32', 'getVarInt32', medium),
+      ('(large)', 'putVarInt64', 'getVarInt64', large),
+      ('', 'put32', 'get32', fixed32),
+      ('', 'put64', 'get64', fixed64),
+      ('', 'putDouble', 'getDouble', doubles),
+      ('', 'putPrefixedString', 'getPrefixedString', strings)):
+    data = BenchmarkEncoder(method, values, label)
+    BenchmarkDecoder(get_method, data, len(values), label)
+
+
+def main():
+  BenchmarkEntities()
+  BenchmarkPrimitives()
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
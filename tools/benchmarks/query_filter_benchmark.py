@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+#
+# Copyright 2007 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Compares the compiled query filters in datastore_stub_util with eval().
+
+The datastore stubs used to run a filter by converting each entity value to a
+Python value and eval()ing '<entity value> <op> <filter value>'.
+CompileFilter() replaces that, and must give the same answers. This script
+first runs both on the same values, including int literals against float
+properties and float literals against int properties, and reports any
+differences. It then times both on a range filter over each number of
+entities given, and a DatastoreFileStub query with the same filter, which
+also uses the stub's property index.
+
+The eval() path is timed without the entity conversions the stub used to
+make around it, so the old cost was higher than reported.
+
+Usage:
+  tools/benchmarks/query_filter_benchmark.py [entities ...]
+
+The default is 10000 and 100000 entities.
+"""
+
+
+import os
+import sys
+import time
+
+DIR_PATH = os.path.abspath(os.path.dirname(os.path.dirname(
+               os.path.dirname(os.path.realpath(__file__)))))
+
+EXTRA_PATHS = [
+  DIR_PATH,
+  os.path.join(DIR_PATH, 'lib', 'django'),
+  os.path.join(DIR_PATH, 'lib', 'webob'),
+  os.path.join(DIR_PATH, 'lib', 'yaml', 'lib'),
+]
+
+sys.path = EXTRA_PATHS + sys.path
+os.environ.setdefault('APPLICATION_ID', 'benchmark')
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import datastore
+from google.appengine.api import datastore_file_stub
+from google.appengine.api import datastore_types
+from google.appengine.datastore import datastore_pb
+from google.appengine.datastore import datastore_stub_util
+
+
+_EVAL_OPERATORS = {
+  datastore_pb.Query_Filter.LESS_THAN:             '<',
+  datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL:    '<=',
+  datastore_pb.Query_Filter.GREATER_THAN:          '>',
+  datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL: '>=',
+  datastore_pb.Query_Filter.EQUAL:                 '==',
+  }
+
+DEFAULT_SIZES = [10000, 100000]
+
+CHECK_VALUES = [-2, -1.5, 0, 0.0, 1.0, 2.5, 3, 3.0, 7.0, 7, 2 ** 53 + 1,
+                float(2 ** 53), u'abc', True, None]
+
+
+def MakeEntities(values):
+  """Returns an entity_pb.EntityProto with property 'p' for each value."""
+  entities = []
+  for index, value in enumerate(values):
+    entity = datastore.Entity('Item', name='item%d' % index)
+    entity['p'] = value
+    entities.append(entity._ToPb())
+  return entities
+
+
+def MakeFilter(op, value):
+  """Returns a datastore_pb.Query_Filter on property 'p'."""
+  filt = datastore_pb.Query_Filter()
+  filt.set_op(op)
+  filt.add_property().CopyFrom(datastore_types.ToPropertyPb('p', value))
+  return filt
+
+
+def EvalFilter(filt):
+  """Returns a predicate that runs a filter the way the stubs used to."""
+  op = _EVAL_OPERATORS[filt.op()]
+  filter_values = [datastore_types.FromPropertyPb(prop)
+                   for prop in filt.property_list()]
+
+  def passes(entity):
+    for prop in entity.property_list():
+      if prop.name() == 'p':
+        entity_value = datastore_types.FromPropertyPb(prop)
+        for filter_value in filter_values:
+          if eval(u'%r %s %r' % (entity_value, op, filter_value)):
+            return True
+    return False
+
+  return passes
+
+
+def CheckFilters():
+  """Compares CompileFilter() with EvalFilter() on mixed int and float values.
+
+  Only values of the same type, or two numbers, are compared. eval() orders
+  other values by type name, or treats bools as ints, rather than using the
+  datastore order.
+
+  Returns:
+    int, the number of differences found
+  """
+  numeric = (int, long, float)
+  differences = 0
+  for entity_value in CHECK_VALUES:
+    entity, = MakeEntities([entity_value])
+    for filter_value in CHECK_VALUES:
+      if (type(entity_value) != type(filter_value) and
+          not (type(entity_value) in numeric and
+               type(filter_value) in numeric)):
+        continue
+      for op in _EVAL_OPERATORS:
+        filt = MakeFilter(op, filter_value)
+        expected = EvalFilter(filt)(entity)
+        actual = datastore_stub_util.CompileFilter(filt)(entity)
+        if expected != actual:
+          differences += 1
+          print 'DIFFERENT: %r %s %r: eval %s, compiled %s' % (
+              entity_value, _EVAL_OPERATORS[op], filter_value, expected,
+              actual)
+  return differences
+
+
+def Time(function, repeat=3):
+  """Returns the best time of several calls to a function, in seconds."""
+  best = None
+  for i in xrange(repeat):
+    start = time.time()
+    function()
+    elapsed = time.time() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best
+
+
+def BenchmarkFilters(size):
+  """Times a range filter over size entities with eval() and compiled filters.
+
+  Prints the time for each, and for the same query run by a DatastoreFileStub.
+  The stub builds its property index on the first run, which isn't counted.
+  """
+  entities = MakeEntities([index % 1000 for index in xrange(size)])
+  filters = [MakeFilter(datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL, 500),
+             MakeFilter(datastore_pb.Query_Filter.LESS_THAN, 510)]
+
+  def Run(predicates):
+    return [entity for entity in entities
+            if predicates[0](entity) and predicates[1](entity)]
+
+  eval_predicates = [EvalFilter(filt) for filt in filters]
+  compiled_predicates = [datastore_stub_util.CompileFilter(filt)
+                         for filt in filters]
+  assert Run(eval_predicates) == Run(compiled_predicates)
+
+  eval_time = Time(lambda: Run(eval_predicates), repeat=1)
+  compiled_time = Time(lambda: Run(compiled_predicates))
+
+  apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+  stub = datastore_file_stub.DatastoreFileStub('benchmark', None, None)
+  apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', stub)
+  put_request = datastore_pb.PutRequest()
+  put_request.entity_list().extend(entities)
+  stub.MakeSyncCall('datastore_v3', 'Put', put_request,
+                    datastore_pb.PutResponse())
+  query = datastore.Query('Item', {'p >=': 500, 'p <': 510})
+  stub_time = Time(lambda: query.Get(1000))
+
+  print ('%8d entities: eval %9.1f ms  compiled %8.1f ms (%4.1fx)  '
+         'stub query %6.2f ms' % (size, eval_time * 1000, compiled_time * 1000,
+                                  eval_time / compiled_time, stub_time * 1000))
+
+
+def main(argv):
+  differences = CheckFilters()
+  if differences:
+    print '%d filters differ from eval()' % differences
+    return 1
+  print 'Compiled filters match eval()'
+
+  sizes = [int(arg) for arg in argv[1:]] or DEFAULT_SIZES
+  for size in sizes:
+    BenchmarkFilters(size)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
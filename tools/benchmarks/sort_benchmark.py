@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+#
+# Copyright 2007 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Times sorting query results with and without a limit.
+
+The datastore stubs used to sort every result of a query with a cmp function
+that took the min() of each entity's values on every comparison, then apply
+the query's limit. datastore_stub_util.SortEntities() computes each entity's
+sort key once, and with a limit keeps only the first results in a heap. This
+script checks that all three give the same order, then times:
+
+  - the old cmp sort, on entities already converted to datastore.Entity,
+  - SortEntities() without a limit,
+  - SortEntities() with a limit of 20,
+
+for a single ascending order and for a descending order with a second
+ascending one.
+
+Usage:
+  tools/benchmarks/sort_benchmark.py [entities ...]
+
+The default is 100000 entities.
+"""
+
+
+import os
+import random
+import sys
+import time
+
+DIR_PATH = os.path.abspath(os.path.dirname(os.path.dirname(
+               os.path.dirname(os.path.realpath(__file__)))))
+
+EXTRA_PATHS = [
+  DIR_PATH,
+  os.path.join(DIR_PATH, 'lib', 'django'),
+  os.path.join(DIR_PATH, 'lib', 'webob'),
+  os.path.join(DIR_PATH, 'lib', 'yaml', 'lib'),
+]
+
+sys.path = EXTRA_PATHS + sys.path
+os.environ.setdefault('APPLICATION_ID', 'benchmark')
+
+from google.appengine.api import datastore
+from google.appengine.datastore import datastore_pb
+from google.appengine.datastore import datastore_stub_util
+
+
+DEFAULT_SIZES = [100000]
+
+LIMIT = 20
+
+ORDERINGS = [
+  [('x', datastore_pb.Query_Order.ASCENDING)],
+  [('y', datastore_pb.Query_Order.DESCENDING),
+   ('x', datastore_pb.Query_Order.ASCENDING)],
+  ]
+
+
+def MakeEntities(size):
+  """Returns size entity_pb.EntityProto with random properties x and y."""
+  random.seed(size)
+  entities = []
+  for index in xrange(size):
+    entity = datastore.Entity('Item', name='item%d' % index)
+    entity['x'] = random.randint(0, 1000000)
+    entity['y'] = [random.randint(0, 100) for i in xrange(random.randint(1, 3))]
+    entities.append(entity._ToPb())
+  return entities
+
+
+def MakeOrders(ordering):
+  """Returns a list of datastore_pb.Query_Order."""
+  orders = []
+  for name, direction in ordering:
+    order = datastore_pb.Query_Order()
+    order.set_property(name)
+    order.set_direction(direction)
+    orders.append(order)
+  return orders
+
+
+def CmpSort(entities, ordering, limit=None):
+  """Sorts datastore.Entity objects the way the stubs used to."""
+
+  def order_compare(a, b):
+    for name, direction in ordering:
+      a_values = a[name]
+      if not isinstance(a_values, list):
+        a_values = [a_values]
+      b_values = b[name]
+      if not isinstance(b_values, list):
+        b_values = [b_values]
+
+      cmped = cmp(min(a_values), min(b_values))
+      if direction == datastore_pb.Query_Order.DESCENDING:
+        cmped = -cmped
+      if cmped != 0:
+        return cmped
+    return 0
+
+  results = list(entities)
+  results.sort(order_compare)
+  if limit is not None:
+    results = results[:limit]
+  return results
+
+
+def Time(function, repeat=3):
+  """Returns the best time of several calls to a function, in seconds."""
+  best = None
+  for i in xrange(repeat):
+    start = time.time()
+    function()
+    elapsed = time.time() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best
+
+
+def Benchmark(size):
+  """Times the three sorts over size entities, for each of ORDERINGS."""
+  entities = MakeEntities(size)
+  converted = [datastore.Entity._FromPb(entity) for entity in entities]
+
+  for ordering in ORDERINGS:
+    orders = MakeOrders(ordering)
+
+    expected = [entity.key() for entity in CmpSort(converted, ordering, LIMIT)]
+    for limit in (None, LIMIT):
+      results = datastore_stub_util.SortEntities(entities, orders, limit)
+      actual = [datastore.Entity._FromPb(entity).key()
+                for entity in results[:LIMIT]]
+      assert actual == expected, 'SortEntities() order differs'
+
+    cmp_time = Time(lambda: CmpSort(converted, ordering, LIMIT), repeat=1)
+    full_time = Time(lambda: datastore_stub_util.SortEntities(entities,
+                                                              orders))
+    limit_time = Time(lambda: datastore_stub_util.SortEntities(entities,
+                                                               orders, LIMIT))
+
+    description = ', '.join(['%s%s' % (
+        direction == datastore_pb.Query_Order.DESCENDING and '-' or '', name)
+        for name, direction in ordering])
+    print ('%8d entities, order by %-6s  cmp sort %8.1f ms  '
+           'sort keys %8.1f ms  top %d %8.1f ms' %
+           (size, description, cmp_time * 1000, full_time * 1000, LIMIT,
+            limit_time * 1000))
+
+
+def main(argv):
+  sizes = [int(arg) for arg in argv[1:]] or DEFAULT_SIZES
+  for size in sizes:
+    Benchmark(size)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))